@@ -0,0 +1,66 @@
+import typing
+
+from .utils import tf, PhaseTimer
+from .layers import attn_hat, attn_hat_xla, orthogonal_gaussian, softmax_kernel_transformation
+
+
+def transposed_attn_hat(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, random_feats: tf.Tensor) -> tf.Tensor:
+    """FAVOR+ attention computed the way attn_hat used to, with sequence major (L, B, H, M) copies of the heads &
+    features and a vector of ones for the normaliser, the baseline of favor_benchmark. Softmax kernel,
+    query, key & value B, H, L, D in, B, L, H, D out like attn_hat."""
+    sequence_length = tf.shape(key)[2]
+    query = tf.transpose(query, [0, 2, 1, 3])
+    key = tf.transpose(key, [0, 2, 1, 3])
+    q_prime = softmax_kernel_transformation(query, projection_matrix=random_feats, is_query=True)  # B L H M
+    k_prime = softmax_kernel_transformation(key, projection_matrix=random_feats, is_query=False)  # B L H M
+
+    value = tf.transpose(value, [2, 0, 1, 3])  # L B H D
+    k_prime = tf.transpose(k_prime, [1, 0, 2, 3])  # L B H M
+    q_prime = tf.transpose(q_prime, [1, 0, 2, 3])  # L B H M
+
+    # noinspection SpellCheckingInspection
+    av_attention = tf.einsum("lbhm,lbhd->bhmd", k_prime, value)
+    # noinspection SpellCheckingInspection
+    av_attention = tf.einsum("lbhm,bhmd->lbhd", q_prime, av_attention)
+    # noinspection SpellCheckingInspection
+    normalizer = tf.einsum("lbhm,l->bhm", k_prime, tf.ones(sequence_length, dtype=k_prime.dtype))
+    # noinspection SpellCheckingInspection
+    normalizer = tf.einsum("lbhm,bhm->lbh", q_prime, normalizer)
+    av_attention = tf.transpose(av_attention, [1, 0, 2, 3])  # B L H D
+    normalizer = tf.transpose(normalizer, [1, 0, 2])  # B L H
+    return av_attention / tf.expand_dims(normalizer, -1)
+
+
+def favor_benchmark(batch_size: int = 8, num_heads: int = 8, sequence_length: int = 512, depth: int = 64,
+                    num_features: int = 128, iterations: int = 10) -> typing.Dict[str, float]:
+    """Time the (non causal, softmax kernel) FAVOR+ attention of one Performer layer on random heads.
+    Every version is traced (& compiled) by a first call before it is timed.
+    Args:
+        :param batch_size: int
+            The batch size
+        :param num_heads: int
+            Number of heads
+        :param sequence_length: int
+            Length of the query, key & value
+        :param depth: int
+            Size of each head
+        :param num_features: int
+            Number of random features
+        :param iterations: int
+            Calls timed per version
+    :return: Dict[str, float]
+        Seconds per call of 'transposed' (transposed_attn_hat), 'fused' (attn_hat) & 'fused_xla' (attn_hat_xla),
+        all three in a tf.function.
+    """
+    query, key, value = [tf.random.normal((batch_size, num_heads, sequence_length, depth)) for _ in range(3)]
+    random_feats = orthogonal_gaussian(num_features, depth)
+    versions = {'transposed': tf.function(transposed_attn_hat),
+                'fused': tf.function(attn_hat),
+                'fused_xla': attn_hat_xla}
+    timer = PhaseTimer()
+    for name, version in versions.items():
+        version(query, key, value, random_feats=random_feats)
+        with timer.phase(name):
+            for _ in range(iterations):
+                version(query, key, value, random_feats=random_feats).numpy()
+    return {name: timer.timings[name] / iterations for name in versions}
@@ -5,6 +5,7 @@ from typing import List, AnyStr, Dict, Union
 import numpy as np
 
 from .models import tf, tfds
+from .layers import GavinMultiHeadAttention, GavinMultiHeadPerformerAttention, orthogonal_gaussians
 
 
 class PredictCallback(tf.keras.callbacks.Callback):
@@ -33,14 +34,9 @@ class PredictCallback(tf.keras.callbacks.Callback):
         self.file_writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'train/'))
 
     def _predict(self):
-        predictions = []
         print("Predicting... (This could take a little bit.)")
-        for i in range(random.randint(self.minimum_samples, self.maximum_samples)):
-            sentence = self.prompts[i]
-            prediction = self.wrapper_model.predict(sentence)
-
-            predictions.append(
-                (sentence, prediction))
+        sentences = self.prompts[:random.randint(self.minimum_samples, self.maximum_samples)]
+        predictions = list(zip(sentences, self.wrapper_model.predict_batch(sentences)))
         random.shuffle(self.prompts)
 
         return predictions
@@ -78,6 +74,10 @@ class PredictCallback(tf.keras.callbacks.Callback):
 class AttentionImageLoggingCallback(tf.keras.callbacks.Callback):
     def __init__(self, log_dir: AnyStr, verbose: int = 0, update_freq: Union[int, str] = 'epoch',
                  wrapper_model=None):
+        """Log the attention of every attention layer that can capture it (see GavinMultiHeadAttention.arm_capture)
+        as one image per head. The layers are armed for a single training step, every update_freq batches
+        or the first batch of every epoch, so other steps don't keep any attention matrix around.
+        """
         super(AttentionImageLoggingCallback, self).__init__()
         if wrapper_model is None:
             raise ValueError("Wrapper model must be passed to AttentionImageLoggingCallback.")
@@ -86,52 +86,85 @@ class AttentionImageLoggingCallback(tf.keras.callbacks.Callback):
         self.log_dir = log_dir
         self.update_freq = update_freq
         self.batches = 0
+        self.armed = False
         self.attention_layers = self._get_attention_layers()
         self.file_writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'train/'))
         self.wrapper_model = wrapper_model
 
     def _get_attention_layers(self):
-        encoder_layers_names = [layer.name for layer in self.model.get_layer('encoder').layers if 'encoder_layer_' in layer.name]
-        attention_layers_names = []
-        for encoder_layers_name in encoder_layers_names:
-            attention_layers_names.extend([(encoder_layers_name, layer.name) for layer in self.model.get_layer('encoder').get_layer(encoder_layers_name).layers if 'multi_head_attention' in layer.name])
-        if self.verbose > 0:
-            tf.print(f"Found {len(attention_layers_names)} attention layers.")
-            tf.print(f"Attention layers: {attention_layers_names}")
-        return attention_layers_names
-
-    def _log_attention_images(self, value, logs):
-        self.attention_layers = self._get_attention_layers()
-        for encoder_decoder_name, attention_name in self.attention_layers:
-            if 'encoder' in encoder_decoder_name:
-                if hasattr(self.model.get_layer('encoder').get_layer(encoder_decoder_name).get_layer(attention_name), 'saved_attention_image'):
-                    image_matrix = self.model.get_layer('encoder').get_layer(encoder_decoder_name).get_layer(attention_name).saved_attention_image
-                else:
-                    continue
-            else:
-                if hasattr(self.model.get_layer('decoder').get_layer(encoder_decoder_name).get_layer(attention_name), 'saved_attention_image'):
-                    image_matrix = self.model.get_layer('decoder').get_layer(encoder_decoder_name).get_layer(attention_name).saved_attention_image
-                else:
+        attention_layers = []
+        for part in ['encoder', 'decoder']:
+            for sub_layer in self.model.get_layer(part).layers:
+                if not isinstance(sub_layer, tf.keras.Model):
                     continue
-            image_matrix = tf.transpose(image_matrix, perm=[0, 3, 2, 1])
+                attention_layers.extend([(sub_layer.name, layer) for layer in sub_layer.layers
+                                         if isinstance(layer, GavinMultiHeadAttention) and layer.capture_armed is not None])
+        if self.verbose > 0:
+            tf.print(f"Found {len(attention_layers)} attention layers.")
+            tf.print(f"Attention layers: {[(name, layer.name) for name, layer in attention_layers]}")
+        return attention_layers
+
+    def _arm(self, armed: bool = True):
+        for _, layer in self.attention_layers:
+            layer.arm_capture(armed)
+        self.armed = armed
+
+    def _log_attention_images(self):
+        for layer_name, layer in self.attention_layers:
+            image_matrix = layer.attention_image[..., tf.newaxis]  # H, size, size, 1
             if self.verbose > 0:
-                tf.print(f"Saving attention image for {encoder_decoder_name} | {attention_name}", end=" ")
+                tf.print(f"Saving attention image for {layer_name} | {layer.name}", end=" ")
                 tf.print(f"Image shape: {image_matrix.shape}")
             with self.file_writer.as_default():
                 with tf.name_scope("Attention Image"):
-                    tf.summary.image(f"{encoder_decoder_name} | {attention_name}", image_matrix, step=self.batches)
+                    tf.summary.image(f"{layer_name} | {layer.name}", image_matrix, step=self.batches,
+                                     max_outputs=layer.num_heads)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.update_freq == "epoch":
+            self._arm()
 
     def on_batch_begin(self, batch, logs=None):
         self.batches += 1
         if isinstance(self.update_freq, int) and self.update_freq != 0:
             if self.batches % self.update_freq == 0:
-                self._log_attention_images(batch, logs)
+                self._arm()
 
-    def on_epoch_end(self, epoch, logs=None):
-        epoch += 1
-        if isinstance(self.update_freq, str):
-            if self.update_freq == "epoch":
-                self._log_attention_images(value=epoch, logs=logs)
+    def on_batch_end(self, batch, logs=None):
+        if self.armed:
+            self._log_attention_images()
+            self._arm(False)
+
+
+class FeatureRedrawCallback(tf.keras.callbacks.Callback):
+    def __init__(self, redraw_steps: int):
+        """Redraw the random features of every Performer attention layer of the model being trained every
+        redraw_steps batches, as FAVOR+ recommends. The features of all the layers are drawn together between
+        two training steps (see orthogonal_gaussians), the steps themselves only read them.
+        """
+        super(FeatureRedrawCallback, self).__init__()
+        if redraw_steps < 1:
+            raise ValueError(f"redraw_steps must be at least 1, got {redraw_steps}.")
+        self.redraw_steps = redraw_steps
+        self.batches = 0
+        self.performer_layers = []
+
+    def redraw(self):
+        layers_by_shape = {}
+        for layer in self.performer_layers:
+            layers_by_shape.setdefault(tuple(layer.random_feats.shape), []).append(layer)
+        for (num_features, depth), layers in layers_by_shape.items():
+            for layer, random_feats in zip(layers, tf.unstack(orthogonal_gaussians(len(layers), num_features, depth))):
+                layer.redraw_features(random_feats)
+
+    def on_train_begin(self, logs=None):
+        self.performer_layers = [layer for layer in self.model.submodules
+                                 if isinstance(layer, GavinMultiHeadPerformerAttention)]
+
+    def on_batch_end(self, batch, logs=None):
+        self.batches += 1
+        if self.batches % self.redraw_steps == 0:
+            self.redraw()
 
 
 # Source: https://www.tensorflow.org/guide/keras/custom_callback#usage_of_selfmodel_attribute
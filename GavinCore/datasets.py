@@ -1,9 +1,42 @@
 from .models import tf
 from .load_data import *  # Ensures GavinBackendDatasetUtils can load
+from .token_files import IndexedTokenFile
 if IS_SUPPORTED_VERSION:
     import GavinBackendDatasetUtils as LTD
 else:
-    import GavinBackend.GavinCore.empty_classes as LTD
+    from . import empty_classes as LTD
+
+
+def open_token_file(path: str, start_token: int, end_token: int, max_length: int,
+                    padding_value: int) -> typing.Union[IndexedTokenFile, LTD.BINFile]:
+    """Open path as a native IndexedTokenFile when one exists, falling back to GavinBackendDatasetUtils.BINFile."""
+    if IndexedTokenFile.exists(path):
+        return IndexedTokenFile(path, start_token, end_token, max_length, padding_value)
+    return LTD.BINFile(path, start_token, end_token, max_length, padding_value)
+
+
+# Model inputs & targets of a batch
+ModelBatch = typing.Tuple[typing.Dict[str, tf.Tensor], typing.Dict[str, tf.Tensor]]
+
+
+def teacher_forcing(answers: tf.Tensor, segments: tf.Tensor = None) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """Decoder inputs & targets of a batch of padded answers, the targets are the answers shifted left by one.
+    Done once per batch in the tf.data graph with slices, rather than copying & rolling every sample.
+    Args:
+        :param answers: tf.Tensor
+            Padded answers starting with the start token (batch_size, sequence_length)
+        :param segments: tf.Tensor
+            Segment ids of packed answers (batch_size, sequence_length), see DatasetAPICreator.pack_samples
+    :return: Tuple[tf.Tensor, tf.Tensor]
+        dec_inputs & outputs (batch_size, sequence_length)
+    """
+    outputs = tf.pad(answers[:, 1:], [[0, 0], [0, 1]])
+    if segments is None:
+        # Nothing follows the last position, so it's only padding in the decoder inputs.
+        return tf.pad(answers[:, :-1], [[0, 0], [0, 1]]), outputs
+    # A segment's last token targets padding rather than the first token of the next segment.
+    next_segments = tf.pad(segments[:, 1:], [[0, 0], [0, 1]])
+    return answers, outputs * tf.cast(tf.equal(next_segments, segments), outputs.dtype)
 
 
 class DatasetAPICreator:
@@ -30,38 +63,181 @@ class DatasetAPICreator:
         second_part = {'outputs': new_outputs}
         return first_part, second_part
 
+    @staticmethod
+    def sequence_lengths(data: np.ndarray) -> np.ndarray:
+        """Length of every row of a padded (number_of_samples, max_length) array, up to and including the last non 0 token."""
+        not_padding = data != 0
+        return np.where(not_padding.any(axis=1), data.shape[1] - np.argmax(not_padding[:, ::-1], axis=1), 0)
+
+    @staticmethod
+    def bucket_batch_sizes(bucket_boundaries: typing.List[int], max_length: int, tokens_per_batch: int) -> typing.List[int]:
+        """Batch size of every bucket so that a batch padded to the bucket's longest possible sample holds at most
+        tokens_per_batch tokens (per input), with at least one sample per batch."""
+        longest = [boundary - 1 for boundary in bucket_boundaries] + [max_length]
+        return [max(1, tokens_per_batch // length) for length in longest]
+
+    def bucketed_dataset(self, dataset: tf.data.Dataset, bucket_boundaries: typing.List[int], max_length: int,
+                         tokens_per_batch: int) -> tf.data.Dataset:
+        """Group samples of similar length into batches of roughly tokens_per_batch tokens,
+        every batch is padded to the longest sample in it rather than max_length."""
+        return dataset.bucket_by_sequence_length(
+            element_length_func=lambda inputs, outputs: tf.maximum(tf.shape(inputs['inputs'])[0],
+                                                                   tf.shape(inputs['dec_inputs'])[0]),
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=self.bucket_batch_sizes(bucket_boundaries, max_length, tokens_per_batch),
+            padded_shapes=({'inputs': [None], 'dec_inputs': [None]}, {'outputs': [None]}),
+            padding_values=0)
+
+    @classmethod
+    def pack_samples(cls, questions: np.ndarray, answers: np.ndarray, open_rows: int = 8) -> typing.Dict[str, np.ndarray]:
+        """Pack several samples into every max_length row, in place of padding each sample to max_length.
+        Samples go into the first of the last open_rows rows with room for both the question and the answer,
+        every sample of a row gets its own segment id (from 1, 0 is padding) for the segment aware masks.
+        Pass the packed answers & segments to teacher_forcing, so no target crosses a segment boundary.
+        Args:
+            :param questions: np.ndarray
+                Padded questions (number_of_samples, max_length)
+            :param answers: np.ndarray
+                Padded answers (number_of_samples, max_length)
+            :param open_rows: int
+                Number of rows still being filled, more packs tighter but each sample checks more rows
+        :return: Dict[str, np.ndarray]
+            'inputs', 'answers', 'inputs_segments' & 'dec_segments', all (number_of_rows, max_length)
+        """
+        max_length = questions.shape[1]
+        question_lengths = cls.sequence_lengths(questions)
+        answer_lengths = cls.sequence_lengths(answers)
+
+        rows = np.zeros(len(questions), dtype=np.int64)
+        question_offsets = np.zeros(len(questions), dtype=np.int64)
+        answer_offsets = np.zeros(len(questions), dtype=np.int64)
+        segments = np.zeros(len(questions), dtype=np.int32)
+        used = []  # [question tokens, answer tokens, segments] of every row
+        candidates = []
+        for sample, (question_length, answer_length) in enumerate(zip(question_lengths, answer_lengths)):
+            row = next((row for row in candidates if used[row][0] + question_length <= max_length
+                        and used[row][1] + answer_length <= max_length), None)
+            if row is None:
+                row = len(used)
+                used.append([0, 0, 0])
+                candidates = (candidates + [row])[-open_rows:]
+            rows[sample] = row
+            question_offsets[sample], answer_offsets[sample] = used[row][0], used[row][1]
+            used[row] = [used[row][0] + question_length, used[row][1] + answer_length, used[row][2] + 1]
+            segments[sample] = used[row][2]
+
+        def scatter(data: np.ndarray, lengths: np.ndarray, offsets: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+            sample = np.repeat(np.arange(len(data)), lengths)
+            position = np.arange(len(sample)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            packed = np.zeros((len(used), max_length), dtype=data.dtype)
+            packed_segments = np.zeros((len(used), max_length), dtype=np.int32)
+            packed[rows[sample], offsets[sample] + position] = data[sample, position]
+            packed_segments[rows[sample], offsets[sample] + position] = segments[sample]
+            return packed, packed_segments
+
+        packed_questions, questions_segments = scatter(questions, question_lengths, question_offsets)
+        packed_answers, answers_segments = scatter(answers, answer_lengths, answer_offsets)
+        return {'inputs': packed_questions, 'answers': packed_answers,
+                'inputs_segments': questions_segments, 'dec_segments': answers_segments}
+
+    @staticmethod
+    def packed_teacher_forcing(packed: typing.Dict[str, tf.Tensor]) -> ModelBatch:
+        """Model inputs & targets of a batch from pack_samples."""
+        dec_inputs, outputs = teacher_forcing(packed['answers'], packed['dec_segments'])
+        return ({'inputs': packed['inputs'], 'dec_inputs': dec_inputs,
+                 'inputs_segments': packed['inputs_segments'], 'dec_segments': packed['dec_segments']},
+                {'outputs': outputs})
+
+    @staticmethod
+    def batch_teacher_forcing(questions: tf.Tensor, answers: tf.Tensor) -> ModelBatch:
+        """Model inputs & targets of a batch of padded questions & answers."""
+        dec_inputs, outputs = teacher_forcing(answers)
+        return {'inputs': questions, 'dec_inputs': dec_inputs}, {'outputs': outputs}
+
+    @staticmethod
+    def trimmed_teacher_forcing(question: tf.Tensor, answer: tf.Tensor, question_length: tf.Tensor,
+                                answer_length: tf.Tensor) -> ModelBatch:
+        """Model inputs & targets of a single sample with its padding trimmed off, for bucketing.
+        dec_inputs & outputs are both answer_length long, at most max_length - 1 as the last position has no target."""
+        answer_length = tf.minimum(tf.cast(answer_length, tf.int32), tf.shape(answer)[0] - 1)
+        return ({'inputs': question[:question_length], 'dec_inputs': answer[:answer_length]},
+                {'outputs': answer[1:answer_length + 1]})
+
     @classmethod
-    def create_data_objects(cls, questions: list, answers: list, buffer_size: int, batch_size: int, vocab_size: int):
+    def create_data_objects(cls, questions: list, answers: list, buffer_size: int, batch_size: int, vocab_size: int,
+                            bucket_boundaries: typing.List[int] = None, tokens_per_batch: int = None, pack: bool = False):
+        """Create the training & validation datasets.
+        Args:
+            :param questions: np.ndarray
+                Padded tokenized questions (number_of_samples, max_length)
+            :param answers: np.ndarray
+                Padded tokenized answers (number_of_samples, max_length)
+            :param buffer_size: int
+                Shuffle buffer size
+            :param batch_size: int
+                Samples per batch, when bucketing it only sets the default tokens_per_batch
+            :param vocab_size: int
+                Vocab size of the tokenizer
+            :param bucket_boundaries: List[int]
+                Sample lengths at which a new bucket starts, giving either this or tokens_per_batch enables
+                length bucketing. Defaults to a bucket every 8 tokens.
+            :param tokens_per_batch: int
+                Token budget of a bucketed batch, defaults to batch_size * max_length.
+                Models with fixed_length_inputs (Performer, FNet) need every batch padded to max_length, don't bucket for those.
+            :param pack: bool
+                Pack several samples into every row with pack_samples, batches are batch_size packed rows.
+                Only for models created with packed_inputs.
+        :return: Tuple[tf.data.Dataset, tf.data.Dataset]
+        """
         self = cls(questions, answers, buffer_size, batch_size, vocab_size)
+        max_length = self.questions_train.shape[1]
+        bucketing = bucket_boundaries is not None or tokens_per_batch is not None
+        if pack and bucketing:
+            raise ValueError("Packed rows are always max_length long, they can't be bucketed.")
+
+        # The answers are only shifted for teacher forcing once batched, see teacher_forcing.
+        if pack:
+            # Training & validation samples are packed separately, so the split is the same as without packing.
+            split = int(len(self.questions_train) * .8)
+            dataset_t, dataset_v = [tf.data.Dataset.from_tensor_slices(self.pack_samples(self.questions_train[part],
+                                                                                         self.answers_train[part]))
+                                    for part in [slice(None, split), slice(split, None)]]
+            return self.finalise_datasets(dataset_t, dataset_v, batch=True, teacher_forcing_fn=self.packed_teacher_forcing)
 
-        dec_inputs_train = self.answers_train.copy()
-        dec_inputs_train[:, -1] = 0
-        outputs_train = self.answers_train.copy()
-        outputs_train[:, 0] = 0
-        outputs_train = np.roll(outputs_train.copy(), -1)  # Roll back values -1 to not leave an empty value.
-        del self.answers_train
-        # decoder inputs use the previous target as input
-        # remove s_token from targets
-        # print("Beginning Dataset Shuffling, Batching and Prefetch.")
-        dataset_all = tf.data.Dataset.from_tensor_slices((
-            {
-                'inputs': self.questions_train,  # Source
-                'dec_inputs': dec_inputs_train  # Targets
-            },
-            {
-                'outputs': outputs_train  # Outputs
-            }))
+        if bucketing:
+            dataset_all = tf.data.Dataset.from_tensor_slices((self.questions_train, self.answers_train,
+                                                              self.sequence_lengths(self.questions_train),
+                                                              self.sequence_lengths(self.answers_train)))
+            # Trim the padding off every sample, dec_inputs & outputs are trimmed to the same length.
+            dataset_all = dataset_all.map(self.trimmed_teacher_forcing, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                                          deterministic=True)
+        else:
+            dataset_all = tf.data.Dataset.from_tensor_slices((self.questions_train, self.answers_train))
         dataset_t = dataset_all.take(int(len(self.questions_train) * .8))
         dataset_v = dataset_all.skip(int(len(self.questions_train) * .8))
-        del dataset_all
+        del dataset_all, self.answers_train
+
+        if not bucketing:
+            return self.finalise_datasets(dataset_t, dataset_v, batch=True, teacher_forcing_fn=self.batch_teacher_forcing)
+        bucket_boundaries = bucket_boundaries or list(range(8, max_length, 8))
+        tokens_per_batch = tokens_per_batch or self.batch_size * max_length
+        dataset_t = self.bucketed_dataset(dataset_t.shuffle(self.buffer_size), bucket_boundaries, max_length, tokens_per_batch)
+        dataset_v = self.bucketed_dataset(dataset_v.shuffle(self.buffer_size), bucket_boundaries, max_length, tokens_per_batch)
+        return self.finalise_datasets(dataset_t, dataset_v, batch=False)
 
-        dataset_t = dataset_t.shuffle(self.buffer_size)
-        dataset_v = dataset_v.shuffle(self.buffer_size)
-        dataset_t = dataset_t.batch(self.batch_size)
-        dataset_v = dataset_v.batch(self.batch_size)
+    def finalise_datasets(self, dataset_t: tf.data.Dataset, dataset_v: tf.data.Dataset, batch: bool,
+                          teacher_forcing_fn: typing.Callable = None) -> typing.Tuple[tf.data.Dataset, tf.data.Dataset]:
+        """Shuffle & batch (unless already batched), then cache & prefetch the training and validation datasets.
+        teacher_forcing_fn maps the cached batches to model inputs & targets, so the cache doesn't hold the shifted copies."""
+        if batch:
+            dataset_t = dataset_t.shuffle(self.buffer_size).batch(self.batch_size)
+            dataset_v = dataset_v.shuffle(self.buffer_size).batch(self.batch_size)
 
         dataset_v = dataset_v.cache()
         dataset_t = dataset_t.cache()
+        if teacher_forcing_fn is not None:
+            dataset_v = dataset_v.map(teacher_forcing_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            dataset_t = dataset_t.map(teacher_forcing_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dataset_v = dataset_v.prefetch(tf.data.experimental.AUTOTUNE)
         dataset_t = dataset_t.prefetch(tf.data.experimental.AUTOTUNE)
         options = tf.data.Options()
@@ -73,7 +249,7 @@ class DatasetAPICreator:
 
 
 class DatasetDirectFromFileAPICreator:
-    def __init__(self, questions_file: typing.Union[LTD.BINFile, str], answers_file: typing.Union[LTD.BINFile, str],
+    def __init__(self, questions_file: typing.Union[IndexedTokenFile, LTD.BINFile, str], answers_file: typing.Union[IndexedTokenFile, LTD.BINFile, str],
                  buffer_size: int, batch_size: int, vocab_size: int, max_length: int, number_of_samples: int, start_token: int = None,
                  end_token: int = None, padding_value: int = None):
         if (isinstance(questions_file, str) and
@@ -82,13 +258,10 @@ class DatasetDirectFromFileAPICreator:
                  end_token is None or
                  padding_value is None):
             raise ValueError("If you are using strings for the files, you must provide max_length, start_token, end_token and padding_value.")
-        if isinstance(questions_file, str):
-            self.questions_bin_file = LTD.BINFile(questions_file, start_token, end_token, max_length, padding_value)
-        if isinstance(answers_file, str):
-            self.answers_bin_file = LTD.BINFile(answers_file, start_token, end_token, max_length, padding_value)
-        else:
-            self.questions_bin_file = questions_file
-            self.answers_bin_file = answers_file
+        self.questions_bin_file = open_token_file(questions_file, start_token, end_token, max_length, padding_value) \
+            if isinstance(questions_file, str) else questions_file
+        self.answers_bin_file = open_token_file(answers_file, start_token, end_token, max_length, padding_value) \
+            if isinstance(answers_file, str) else answers_file
 
         self.legacy = True if hasattr(self.questions_bin_file, 'MaxNumberOfSamples') else False
         questions_max = self.questions_bin_file.MaxNumberOfSamples if self.legacy else self.questions_bin_file.max_number_of_samples
@@ -104,50 +277,98 @@ class DatasetDirectFromFileAPICreator:
                              f" in the file.")
         self.number_of_samples = number_of_samples
 
-    def numpy_generator(self):
-        current_index = 0
-        while current_index + 1 < self.number_of_samples:
-            questions = self.questions_bin_file[current_index]
-            answers = self.answers_bin_file[current_index]
+    def read_samples(self, indices: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Read a batch of samples.
+        IndexedTokenFiles are read with a single vectorised gather, BINFiles one sample at a time.
+        :return: Tuple[np.ndarray, np.ndarray]
+            questions & answers (len(indices), max_length) int32
+        """
+        if self.legacy:
+            questions = np.stack([self.questions_bin_file[int(index)] for index in indices]).astype(np.int32)
+            answers = np.stack([self.answers_bin_file[int(index)] for index in indices]).astype(np.int32)
+        else:
+            questions = self.questions_bin_file.batch(indices, max_length=self.max_length)
+            answers = self.answers_bin_file.batch(indices, max_length=self.max_length)
+        return questions, answers
+
+    def read_batches(self, indices: tf.data.Dataset, batch_size: int) -> tf.data.Dataset:
+        """Batch a dataset of sample indices and read every batch in parallel with read_samples."""
+        def read(batch_indices):
+            questions, answers = tf.numpy_function(self.read_samples, [batch_indices], [tf.int32, tf.int32], stateful=False)
+            questions.set_shape((None, self.max_length))
+            answers.set_shape((None, self.max_length))
+            return DatasetAPICreator.batch_teacher_forcing(questions, answers)
 
-            dec_inputs = answers.copy()
-            outputs = answers.copy()
-            del answers
+        return indices.batch(batch_size).map(read, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-            dec_inputs[-1] = 0
+    @staticmethod
+    def shard_indices(shard_start: tf.Tensor, shard_end: tf.Tensor) -> tf.data.Dataset:
+        return tf.data.Dataset.range(shard_start, shard_end)
 
-            outputs[0] = 0
-            outputs = np.roll(outputs.copy(), -1)  # Roll back values -1 to not leave an empty value.
+    def sample_dataset(self, start: int, end: int, num_shards: int, num_workers: int, worker_index: int,
+                       shuffle: bool, cache_path: typing.Optional[str]) -> tf.data.Dataset:
+        """Batches of the samples [start, end), see create_data_objects."""
+        shard_bounds = np.linspace(start, end, num_shards + 1).astype(np.int64)
+        # Workers take whole shards, so they never read the same samples.
+        shards = tf.data.Dataset.from_tensor_slices((shard_bounds[:-1], shard_bounds[1:])).shard(num_workers, worker_index)
 
-            return_data = ({'inputs': questions, 'dec_inputs': dec_inputs}, {'outputs': outputs})
-            current_index += 1
-            yield return_data
+        if cache_path is not None:
+            # Every sample is read once, in order, then later epochs read the cache file instead of the token files.
+            samples = self.read_batches(shards.flat_map(self.shard_indices), batch_size=max(self.batch_size, 1024))
+            samples = samples.unbatch().cache(cache_path)
+            if shuffle:
+                samples = samples.shuffle(self.buffer_size, reshuffle_each_iteration=True)
+            return samples.batch(self.batch_size)
+
+        if not shuffle:
+            # One shard after the other, the samples are read in order.
+            return self.read_batches(shards.flat_map(self.shard_indices), self.batch_size)
+        shards = shards.shuffle(num_shards, reshuffle_each_iteration=True)
+        # Only indices go through the shuffle buffer, the samples are read after batching.
+        indices = shards.interleave(self.shard_indices, cycle_length=num_shards, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                                    deterministic=False)
+        indices = indices.shuffle(self.buffer_size, reshuffle_each_iteration=True)
+        return self.read_batches(indices, self.batch_size)
 
     @classmethod
-    def create_data_objects(cls, questions_file: typing.Union[LTD.BINFile, str], answers_file: typing.Union[LTD.BINFile, str],
+    def create_data_objects(cls, questions_file: typing.Union[IndexedTokenFile, LTD.BINFile, str], answers_file: typing.Union[IndexedTokenFile, LTD.BINFile, str],
                             buffer_size: int, batch_size: int, vocab_size: int, max_length: int, number_of_samples: int, start_token: int = None,
-                            end_token: int = None, padding_value: int = None):
+                            end_token: int = None, padding_value: int = None, num_shards: int = 16, cache_path: str = None,
+                            num_workers: int = 1, worker_index: int = 0):
+        """Create the training & validation datasets, streamed from the token files.
+        Samples are split into num_shards contiguous shards which are interleaved, shuffled one sample at a time and
+        batched, every batch is then read from the files in parallel. Nothing is held in memory past the shuffle buffer.
+        The validation samples aren't shuffled, they're read in order.
+        Args:
+            :param num_shards: int
+                Number of shards the samples of each dataset are split into
+            :param cache_path: str
+                File path prefix to cache the samples read on the first epoch in, for slow to decode (BINFile) inputs.
+                The training & validation datasets are cached to cache_path + "-train" & "-val"
+            :param num_workers: int
+                Number of workers reading the files, every worker takes its own shards
+            :param worker_index: int
+                Index of this worker
+        :return: Tuple[tf.data.Dataset, tf.data.Dataset]
+        """
         self = cls(questions_file, answers_file, buffer_size, batch_size, vocab_size, max_length, number_of_samples, start_token, end_token, padding_value)
+        if not 0 <= worker_index < num_workers:
+            raise ValueError(f"worker_index {worker_index} must be in [0, {num_workers}).")
+        if num_shards < num_workers:
+            raise ValueError(f"num_shards {num_shards} must be at least num_workers {num_workers}, so every worker has a shard.")
 
-        dataset_all = tf.data.Dataset.from_generator(self.numpy_generator, output_types=({'inputs': tf.int32, 'dec_inputs': tf.int32}, {'outputs': tf.int32}),
-                                                     output_shapes=({'inputs': (self.max_length,),
-                                                                     'dec_inputs': (self.max_length,)},
-                                                                    {'outputs': (self.max_length,)}))
-        dataset_t = dataset_all.take(int(self.number_of_samples * .8))
-        dataset_v = dataset_all.skip(int(self.number_of_samples * .8))
-        del dataset_all
-
-        dataset_t = dataset_t.batch(self.batch_size)
-        dataset_v = dataset_v.batch(self.batch_size)
-        dataset_t = dataset_t.shuffle(self.buffer_size)
-        dataset_v = dataset_v.shuffle(self.buffer_size)
+        split = int(self.number_of_samples * .8)
+        dataset_t = self.sample_dataset(0, split, num_shards, num_workers, worker_index, shuffle=True,
+                                        cache_path=cache_path + "-train" if cache_path is not None else None)
+        dataset_v = self.sample_dataset(split, self.number_of_samples, num_shards, num_workers, worker_index, shuffle=False,
+                                        cache_path=cache_path + "-val" if cache_path is not None else None)
 
-        dataset_v = dataset_v.cache()
-        dataset_t = dataset_t.cache()
         dataset_v = dataset_v.prefetch(tf.data.experimental.AUTOTUNE)
         dataset_t = dataset_t.prefetch(tf.data.experimental.AUTOTUNE)
         options = tf.data.Options()
-        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        # Samples are already split between workers by worker_index.
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA \
+            if num_workers == 1 else tf.data.experimental.AutoShardPolicy.OFF
         dataset_t = dataset_t.with_options(options)
         dataset_v = dataset_v.with_options(options)
 
@@ -0,0 +1,191 @@
+import abc
+import typing
+
+from .utils import tf
+
+
+class Decoder(abc.ABC):
+    """Decoding strategy used by TransformerAbstract.evaluate.
+    Decoders only talk to the model through decode_state/decode_logits, and run as a tf.while_loop over a fixed size
+    output buffer, so they can be compiled into a single graph (with or without XLA)."""
+
+    @staticmethod
+    def buffer_length(model) -> int:
+        """Length of the output buffer, the start token plus every token the model can decode."""
+        return model.max_len if model.fixed_length_decoding else model.max_len + 1
+
+    @staticmethod
+    def initial_output(model, batch_size: tf.Tensor, buffer_length: int) -> tf.Tensor:
+        """Output buffer holding only the start token, padded with 0s."""
+        return tf.pad(tf.fill((batch_size, 1), model.start_token[0]), [[0, 0], [0, buffer_length - 1]])
+
+    @abc.abstractmethod
+    def decode(self, model, sentences: tf.Tensor, use_cache: bool = True) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+        """Decode replies to a batch of tokenized sentences.
+        Args:
+            :param model: TransformerAbstract
+                The model to decode with
+            :param sentences: tf.Tensor
+                Tokenized sentences (batch_size, sequence_length)
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+        :return: Tuple[tf.Tensor, tf.Tensor]
+            The output buffer (batch_size, buffer_length) starting with the start token, rows which
+            finished early are padded with 0s, and the number of decoded positions in the buffer.
+        """
+        raise NotImplementedError("Method not implemented.")
+
+
+class GreedyDecoder(Decoder):
+    """Picks the most likely token at every step."""
+
+    def next_token(self, logits: tf.Tensor) -> tf.Tensor:
+        """Choose the next token of every row from its logits (batch_size, vocab_size)."""
+        return tf.cast(tf.argmax(logits, axis=-1), tf.int32)
+
+    def decode(self, model, sentences: tf.Tensor, use_cache: bool = True) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+        batch_size = tf.shape(sentences)[0]
+        buffer_length = self.buffer_length(model)
+        state = model.decode_state(sentences, buffer_length, use_cache=use_cache)
+        output = self.initial_output(model, batch_size, buffer_length)
+        finished = tf.zeros((batch_size,), dtype=tf.bool)
+
+        def cond(step, output, finished, state):
+            return tf.logical_and(step < buffer_length - 1, tf.logical_not(tf.reduce_all(finished)))
+
+        def body(step, output, finished, state):
+            logits, state = model.decode_logits(sentences, output, step, state)
+            predicted_id = self.next_token(logits)
+
+            finished = tf.logical_or(finished, tf.equal(predicted_id, model.end_token[0]))
+            # write the predicted_id after step, finished rows are padded
+            predicted_id = tf.where(finished, 0, predicted_id)
+            output += predicted_id[:, tf.newaxis] * tf.one_hot(step + 1, buffer_length, dtype=tf.int32)[tf.newaxis, :]
+            return step + 1, output, finished, state
+
+        step, output, finished, _ = tf.while_loop(cond, body, (tf.constant(0), output, finished, state))
+        # Once every row has finished the last step only wrote padding.
+        return output, tf.where(tf.reduce_all(finished), step, step + 1)
+
+
+class SamplingDecoder(GreedyDecoder):
+    def __init__(self, top_k: int = 0, top_p: float = 1.0, temperature: float = 1.0, seed: int = None):
+        """Samples the next token, optionally restricted to the top k tokens and/or the nucleus (top p).
+        Args:
+            :param top_k: int
+                Only sample from the k most likely tokens, 0 disables the restriction
+            :param top_p: float
+                Only sample from the smallest set of tokens whose probability adds up to top_p, 1.0 disables it
+            :param temperature: float
+                Logits are divided by the temperature, lower is closer to greedy
+            :param seed: int
+                Op level seed for tf.random.categorical
+        """
+        if top_k < 0:
+            raise ValueError(f"top_k {top_k} must be 0 (disabled) or positive")
+        if not 0.0 < top_p <= 1.0:
+            raise ValueError(f"top_p {top_p} must be in (0, 1]")
+        if temperature <= 0.0:
+            raise ValueError(f"temperature {temperature} must be positive")
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.seed = seed
+
+    def filter_logits(self, logits: tf.Tensor) -> tf.Tensor:
+        """Set the logits of tokens outside the top k / nucleus to -inf."""
+        logits = tf.cast(logits, tf.float32) / self.temperature
+        if self.top_k:
+            # the k-th largest logit of every row is the cut off
+            threshold = tf.math.top_k(logits, k=self.top_k).values[:, -1:]
+            logits = tf.where(logits < threshold, float('-inf'), logits)
+        if self.top_p < 1.0:
+            sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+            # probability mass of the tokens ranked above each token, the most likely token is always kept
+            cumulative_probs = tf.math.cumsum(tf.nn.softmax(sorted_logits, axis=-1), axis=-1, exclusive=True)
+            threshold = tf.reduce_min(tf.where(cumulative_probs < self.top_p, sorted_logits, float('inf')),
+                                      axis=-1, keepdims=True)
+            logits = tf.where(logits < threshold, float('-inf'), logits)
+        return logits
+
+    def next_token(self, logits: tf.Tensor) -> tf.Tensor:
+        return tf.cast(tf.random.categorical(self.filter_logits(logits), 1, seed=self.seed)[:, 0], tf.int32)
+
+
+class BeamSearchDecoder(Decoder):
+    def __init__(self, beam_width: int = 4, length_penalty: float = 0.6):
+        """Beam search, every beam of every sentence is a row of one (batch_size * beam_width) batch,
+        so each step is a single call to decode_logits.
+        Args:
+            :param beam_width: int
+                Number of beams kept per sentence
+            :param length_penalty: float
+                The alpha of the GNMT length penalty ((5 + length) / 6) ** alpha, finished replies are scored
+                by their log probability divided by it. 0.0 ranks by the raw log probability.
+        """
+        if beam_width < 1:
+            raise ValueError(f"beam_width {beam_width} must be at least 1")
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+
+    def length_normaliser(self, length: tf.Tensor) -> tf.Tensor:
+        return tf.pow((5.0 + tf.cast(length, tf.float32)) / 6.0, self.length_penalty)
+
+    def decode(self, model, sentences: tf.Tensor, use_cache: bool = True) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+        """decode_state must return batch major tensors, they are reordered with tf.gather as beams are picked."""
+        batch_size = tf.shape(sentences)[0]
+        beam_width = self.beam_width
+        buffer_length = self.buffer_length(model)
+        end_token = model.end_token[0]
+
+        # (batch_size * beam_width, ...), the beams of a sentence are next to each other
+        sentences = tf.repeat(sentences, beam_width, axis=0)
+        state = model.decode_state(sentences, buffer_length, use_cache=use_cache)
+        alive_seq = self.initial_output(model, batch_size * beam_width, buffer_length)
+        # Only the first beam starts alive, otherwise the first step would pick beam_width copies of the same token.
+        alive_log_probs = tf.tile(tf.constant([[0.0] + [float('-inf')] * (beam_width - 1)]), [batch_size, 1])
+        finished_seq = tf.zeros((batch_size, beam_width, buffer_length), dtype=tf.int32)
+        finished_scores = tf.fill((batch_size, beam_width), float('-inf'))
+        # offset of each sentence's first beam in the flattened batch
+        beam_offsets = tf.range(batch_size)[:, tf.newaxis] * beam_width
+
+        def cond(step, alive_seq, alive_log_probs, finished_seq, finished_scores, state):
+            # Log probabilities only decrease, so the best alive beam at the longest length bounds its final score.
+            best_alive = alive_log_probs[:, 0] / self.length_normaliser(buffer_length - 1)
+            done = tf.reduce_all(tf.reduce_max(finished_scores, axis=1) > best_alive)
+            return tf.logical_and(step < buffer_length - 1, tf.logical_not(done))
+
+        def body(step, alive_seq, alive_log_probs, finished_seq, finished_scores, state):
+            logits, state = model.decode_logits(sentences, alive_seq, step, state)
+            vocab_size = tf.shape(logits)[-1]
+            log_probs = tf.nn.log_softmax(tf.cast(logits, tf.float32), axis=-1)
+            log_probs = alive_log_probs[:, :, tf.newaxis] + tf.reshape(log_probs, (batch_size, beam_width, -1))
+
+            # 2 * beam_width candidates, at most beam_width of them are end tokens so beam_width stay alive
+            topk_log_probs, topk_ids = tf.math.top_k(tf.reshape(log_probs, (batch_size, -1)), k=2 * beam_width)
+            topk_rows = beam_offsets + topk_ids // vocab_size
+            topk_tokens = topk_ids % vocab_size
+            is_end = tf.equal(topk_tokens, end_token)
+
+            # Finished replies keep the buffer without the end token, like greedy decoding.
+            finished_candidates = tf.where(is_end, topk_log_probs / self.length_normaliser(step + 1), float('-inf'))
+            finished_scores, finished_ids = tf.math.top_k(tf.concat([finished_scores, finished_candidates], axis=1),
+                                                          k=beam_width)
+            finished_seq = tf.gather(tf.concat([finished_seq, tf.gather(alive_seq, topk_rows)], axis=1),
+                                     finished_ids, batch_dims=1)
+
+            alive_log_probs, alive_ids = tf.math.top_k(tf.where(is_end, float('-inf'), topk_log_probs), k=beam_width)
+            rows = tf.reshape(tf.gather(topk_rows, alive_ids, batch_dims=1), (-1,))
+            tokens = tf.reshape(tf.gather(topk_tokens, alive_ids, batch_dims=1), (-1, 1))
+            alive_seq = tf.gather(alive_seq, rows) + tokens * tf.one_hot(step + 1, buffer_length, dtype=tf.int32)[tf.newaxis, :]
+            state = tf.nest.map_structure(lambda tensor: tf.gather(tensor, rows), state)
+            return step + 1, alive_seq, alive_log_probs, finished_seq, finished_scores, state
+
+        step, alive_seq, alive_log_probs, finished_seq, finished_scores, _ = tf.while_loop(
+            cond, body, (tf.constant(0), alive_seq, alive_log_probs, finished_seq, finished_scores, state))
+
+        # Beams still alive when the buffer ran out compete with the finished ones.
+        scores = tf.concat([finished_scores, alive_log_probs / self.length_normaliser(step)], axis=1)
+        sequences = tf.concat([finished_seq, tf.reshape(alive_seq, (batch_size, beam_width, buffer_length))], axis=1)
+        output = tf.gather(sequences, tf.argmax(scores, axis=1, output_type=tf.int32), batch_dims=1)
+        return output, step + 1
@@ -1,6 +1,11 @@
+import functools
 import typing
-from typing import List
+import warnings
+
+import numpy as np
 from tensorflow.python.keras.utils import tf_utils
+from tensorflow.python.saved_model import save_context
+from tensorflow.python.trackable import base as trackable_base
 
 from .utils import tf
 from typing import Dict
@@ -15,37 +20,43 @@ def iid_gaussian(m, d):
     return tf.random.normal(shape=(m, d))
 
 
-def orthogonal_gaussian(m: int, d: int):
-    """Generate Orthogonal Gaussian distribution's. This is to improve upon MSE (mean squared error)
-    inside a performer.
+def orthogonal_gaussians(count: int, m: int, d: int) -> tf.Tensor:
+    """count independent orthogonal_gaussian matrices (count, m, d), the QR decompositions of all their
+    d × d blocks are computed by a single batched tf.linalg.qr.
     Args:
+        :param count: int
+            Number of matrices, e.g. one per attention layer
         :param m: int
             Hidden Dimensions
         :param d: int
             Depth (half the hidden dimensions)"""
-
-    def orthogonal_square():
-        q, _ = tf.linalg.qr(iid_gaussian(d, d))
-        return tf.transpose(q)
-
     num_squares = int(m / d)
-    blocks = [orthogonal_square() for _ in range(num_squares)]
-
     remainder = m - d * num_squares
-    if remainder:
-        blocks.append(orthogonal_square()[:remainder])
+    num_blocks = num_squares + (1 if remainder else 0)
 
-    # matrix = tf.concat(blocks, axis=0)
-    matrix = tf.experimental.numpy.vstack(blocks)
-    matrix /= tf.sqrt(num_squares + remainder / d)
+    q, _ = tf.linalg.qr(tf.random.normal(shape=(count * num_blocks, d, d)))
+    # the rows of each block are orthogonal, stack the blocks of each matrix & keep its first m rows
+    blocks = tf.reshape(tf.transpose(q, perm=[0, 2, 1]), (count, num_blocks * d, d))
+    return blocks[:, :m] / tf.sqrt(num_squares + remainder / d)
 
-    return matrix
+
+def orthogonal_gaussian(m: int, d: int):
+    """Generate Orthogonal Gaussian distribution's. This is to improve upon MSE (mean squared error)
+    inside a performer.
+    Args:
+        :param m: int
+            Hidden Dimensions
+        :param d: int
+            Depth (half the hidden dimensions)"""
+    return orthogonal_gaussians(1, m, d)[0]
 
 
 def softmax_kernel_transformation(data: tf.Tensor,
                                   is_query: bool,
                                   projection_matrix: tf.Tensor = None,
-                                  numerical_stabilizer=0.000001):
+                                  numerical_stabilizer=0.000001,
+                                  causal: bool = False,
+                                  sequence_axis: int = 1):
     """Computes random features for the softmax kernel using FAVOR+ mechanism.
 
   Computes random features for the softmax kernel using FAVOR+ mechanism from
@@ -62,6 +73,10 @@ def softmax_kernel_transformation(data: tf.Tensor,
         number of random features and each D x D sub-block has pairwise orthogonal rows
     :param numerical_stabilizer: float
         small positive constant for numerical stability.
+    :param causal: bool
+        Key features only depend on their own position, so they can be computed one token at a time.
+    :param sequence_axis: int
+        The attention dimension of data, 1 for [B, L, H, D] or 2 for [B, H, L, D], the layout kernel_features uses.
 
   Returns:
     Corresponding kernel feature map.
@@ -73,18 +88,22 @@ def softmax_kernel_transformation(data: tf.Tensor,
     ratio = 1.0 / tf.math.sqrt(
         tf.dtypes.cast(tf.shape(projection_matrix)[0], data.dtype))
     # noinspection SpellCheckingInspection
-    data_dash = tf.einsum("blhd,md->blhm", data, projection_matrix, name="SoftmaxKernel")
+    data_dash = tf.einsum("...d,md->...m", data, projection_matrix, name="SoftmaxKernel")
     diag_data = tf.math.square(data)
     diag_data = tf.math.reduce_sum(
         diag_data, axis=tf.keras.backend.ndim(data) - 1)
     diag_data = diag_data / 2.0
     diag_data = tf.expand_dims(diag_data, axis=tf.keras.backend.ndim(data) - 1)
     last_dims_t = (tf.rank(data_dash) - 1,)
-    attention_dims_t = (tf.rank(data_dash) - 3,)
+    attention_dims_t = (sequence_axis,)
     if is_query:
         data_dash = ratio * (
                 tf.math.exp(data_dash - diag_data - tf.math.reduce_max(
                     data_dash, axis=last_dims_t, keepdims=True)) + numerical_stabilizer)
+    elif causal:
+        # The maximum over the sequence would leak future keys into earlier positions,
+        # the projection rows have at most unit norm so data_dash - diag_data <= 0.5 anyway.
+        data_dash = ratio * (tf.math.exp(data_dash - diag_data) + numerical_stabilizer)
     else:
         data_dash = ratio * (
                 tf.math.exp(data_dash - diag_data - tf.math.reduce_max(
@@ -113,12 +132,13 @@ def relu_kernel_transformation(data: tf.Tensor,
     m = tf.shape(data)[-1]
     m = tf.cast(m, data.dtype)
     data_normalizer = 1.0 / tf.math.sqrt(m)
-    projection_matmul = tf.einsum("blhd,md->blhm", data, projection_matrix)
+    projection_matmul = tf.einsum("...d,md->...m", data, projection_matrix)
     return tf.nn.relu(data_normalizer * projection_matmul + numerical_stabilizer)
 
 
 def attn_hat(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, phi_fun=None, random_feats: tf.Tensor = None):
-    """
+    """FAVOR+ attention, everything stays in the B, H, L, D layout of the heads, the keys & values are summarised
+    by favor_state (the normaliser is a reduction over the sequence) & attended to by favor_state_attention.
     Args:
         :param query: tf.Tensor
             The Query tensor from the Multi-headed attention mechanism
@@ -130,38 +150,168 @@ def attn_hat(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, phi_fun=None, r
             A function for "phi" If None, default to Softmax kernel transformations
         :param random_feats: tf.Tensor
             The random features for use in phi function in predicting the softmax values
+    :return: tf.Tensor
+        B, L, H, D, ready to be merged back into d_model
     """
-    sequence_length = tf.shape(query)[2]
-    # B, H, L, D to B, L, H, D
-    query = tf.transpose(query, [0, 2, 1, 3])
-    key = tf.transpose(key, [0, 2, 1, 3])
-    if phi_fun is not None:
-        q_prime = phi_fun(query, random_feats)
-        k_prime = phi_fun(key, random_feats)
-    else:
-        q_prime = softmax_kernel_transformation(query, projection_matrix=random_feats, is_query=True)  # B L H M
-        k_prime = softmax_kernel_transformation(key, projection_matrix=random_feats, is_query=False)  # B L H M
+    kv, normalizer = favor_state(key, value, phi_fun=phi_fun, random_feats=random_feats)
+    return favor_state_attention(query, kv, normalizer, phi_fun=phi_fun, random_feats=random_feats)
 
-    # B H L D, L B H D
-    value = tf.transpose(value, [2, 0, 1, 3])
 
-    # B L H M, L B H M
-    k_prime = tf.transpose(k_prime, [1, 0, 2, 3])  # L B H M
-    q_prime = tf.transpose(q_prime, [1, 0, 2, 3])  # L B H M
+# attn_hat compiled with XLA, which fuses the feature maps, contractions & division into a few kernels.
+attn_hat_xla = tf.function(attn_hat, jit_compile=True)
 
-    # noinspection SpellCheckingInspection
-    av_attention = tf.einsum("lbhm,lbhd->bhmd", k_prime, value, name="AVAttention_PA")
 
+def kernel_features(data: tf.Tensor, is_query: bool, phi_fun=None, random_feats: tf.Tensor = None,
+                    causal: bool = False) -> tf.Tensor:
+    """FAVOR+ features of a query or key tensor (B, H, L, D), returned as B, H, L, M without transposing.
+    Args:
+        :param data: tf.Tensor
+            The Query or Key tensor from the Multi-headed attention mechanism
+        :param is_query: bool
+            Indicates whether data is a query or key tensor
+        :param phi_fun: Any function
+            A function for "phi" If None, default to Softmax kernel transformations
+        :param random_feats: tf.Tensor
+            The random features for use in phi function in predicting the softmax values
+        :param causal: bool
+            Key features are computed per position, see softmax_kernel_transformation
+    """
+    if phi_fun is not None:
+        return phi_fun(data, random_feats)
+    return softmax_kernel_transformation(data, projection_matrix=random_feats, is_query=is_query, causal=causal,
+                                         sequence_axis=2)
+
+
+def causal_attn_hat(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, phi_fun=None, random_feats: tf.Tensor = None,
+                    chunk_size: int = 64):
+    """Causal (unidirectional) FAVOR+, each position only attends to itself and earlier positions.
+    The sequence is split into chunks of chunk_size positions, a chunk attends to the earlier ones through the running
+    sum of their k'ᵀv (B, H, M, D), see favor_state, and to itself through its masked chunk_size × chunk_size scores.
+    The gradient recomputes the running sums instead of keeping one per chunk (like blockwise_attention),
+    so memory grows linearly with the sequence length.
+    Args:
+        :param query: tf.Tensor
+            The Query tensor from the Multi-headed attention mechanism
+        :param key: tf.Tensor
+            The Key tensor from the Multi-headed attention mechanism
+        :param value: tf.Tensor
+            The Value tensor from the Multi-headed attention mechanism
+        :param phi_fun: Any function
+            A function for "phi" If None, default to Softmax kernel transformations
+        :param random_feats: tf.Tensor
+            The random features for use in phi function in predicting the softmax values
+        :param chunk_size: int
+            Number of positions per chunk
+    :return: tf.Tensor
+        B, L, H, D like attn_hat
+    """
+    q_prime = kernel_features(query, is_query=True, phi_fun=phi_fun, random_feats=random_feats)  # B H L M
+    k_prime = kernel_features(key, is_query=False, phi_fun=phi_fun, random_feats=random_feats, causal=True)  # B H L M
+    dtype = q_prime.dtype
+    q_prime, k_prime, value = tf.cast(q_prime, tf.float32), tf.cast(k_prime, tf.float32), tf.cast(value, tf.float32)
+    # The normaliser is the attention over a column of ones, computed along with the values.
+    value = tf.concat([value, tf.ones_like(value[..., :1])], axis=-1)
+    batch_size, num_heads, length = tf.unstack(tf.shape(value)[:3])
+    num_chunks = (length + chunk_size - 1) // chunk_size
+    padding = num_chunks * chunk_size - length
+
+    # Pad to whole chunks, padded keys & values are 0 so they add nothing, & split them so every chunk has a static size.
+    def chunks(tensor):  # B, H, N, chunk_size, M or D + 1
+        tensor = tf.pad(tensor, [[0, 0], [0, 0], [0, padding], [0, 0]])
+        return tf.reshape(tensor, tf.concat([[batch_size, num_heads, num_chunks, chunk_size], tf.shape(tensor)[-1:]], axis=0))
+
+    causal = tf.linalg.band_part(tf.ones((chunk_size, chunk_size)), -1, 0)
+
+    @tf.custom_gradient
+    def prefix_attention(q, k, v):
+        state_shape = tf.concat([tf.shape(k)[:2], tf.shape(k)[-1:], tf.shape(v)[-1:]], axis=0)  # B, H, M, D + 1
+
+        def body(j, state, outputs):
+            q_j, k_j, v_j = tf.gather(q, j, axis=2), tf.gather(k, j, axis=2), tf.gather(v, j, axis=2)
+            scores = tf.matmul(q_j, k_j, transpose_b=True) * causal
+            outputs = outputs.write(j, tf.matmul(q_j, state) + tf.matmul(scores, v_j))
+            return j + 1, state + tf.matmul(k_j, v_j, transpose_a=True), outputs
+
+        _, _, outputs = tf.while_loop(
+            lambda j, *_: j < num_chunks, body,
+            (tf.constant(0), tf.zeros(state_shape), tf.TensorArray(tf.float32, size=num_chunks)),
+            maximum_iterations=num_chunks)
+        # TensorArray.stack gives chunks first, N, B, H, chunk_size, D + 1
+        outputs = tf.transpose(outputs.stack(), perm=[1, 2, 0, 3, 4])
+
+        def grad(d_outputs):
+            # The query of a chunk sees the running sum of the earlier chunks' k'ᵀv,
+            # the keys & values of a chunk are seen by the running sum of the later chunks' q'ᵀdO.
+            def query_body(j, state, d_query):
+                k_j, v_j, d_j = tf.gather(k, j, axis=2), tf.gather(v, j, axis=2), tf.gather(d_outputs, j, axis=2)
+                d_scores = tf.matmul(d_j, v_j, transpose_b=True) * causal
+                d_query = d_query.write(j, tf.matmul(d_j, state, transpose_b=True) + tf.matmul(d_scores, k_j))
+                return j + 1, state + tf.matmul(k_j, v_j, transpose_a=True), d_query
+
+            def key_value_body(i, d_state, d_keys, d_values):
+                j = num_chunks - 1 - i
+                q_j, k_j, v_j = tf.gather(q, j, axis=2), tf.gather(k, j, axis=2), tf.gather(v, j, axis=2)
+                d_j = tf.gather(d_outputs, j, axis=2)
+                scores = tf.matmul(q_j, k_j, transpose_b=True) * causal
+                d_scores = tf.matmul(d_j, v_j, transpose_b=True) * causal
+                d_keys = d_keys.write(j, tf.matmul(v_j, d_state, transpose_b=True) +
+                                      tf.matmul(d_scores, q_j, transpose_a=True))
+                d_values = d_values.write(j, tf.matmul(k_j, d_state) + tf.matmul(scores, d_j, transpose_a=True))
+                return i + 1, d_state + tf.matmul(q_j, d_j, transpose_a=True), d_keys, d_values
+
+            _, _, d_query = tf.while_loop(
+                lambda j, *_: j < num_chunks, query_body,
+                (tf.constant(0), tf.zeros(state_shape), tf.TensorArray(tf.float32, size=num_chunks)),
+                maximum_iterations=num_chunks)
+            _, _, d_keys, d_values = tf.while_loop(
+                lambda i, *_: i < num_chunks, key_value_body,
+                (tf.constant(0), tf.zeros(state_shape), tf.TensorArray(tf.float32, size=num_chunks),
+                 tf.TensorArray(tf.float32, size=num_chunks)), maximum_iterations=num_chunks)
+            return [tf.transpose(chunk_grads.stack(), perm=[1, 2, 0, 3, 4]) for chunk_grads in (d_query, d_keys, d_values)]
+
+        return outputs, grad
+
+    outputs = prefix_attention(chunks(q_prime), chunks(k_prime), chunks(value))
+    outputs = tf.reshape(outputs, tf.concat([[batch_size, num_heads, num_chunks * chunk_size], tf.shape(value)[-1:]], axis=0))
+    outputs = outputs[:, :, :length]
+    av_attention = outputs[..., :-1] / outputs[..., -1:]
+    return tf.cast(tf.transpose(av_attention, perm=[0, 2, 1, 3]), dtype)  # B L H D
+
+
+def favor_state(key: tf.Tensor, value: tf.Tensor, phi_fun=None, random_feats: tf.Tensor = None,
+                causal: bool = False) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """Sums over the sequence of k'ᵀv (B, H, M, D) and of k' (B, H, M), everything FAVOR+ needs from the keys & values.
+    Adding the sums of new tokens to a running state is the recurrent form of causal_attn_hat.
+    Args:
+        :param key: tf.Tensor
+            The Key tensor (B, H, L, D)
+        :param value: tf.Tensor
+            The Value tensor (B, H, L, D)
+        :param phi_fun: Any function
+            A function for "phi" If None, default to Softmax kernel transformations
+        :param random_feats: tf.Tensor
+            The random features for use in phi function in predicting the softmax values
+        :param causal: bool
+            Use the causal key features, must match the attention the state replaces
+    """
+    k_prime = kernel_features(key, is_query=False, phi_fun=phi_fun, random_feats=random_feats, causal=causal)  # B H L M
     # noinspection SpellCheckingInspection
-    av_attention = tf.einsum("lbhm,bhmd->lbhd", q_prime, av_attention, name="AVAttention_PB")
+    kv = tf.einsum("bhlm,bhld->bhmd", k_prime, value, name="StateKV")
+    # A reduction rather than the equivalent einsum "bhlm->bhm", which crashes the TFLite converter.
+    normalizer = tf.reduce_sum(k_prime, axis=2, name="StateNormalizer")
+    return kv, normalizer
+
+
+def favor_state_attention(query: tf.Tensor, kv: tf.Tensor, normalizer: tf.Tensor, phi_fun=None,
+                          random_feats: tf.Tensor = None):
+    """FAVOR+ attention of query (B, H, L, D) over the keys & values summarised by favor_state.
+    Returns B, L, H, D like attn_hat."""
+    q_prime = kernel_features(query, is_query=True, phi_fun=phi_fun, random_feats=random_feats)  # B H L M
     # noinspection SpellCheckingInspection
-    normalizer = tf.einsum("lbhm,l->bhm", k_prime, tf.ones(sequence_length, dtype=k_prime.dtype), name="NormalizerPA")
+    av_attention = tf.einsum("bhlm,bhmd->blhd", q_prime, kv, name="StateAVAttention")
     # noinspection SpellCheckingInspection
-    normalizer = tf.einsum("lbhm,bhm->lbh", q_prime, normalizer, name="NormalizerPB")
-    av_attention = tf.transpose(av_attention, [1, 0, 2, 3])  # B L H D
-    normalizer = tf.transpose(normalizer, [1, 0, 2])  # B L H
-    normalizer = tf.expand_dims(normalizer, tf.rank(normalizer))  # B L H 1
-    return av_attention / normalizer
+    normalizer = tf.einsum("bhlm,bhm->blh", q_prime, normalizer, name="StateNormalizerQ")
+    return av_attention / tf.expand_dims(normalizer, -1)
 
 
 def positive_attention(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, random_feats: tf.Tensor):
@@ -198,6 +348,27 @@ def positive_relu_attention(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor,
     return attn_hat(query, key, value, random_feats=random_feats, phi_fun=relu_kernel_transformation)
 
 
+def mask_logits(logits: tf.Tensor, mask: typing.Optional[tf.Tensor]) -> tf.Tensor:
+    """Set the masked (True or non zero) positions of logits to -1e9 with a single select.
+    Padding masks (..., 1, key_length) are checked first, batches without any padding skip the select.
+    Args:
+        :param logits: tf.Tensor
+            Attention logits (batch_size, num_heads, query_length, key_length)
+        :param mask: tf.Tensor
+            Mask broadcastable to logits, None masks nothing
+    """
+    if mask is None:
+        return logits
+    mask = tf.cast(mask, tf.bool)
+
+    def masked():
+        return tf.where(mask, tf.constant(-1e9, dtype=logits.dtype), logits)
+
+    if mask.shape.rank is not None and mask.shape[-2] == 1:
+        return tf.cond(tf.reduce_any(mask), masked, lambda: logits)
+    return masked()
+
+
 def scaled_dot_product_attention(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, mask: tf.Tensor, name_prefix: str) -> typing.Tuple[tf.Tensor, tf.Tensor]:
     """
     Args:
@@ -219,30 +390,173 @@ def scaled_dot_product_attention(query: tf.Tensor, key: tf.Tensor, value: tf.Ten
     logits = matmul_qk / tf.math.sqrt(depth)
     logits = tf.cast(logits, tf.float32)
 
-    # add the mask zero out padding tokens.
-    if mask is not None:
-        logits += (tf.cast(mask, tf.float32) * -1e9)
+    # mask out padding & future tokens
+    logits = mask_logits(logits, mask)
 
     attention_weights = tf.nn.softmax(logits, axis=-1, name=name_prefix + "_attention_weights")
     return tf.cast(tf.matmul(attention_weights, tf.cast(value, tf.float32)), query.dtype), attention_weights
 
 
+def blockwise_attention(query: tf.Tensor, key: tf.Tensor, value: tf.Tensor, mask: tf.Tensor,
+                        block_size: int = 128) -> tf.Tensor:
+    """Softmax attention, equivalent to scaled_dot_product_attention, computed one block of block_size keys at a time
+    with an online softmax (a running max & sum per query), so the logits are B×H×L×block_size instead of B×H×L×L.
+    The gradient recomputes the blocks the same way instead of keeping them (like FlashAttention), so training
+    memory also grows linearly with the sequence length.
+    Args:
+        :param query: tf.Tensor
+            The Query tensor (B, H, Lq, D)
+        :param key: tf.Tensor
+            The Key tensor (B, H, Lk, D)
+        :param value: tf.Tensor
+            The Value tensor (B, H, Lk, D)
+        :param mask: tf.Tensor
+            1s for the keys to hide, broadcastable to (B, H, Lq, Lk), or None
+        :param block_size: int
+            Number of keys per block
+    :return: tf.Tensor
+        B, H, Lq, D
+    """
+    dtype = query.dtype
+    query, key, value = tf.cast(query, tf.float32), tf.cast(key, tf.float32), tf.cast(value, tf.float32)
+    batch_size, num_heads, key_length, depth = tf.unstack(tf.shape(key))
+    scale = tf.math.rsqrt(tf.cast(depth, tf.float32))
+    num_blocks = (key_length + block_size - 1) // block_size
+    padding = num_blocks * block_size - key_length
+
+    # Pad the keys to whole blocks, the padding is masked, & split them into blocks so every block has a static size.
+    bias = tf.zeros((1, 1, 1, key_length)) if mask is None else tf.cast(mask, tf.float32) * -1e9
+    bias = tf.pad(bias, [[0, 0], [0, 0], [0, 0], [0, padding]], constant_values=-1e9)
+    bias = tf.reshape(bias, tf.concat([tf.shape(bias)[:3], [num_blocks, block_size]], axis=0))
+    key, value = [tf.reshape(tf.pad(tensor, [[0, 0], [0, 0], [0, padding], [0, 0]]),
+                             (batch_size, num_heads, num_blocks, block_size, depth)) for tensor in (key, value)]
+
+    # The query is scaled up front, the grappler remapper fuses matmul * scale + bias into a CPU kernel which returns
+    # an empty tensor for these shapes inside tf.function.
+    def block_logits(q, k, b, j):
+        return tf.matmul(q, tf.gather(k, j, axis=2), transpose_b=True) + tf.gather(b, j, axis=3)
+
+    @tf.custom_gradient
+    def attention(q, k, v, b):
+        def body(j, output, row_max, row_sum):
+            logits = block_logits(q, k, b, j)
+            new_max = tf.maximum(row_max, tf.reduce_max(logits, axis=-1, keepdims=True))
+            probabilities = tf.exp(logits - new_max)
+            correction = tf.exp(row_max - new_max)
+            output = output * correction + tf.matmul(probabilities, tf.gather(v, j, axis=2))
+            row_sum = row_sum * correction + tf.reduce_sum(probabilities, axis=-1, keepdims=True)
+            return j + 1, output, new_max, row_sum
+
+        rows = tf.shape(q)[:3]
+        _, output, row_max, row_sum = tf.while_loop(
+            lambda j, *_: j < num_blocks, body,
+            (tf.constant(0), tf.zeros_like(q), tf.fill(tf.concat([rows, [1]], axis=0), float('-inf')),
+             tf.zeros(tf.concat([rows, [1]], axis=0))), maximum_iterations=num_blocks)
+        output /= row_sum
+        logsumexp = row_max + tf.math.log(row_sum)
+
+        def grad(d_output):
+            # dlogits = p * (dp - rowsum(dO * O)) for every block, with p recomputed from the logsumexp
+            delta = tf.reduce_sum(d_output * output, axis=-1, keepdims=True)
+
+            def grad_body(j, d_query, d_keys, d_values):
+                probabilities = tf.exp(block_logits(q, k, b, j) - logsumexp)
+                d_values = d_values.write(j, tf.matmul(probabilities, d_output, transpose_a=True))
+                d_logits = probabilities * (tf.matmul(d_output, tf.gather(v, j, axis=2), transpose_b=True) - delta)
+                d_query += tf.matmul(d_logits, tf.gather(k, j, axis=2))
+                d_keys = d_keys.write(j, tf.matmul(d_logits, q, transpose_a=True))
+                return j + 1, d_query, d_keys, d_values
+
+            _, d_query, d_keys, d_values = tf.while_loop(
+                lambda j, *_: j < num_blocks, grad_body,
+                (tf.constant(0), tf.zeros_like(q), tf.TensorArray(tf.float32, size=num_blocks),
+                 tf.TensorArray(tf.float32, size=num_blocks)), maximum_iterations=num_blocks)
+            # TensorArray.stack gives blocks first, N, B, H, block_size, D
+            d_keys, d_values = [tf.transpose(blocks.stack(), perm=[1, 2, 0, 3, 4]) for blocks in (d_keys, d_values)]
+            return d_query, d_keys, d_values, tf.zeros_like(b)
+
+        return output, grad
+
+    return tf.cast(attention(query * scale, key, value, bias), dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def dft_matrix(n: int, dtype: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Real & (negated) imaginary parts of the n × n DFT matrix, cos & sin of 2π k j / n, cached per (n, dtype).
+    Args:
+        :param n: int
+            Size of the transform
+        :param dtype: str
+            Name of the dtype of the matrices
+    """
+    # (k * j) mod n keeps the angles small, so the float64 values are exact to the last bit of dtype
+    angles = 2 * np.pi * (np.outer(np.arange(n), np.arange(n)) % n) / n
+    return np.cos(angles).astype(dtype), np.sin(angles).astype(dtype)
+
+
+def graph_dft_matrix(n: tf.Tensor, dtype: tf.DType) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """dft_matrix computed in the graph, for a size only known when the graph runs."""
+    positions = tf.range(n)
+    angles = 2 * np.pi * tf.cast(tf.math.floormod(positions[:, tf.newaxis] * positions, n), tf.float32) / tf.cast(n, tf.float32)
+    return tf.cast(tf.math.cos(angles), dtype), tf.cast(tf.math.sin(angles), dtype)
+
+
 @tf.keras.utils.register_keras_serializable('GavinCore')
 class FourierTransformationLayer(tf.keras.layers.Layer):
     """
     From the paper: https://arxiv.org/pdf/2105.03824.pdf
     Fourier transformations can apparently be used in attention & achieve similar results.
-    Applies FFT1D across the first dimension of the embeddings (sequence_length).
-    Applies FFT2D across the last two dimensions of the embeddings (sequence_length, d_model).
-    Furthermore, applies FFT1D across the last dimension of the embeddings (d_model).
+    Applies FFT2D across the last two dimensions of the embeddings (sequence_length, d_model) & keeps the real part.
 
+    Attributes:
+        :param mode: str
+            How the real part of the FFT2D is computed, all give the same values:
+            'rfft' a real input FFT2D, which only computes half the columns, the other half is filled in by symmetry.
+            'fft' a complex FFT2D of the inputs cast to complex64.
+            'dft' matmuls with cached DFT matrices (see dft_matrix) in the inputs' dtype, float16 included.
+            As the paper recommends for TPUs & short sequences, on CPU the FFTs are faster.
     """
+    modes = ('rfft', 'fft', 'dft')
 
-    def __init__(self, name="fourier_transformation", *args, **kwargs):
+    def __init__(self, name="fourier_transformation", mode: str = 'rfft', *args, **kwargs):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown Fourier mode {mode}, expected one of {self.modes}")
+        self.mode = mode
         super(FourierTransformationLayer, self).__init__(name=name, *args, **kwargs)
 
     @staticmethod
-    def call(inputs: tf.Tensor):
+    def fft(inputs: tf.Tensor) -> tf.Tensor:
+        output = tf.cast(inputs, tf.complex64)
+        output = tf.signal.fft2d(output)
+        return tf.cast(output, inputs.dtype)
+
+    @staticmethod
+    def rfft(inputs: tf.Tensor) -> tf.Tensor:
+        d_model = inputs.shape[-1]
+        # B, L, d // 2 + 1, the missing columns m are the conjugates of the columns d - m in the rows -k mod L
+        output = tf.math.real(tf.signal.rfft2d(tf.cast(inputs, tf.float32)))
+        missing = tf.reverse(output[:, :, 1:d_model - d_model // 2], axis=[2])
+        missing = tf.roll(tf.reverse(missing, axis=[1]), shift=1, axis=1)
+        return tf.cast(tf.concat([output, missing], axis=2), inputs.dtype)
+
+    @staticmethod
+    def dft(inputs: tf.Tensor) -> tf.Tensor:
+        length, d_model = inputs.shape[1], inputs.shape[2]
+        frequencies = d_model // 2 + 1
+        hidden_cos, hidden_sin = dft_matrix(d_model, inputs.dtype.name)
+        if length is None:
+            # Unknown while the functional model is built, or if traced without a static length.
+            sequence_cos, sequence_sin = graph_dft_matrix(tf.shape(inputs)[1], inputs.dtype)
+        else:
+            sequence_cos, sequence_sin = dft_matrix(length, inputs.dtype.name)
+        # Re(fft2d(x)) = cos x cos - sin x sin, the columns m & d - m share their cos & negate their sin
+        # so only the first d // 2 + 1 columns are computed.
+        hidden = np.concatenate([hidden_cos[:, :frequencies], hidden_sin[:, :frequencies]], axis=1)
+        cos, sin = tf.split(tf.matmul(inputs, hidden), 2, axis=2)  # B, L, d // 2 + 1
+        cos, sin = tf.matmul(sequence_cos, cos), tf.matmul(sequence_sin, sin)
+        return tf.concat([cos - sin, tf.reverse((cos + sin)[:, :, 1:d_model - d_model // 2], axis=[2])], axis=2)
+
+    def call(self, inputs: tf.Tensor):
         """
         Args:
             :param inputs: tf.Tensor
@@ -250,11 +564,43 @@ class FourierTransformationLayer(tf.keras.layers.Layer):
         :return: tf.Tensor
             The transformed tensor. Should be of shape (batch_size, sequence_length, d_model)
         """
-        output = tf.cast(inputs, tf.complex64)
-        output = tf.signal.fft2d(output)
-        # output = tf.signal.fft(output)
-        # output = tf.signal.fft(output)
-        return tf.cast(output, inputs.dtype)
+        if self.mode == 'dft':
+            return self.dft(inputs)
+        if self.mode == 'rfft':
+            return self.rfft(inputs)
+        return self.fft(inputs)
+
+    def get_config(self):
+        cfg = {'mode': self.mode}
+        return cfg
+
+
+# The sinusoid tables of positional_encoding_table, one per (d_model, dtype) shared by every layer & model.
+_positional_encoding_tables: Dict[typing.Tuple[int, str], np.ndarray] = {}
+
+
+def positional_encoding_table(length: int, d_model: int, dtype: str = 'float32') -> np.ndarray:
+    """Sinusoid positional encodings of the positions [0, length), (length, d_model).
+    The result is a read only view of a table shared by every PositionalEncoding with the same d_model & dtype,
+    which is only rebuilt (twice as long) when a longer length than ever before is asked for.
+    Args:
+        :param length: int
+            Number of positions
+        :param d_model: int
+            Embeddings size
+        :param dtype: str
+            Name of the dtype of the table
+    """
+    key = (d_model, np.dtype(dtype).name)
+    table = _positional_encoding_tables.get(key)
+    if table is None or len(table) < length:
+        size = max(length, 2 * len(table)) if table is not None else length
+        angles = np.arange(size)[:, np.newaxis] / np.power(10000, (2 * (np.arange(d_model) // 2)) / d_model)
+        # sin of the even indexes then cos of the odd indexes
+        table = np.concatenate([np.sin(angles[:, 0::2]), np.cos(angles[:, 1::2])], axis=-1).astype(dtype)
+        table.flags.writeable = False
+        _positional_encoding_tables[key] = table
+    return table[:length]
 
 
 @tf.keras.utils.register_keras_serializable('GavinCore')
@@ -263,10 +609,11 @@ class PositionalEncoding(tf.keras.layers.Layer):
     """Positional Encoding
 
     Acts as input for the model, attention to where words appear in an input etc...
+    Inputs of a known length use the shared positional_encoding_table, others compute their positions in the graph.
 
     Attributes:
         :param position: int
-            The position the word appears in
+            Number of positions the model is expected to see (its maximum context), longer inputs still work
         :param d_model: int
             This is for the attention math, acts as units for other layers in the model too.
     """
@@ -275,31 +622,64 @@ class PositionalEncoding(tf.keras.layers.Layer):
         self.d_model = d_model
         self.position = position
         super(PositionalEncoding, self).__init__(**kwargs)
-        self.pos_encoding = self.positional_encoding(position, d_model=d_model)
+
+    @property
+    def pos_encoding(self) -> np.ndarray:
+        """The encodings of the first position positions, (1, position, d_model), a view of the shared table."""
+        return positional_encoding_table(self.position, self.d_model)[np.newaxis]
 
     def get_angles(self, position: int, i, d_model: int):
-        angles = 1 / tf.pow(10000, (2 * (i // 2)) / tf.cast(d_model, tf.float32))
+        angles = 1 / tf.pow(10000., (2 * (i // 2)) / tf.cast(d_model, tf.float32))
         return position * angles
 
-    def positional_encoding(self, position, d_model):
+    def positional_encoding(self, positions: tf.Tensor, d_model: int) -> tf.Tensor:
+        """The encodings of any float32 positions tensor, computed in the graph, positions.shape + (d_model,)."""
         angle_rads = self.get_angles(
-            position=tf.range(position, dtype=tf.float32)[:, tf.newaxis],
-            i=tf.range(d_model, dtype=tf.float32)[tf.newaxis, :],
+            position=positions[..., tf.newaxis],
+            i=tf.range(d_model, dtype=tf.float32),
             d_model=d_model)
 
         # apply sin to even index in the array
-        sines = tf.math.sin(angle_rads[:, 0::2])
+        sines = tf.math.sin(angle_rads[..., 0::2])
         # apply cos to odd index in the array
-        cosines = tf.math.cos(angle_rads[:, 1::2])
+        cosines = tf.math.cos(angle_rads[..., 1::2])
 
-        pos_encoding = tf.concat([sines, cosines], axis=-1)
-        pos_encoding = pos_encoding[tf.newaxis, ...]
-        return tf.cast(pos_encoding, tf.float32)
+        return tf.concat([sines, cosines], axis=-1)
 
-    def call(self, inputs):
-        y = self.pos_encoding[:, :tf.shape(inputs)[1], :]
-        y = tf.cast(y, inputs.dtype)
-        return inputs + y
+    def build(self, input_shape):
+        # the shared table is sized for the model's context up front, longer inputs slice a longer one in call
+        positional_encoding_table(self.position, self.d_model)
+        super(PositionalEncoding, self).build(input_shape)
+
+    def call(self, inputs, position: int = 0, attention_mask: tf.Tensor = None):
+        """
+        Args:
+            :param inputs: tf.Tensor
+                Embeddings of shape (batch_size, sequence_length, d_model)
+            :param position: int
+                Offset of the first element of inputs, used when decoding one token at a time.
+            :param attention_mask: tf.Tensor
+                Self attention mask of packed inputs (batch_size, 1, sequence_length, sequence_length),
+                each token's position is the number of earlier tokens it may attend to, so positions restart with every segment.
+        """
+        seq_len = inputs.shape[1]
+        if attention_mask is not None:
+            length = tf.shape(inputs)[1] if seq_len is None else seq_len
+            earlier = tf.transpose(causal_mask(length))
+            visible = tf.logical_and(tf.logical_not(tf.cast(attention_mask[:, 0], tf.bool)), earlier)
+            positions = tf.reduce_sum(tf.cast(visible, tf.float32), axis=-1)
+            if seq_len is None:
+                y = self.positional_encoding(positions, self.d_model)
+            else:
+                y = tf.gather(positional_encoding_table(seq_len, self.d_model), tf.cast(positions, tf.int32))
+        elif seq_len is not None and isinstance(position, int):
+            y = positional_encoding_table(position + seq_len, self.d_model)[position:][np.newaxis]
+        else:
+            # only the positions of inputs, so the shape stays static under XLA when position is a loop variable
+            length = tf.shape(inputs)[1] if seq_len is None else seq_len
+            positions = tf.cast(position, tf.float32) + tf.range(length, dtype=tf.float32)
+            y = self.positional_encoding(positions, self.d_model)[tf.newaxis]
+        return inputs + tf.cast(y, inputs.dtype)
 
     def get_config(self):
         cfg = {'d_model': self.d_model,
@@ -307,48 +687,167 @@ class PositionalEncoding(tf.keras.layers.Layer):
         return cfg
 
 
+# The rotary tables of rotary_table, one (cos, sin) pair per (depth, dtype) shared by every attention layer.
+_rotary_tables: Dict[typing.Tuple[int, str], typing.Tuple[np.ndarray, np.ndarray]] = {}
+
+
+def rotary_frequencies(depth: int) -> np.ndarray:
+    """Rotation frequency of each of the depth // 2 pairs of features, (depth // 2,)."""
+    return 1 / np.power(10000, np.arange(0, depth, 2) / depth)
+
+
+def rotary_table(length: int, depth: int, dtype: str = 'float32') -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Cosines & sines of the rotary embeddings (https://arxiv.org/pdf/2104.09864.pdf) of the positions [0, length),
+    each (length, depth) in the layout of rotate_half, the first & second half of the features are rotated together.
+    Like positional_encoding_table the results are read only views of tables shared by every layer with the same
+    depth & dtype, only rebuilt (twice as long) when a longer length than ever before is asked for.
+    Args:
+        :param length: int
+            Number of positions
+        :param depth: int
+            Size of each head
+        :param dtype: str
+            Name of the dtype of the tables
+    """
+    key = (depth, np.dtype(dtype).name)
+    tables = _rotary_tables.get(key)
+    if tables is None or len(tables[0]) < length:
+        size = max(length, 2 * len(tables[0])) if tables is not None else length
+        angles = np.arange(size)[:, np.newaxis] * rotary_frequencies(depth)
+        angles = np.concatenate([angles, angles], axis=-1)
+        tables = np.cos(angles).astype(dtype), np.sin(angles).astype(dtype)
+        for table in tables:
+            table.flags.writeable = False
+        _rotary_tables[key] = tables
+    return tables[0][:length], tables[1][:length]
+
+
+def rotate_half(inputs: tf.Tensor) -> tf.Tensor:
+    """(x1, x2) -> (-x2, x1) over the two halves of the last axis."""
+    x1, x2 = tf.split(inputs, 2, axis=-1)
+    return tf.concat([-x2, x1], axis=-1)
+
+
+def apply_rotary(inputs: tf.Tensor, cos: tf.Tensor, sin: tf.Tensor) -> tf.Tensor:
+    """Rotate the heads inputs (B, H, L, D) by the angles of their positions, cos & sin (L, D) from rotary_table."""
+    return inputs * tf.cast(cos, inputs.dtype) + rotate_half(inputs) * tf.cast(sin, inputs.dtype)
+
+
 @tf.keras.utils.register_keras_serializable('GavinCore')
 class RotaryPositionalEncoding(tf.keras.layers.Layer):
-    """Rotary Positional Encoding
-    This kind of positional encoding is used by the GPT-J model, its an alternative to the standard positional encoding
-    which is used in the Transformer model. This positional encoding works by adding a sinusoidal signal to the input
-    embeddings at the positional positions.
+    """Deprecated, the embeddings are passed through unchanged.
+    Rotary embeddings now rotate the query & key inside self attention, see GavinMultiHeadAttention's
+    rotary_positions & RotaryTransformerIntegration. Kept so configs saved with it still load.
     """
 
     def __init__(self, name: str = "rotary_positional_encoding", **kwargs):
+        warnings.warn("RotaryPositionalEncoding is deprecated and does nothing, rotary embeddings are applied inside "
+                      "GavinMultiHeadAttention (rotary_positions).", DeprecationWarning, stacklevel=2)
         super(RotaryPositionalEncoding, self).__init__(name=name, **kwargs)
 
-    @staticmethod
-    def align(tensor, axes: List[int], ndim=None):
-        """
-        https://github.com/bojone/bert4keras/blob/70a7eb9ace18b9f4806b6386e5183f32d024bc37/bert4keras/backend.py#L136
-        """
-        ndim = ndim or max(axes) + 1
-        indices = [None] * ndim
-        for i in axes:
-            indices[i] = slice(None)
-        return tensor[indices]
-
-    @staticmethod
-    def check_n(inputs: tf.Tensor):
-        return tf.cond(pred=tf.equal(tf.rank(inputs), 4), true_fn=lambda: 3, false_fn=lambda: 0)
-
     def call(self, inputs):
-        n = self.check_n(inputs)
-        sinusoidal = self.align(inputs[n], axes=[0, 1, -1], ndim=tf.keras.backend.ndim(inputs[0]))
-        cos_pos = tf.keras.backend.repeat_elements(sinusoidal[..., 1::2], 2, -1)
-        sin_pos = tf.keras.backend.repeat_elements(sinusoidal[..., ::2], 2, -1)
-        return inputs * cos_pos + inputs * sin_pos
+        return inputs
 
     def get_config(self):
         return {}
 
 
+def quantize_per_channel(weights: tf.Tensor, axis: int = -1) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+    """Symmetric int8 quantisation with one scale per channel, weights ≈ values * scales.
+    Args:
+        :param weights: tf.Tensor
+            Float weights, e.g. a Dense kernel (input_dim, units) or an embedding table (vocab_size, d_model)
+        :param axis: int
+            The channel axis, every other axis is reduced to find the range of a channel
+    :return: Tuple[tf.Tensor, tf.Tensor]
+        int8 values shaped like weights, and float32 scales (weights.shape[axis],)
+    """
+    weights = tf.cast(weights, tf.float32)
+    rank = len(weights.shape)
+    axis = axis % rank
+    scales = tf.reduce_max(tf.abs(weights), axis=[i for i in range(rank) if i != axis]) / 127.
+    # channels of zeros would divide by 0
+    scales = tf.where(scales > 0., scales, tf.ones_like(scales))
+    values = tf.round(weights / tf.reshape(scales, [-1 if i == axis else 1 for i in range(rank)]))
+    return tf.cast(tf.clip_by_value(values, -127., 127.), tf.int8), scales
+
+
+@tf.keras.utils.register_keras_serializable('GavinCore')
+class QuantizableDense(tf.keras.layers.Dense):
+    """Dense layer whose kernel can be quantised to int8 once trained, see quantize."""
+    quantized = False
+
+    def quantize(self):
+        """Replace the float kernel with an int8 kernel and a float scale per output unit, for inference only.
+        Decoding on CPUs is limited by reading the weights, which are a quarter of the size."""
+        if self.quantized:
+            return
+        kernel, scale = quantize_per_channel(self.kernel, axis=-1)
+        # Untracks the float kernel, so it's neither saved nor kept alive by the layer.
+        self.kernel = None
+        self.quantized_kernel = self.add_weight(name="quantized_kernel", shape=kernel.shape, dtype=tf.int8,
+                                                initializer="zeros", trainable=False)
+        self.kernel_scale = self.add_weight(name="kernel_scale", shape=scale.shape, dtype=tf.float32,
+                                            initializer="ones", trainable=False)
+        self.quantized_kernel.assign(kernel)
+        self.kernel_scale.assign(scale)
+        self.quantized = True
+
+    def call(self, inputs):
+        if not self.quantized:
+            return super(QuantizableDense, self).call(inputs)
+        # The scale is per output unit, so it's applied to the outputs instead of the whole kernel.
+        # tensordot like Dense, tf.matmul would broadcast the kernel over the batch of 3D inputs (BatchMatMul),
+        # which dominated the decode time. TFLite turns the int8 kernel into dynamic range (hybrid) kernels.
+        outputs = tf.tensordot(inputs, tf.cast(self.quantized_kernel, inputs.dtype), [[inputs.shape.rank - 1], [0]])
+        outputs *= tf.cast(self.kernel_scale, outputs.dtype)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, tf.cast(self.bias, outputs.dtype))
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+
+class FusedWeightSlice(trackable_base.Trackable):
+    """Checkpoint view of one of the parts a fused weight is made of, along its last axis,
+    e.g. the query kernel inside the kernel of a fused QKV projection."""
+
+    def __init__(self, variable: tf.Variable, index: int, parts: int):
+        self.variable, self.index, self.parts = variable, index, parts
+
+    def _serialize_to_tensors(self):
+        return {trackable_base.VARIABLE_VALUE_KEY: tf.split(self.variable, self.parts, axis=-1)[self.index]}
+
+    def _restore_from_tensors(self, restored_tensors):
+        parts = tf.split(self.variable, self.parts, axis=-1)
+        parts[self.index] = tf.cast(restored_tensors[trackable_base.VARIABLE_VALUE_KEY], self.variable.dtype)
+        return self.variable.assign(tf.concat(parts, axis=-1))
+
+
+class FusedDenseSlice(trackable_base.Trackable):
+    """Stands in for one of the Dense layers fused into dense when restoring a checkpoint saved before fusing,
+    its kernel & bias restore into their slice of the fused kernel & bias."""
+
+    def __init__(self, dense: tf.keras.layers.Dense, index: int, parts: int):
+        self.dense, self.index, self.parts = dense, index, parts
+
+    def _lookup_dependency(self, name, cached_dependencies=None):
+        if name in ('kernel', 'bias') and getattr(self.dense, name, None) is not None:
+            return FusedWeightSlice(getattr(self.dense, name), self.index, self.parts)
+        return None
+
+
 @tf.keras.utils.register_keras_serializable('GavinCore')
 # noinspection PyMethodOverriding,PyShadowingNames
 class GavinMultiHeadAttention(tf.keras.layers.Layer):
+    # Whether the layer has an attention matrix to capture (see arm_capture).
+    captures_attention = True
+    # Side of the square (resized) attention image captured per head.
+    attention_image_size = 64
+
     # noinspection Assert
-    def __init__(self, d_model: int, num_heads: int, name: str = "multi_head_attention", **kwargs):
+    def __init__(self, d_model: int, num_heads: int, name: str = "multi_head_attention", fused_qkv: bool = False,
+                 block_size: int = None, rotary_positions: int = None, **kwargs):
         """Multi Head Attention Layer
 
         ...
@@ -359,44 +858,207 @@ class GavinMultiHeadAttention(tf.keras.layers.Layer):
                 The number of heads the layer should have
             :param name: str
                 The name of layer
+            :param fused_qkv: bool
+                Self attention only, the query, key & value are the same tensor so they're projected by
+                a single d_model -> 3 * d_model Dense (qkv_dense) and split into heads once.
+                Checkpoints saved with separate query_dense, key_dense & value_dense still load.
+            :param block_size: int
+                Compute the attention blockwise over this many keys at a time (see blockwise_attention),
+                memory then grows linearly with the sequence length.
+            :param rotary_positions: int
+                Rotate the query & key heads by the rotary embeddings of their positions (see rotary_table),
+                the angles of the first rotary_positions positions are kept as a table, later ones are computed.
+                Meant for self attention, whose scores then only depend on the distance between tokens.
         """
         super(GavinMultiHeadAttention, self).__init__(name=name)
         self.num_heads = num_heads
         self.d_model = d_model
+        self.fused_qkv = fused_qkv
+        self.block_size = block_size
+        self.rotary_positions = rotary_positions
 
         assert d_model % self.num_heads == 0
 
         self.depth = d_model // self.num_heads
 
-        self.query_dense = tf.keras.layers.Dense(units=d_model)
-        self.key_dense = tf.keras.layers.Dense(units=d_model)
-        self.value_dense = tf.keras.layers.Dense(units=d_model)
-        self.saved_attention_image = None
+        if fused_qkv:
+            self.qkv_dense = QuantizableDense(units=3 * d_model)
+        else:
+            self.query_dense = QuantizableDense(units=d_model)
+            self.key_dense = QuantizableDense(units=d_model)
+            self.value_dense = QuantizableDense(units=d_model)
 
-        self.dense = tf.keras.layers.Dense(units=d_model)
+        self.dense = QuantizableDense(units=d_model)
         super(GavinMultiHeadAttention, self).__init__(**kwargs)
 
+        self.create_capture_variables()
+
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def create_capture_variables(self):
+        """Single step capture for AttentionImageLoggingCallback, a few KB instead of keeping the B×H×L×L matrix.
+        Untracked, so they're neither weights of the model nor saved with it.
+        Synchronised on read, so training steps under a MirroredStrategy assign their replica's copy
+        without a merge_call, which can't happen inside the tf.cond of capture_attention."""
+        self.capture_armed, self.attention_image = None, None
+        if not self.captures_attention:
+            return
+        self.capture_armed = tf.Variable(False, name="capture_armed", trainable=False,
+                                         synchronization=tf.VariableSynchronization.ON_READ,
+                                         aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+        self.attention_image = tf.Variable(tf.zeros((self.num_heads, self.attention_image_size, self.attention_image_size)),
+                                           name="attention_image", trainable=False,
+                                           synchronization=tf.VariableSynchronization.ON_READ,
+                                           aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
     def split_heads(self, inputs, batch_size: int):
         inputs = tf.reshape(inputs, shape=(batch_size, -1, self.num_heads, self.depth))  # B, L, H, D
         return tf.transpose(inputs, perm=[0, 2, 1, 3])  # B, H, L, D
 
-    def call(self, inputs: Dict):
+    def split_qkv(self, inputs, batch_size: int) -> typing.Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """Split the output of qkv_dense (B, L, 3 * d_model) into the query, key & value heads with one transpose."""
+        inputs = tf.reshape(inputs, shape=(batch_size, -1, 3, self.num_heads, self.depth))  # B, L, 3, H, D
+        query, key, value = tf.unstack(tf.transpose(inputs, perm=[2, 0, 3, 1, 4]))  # 3, B, H, L, D
+        return query, key, value
+
+    def project_heads(self, query: tf.Tensor, key: typing.Optional[tf.Tensor], value: typing.Optional[tf.Tensor],
+                      batch_size: int) -> typing.Tuple[tf.Tensor, typing.Optional[tf.Tensor], typing.Optional[tf.Tensor]]:
+        """Linear layers & split heads, each B, H, L, D. The key & value stay None when key is None,
+        fused_qkv layers project all three from the query."""
+        if self.fused_qkv:
+            return self.split_qkv(self.qkv_dense(query), batch_size)
+        query = self.split_heads(self.query_dense(query), batch_size)
+        if key is None:
+            return query, None, None
+        return query, self.split_heads(self.key_dense(key), batch_size), self.split_heads(self.value_dense(value), batch_size)
+
+    def rotary_embedding(self, offset: typing.Union[int, tf.Tensor],
+                         length: typing.Union[int, tf.Tensor]) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+        """Cosines & sines of the rotary embeddings of the positions [offset, offset + length), each (length, depth).
+        An offset & length known when tracing slice the shared rotary_table, otherwise the table of the first
+        rotary_positions positions is sliced in the graph (a fixed size slice under XLA when decoding one token),
+        the angles of positions past it are computed."""
+        if isinstance(offset, int) and isinstance(length, int):
+            cos, sin = rotary_table(offset + length, self.depth)
+            return tf.constant(cos[offset:]), tf.constant(sin[offset:])
+        offset = tf.cast(offset, tf.int32)
+        table = tf.constant(np.stack(rotary_table(self.rotary_positions, self.depth)))  # 2, P, D
+
+        def from_table():
+            cos, sin = tf.unstack(tf.slice(table, [0, offset, 0], [2, length, self.depth]))
+            return cos, sin
+
+        def in_graph():
+            positions = tf.cast(offset + tf.range(length), tf.float32)
+            angles = positions[:, tf.newaxis] * tf.constant(rotary_frequencies(self.depth), dtype=tf.float32)
+            angles = tf.concat([angles, angles], axis=-1)
+            return tf.math.cos(angles), tf.math.sin(angles)
+
+        return tf.cond(offset + length <= self.rotary_positions, from_table, in_graph)
+
+    @staticmethod
+    def sequence_length(heads: tf.Tensor) -> typing.Union[int, tf.Tensor]:
+        """Length of heads (B, H, L, D), an int when it is known when tracing."""
+        return heads.shape[2] if heads.shape[2] is not None else tf.shape(heads)[2]
+
+    def _lookup_dependency(self, name, cached_dependencies=None):
+        """Maps the Dense layers of checkpoints saved before fusing onto their slice of qkv_dense."""
+        projections = ['query_dense', 'key_dense', 'value_dense']
+        if self.fused_qkv and name in projections:
+            return FusedDenseSlice(self.qkv_dense, projections.index(name), len(projections))
+        return super(GavinMultiHeadAttention, self)._lookup_dependency(name, cached_dependencies)
+
+    def arm_capture(self, armed: bool = True):
+        """Capture the attention of the next training calls into attention_image, until disarmed.
+        Disarmed (the default) a training call only reads the flag, inference calls don't touch it at all."""
+        if self.capture_armed is None:
+            raise ValueError(f"{self.name} has no attention matrix to capture.")
+        self.capture_armed.assign(armed)
+
+    def capture_attention(self, query: tf.Tensor, key: tf.Tensor, mask: tf.Tensor, attention_matrix: tf.Tensor = None):
+        """When armed, save the attention of the first example (H, Lq, Lk) resized to
+        attention_image_size × attention_image_size into attention_image.
+        Without attention_matrix (blockwise attention) the first example's matrix is computed only when armed."""
+        def capture():
+            if attention_matrix is None:
+                _, matrix = scaled_dot_product_attention(query[:1], key[:1], key[:1], None if mask is None else mask[:1],
+                                                         name_prefix=self.name)
+            else:
+                matrix = attention_matrix
+            image = tf.transpose(tf.cast(matrix[0], tf.float32), perm=[1, 2, 0])  # Lq, Lk, H
+            image = tf.image.resize(image, (self.attention_image_size, self.attention_image_size), method='area')
+            self.attention_image.assign(tf.transpose(image, perm=[2, 0, 1]))
+
+        tf.cond(self.capture_armed, capture, lambda: None)
+
+    def initial_cache(self, batch_size: int, length: int = None, key: tf.Tensor = None, value: tf.Tensor = None) -> Dict:
+        """Create the key/value cache for incremental decoding.
+        Args:
+            :param batch_size: int
+                The batch size being decoded
+            :param length: int
+                Number of positions the (self attention) cache holds, filled one step at a time
+            :param key: tf.Tensor
+                Encoder outputs, if given they are projected once here and reused every step
+            :param value: tf.Tensor
+                Encoder outputs, see key
+        """
+        if key is not None:
+            key = self.split_heads(self.key_dense(key), batch_size)
+            if self.rotary_positions:
+                key = apply_rotary(key, *self.rotary_embedding(0, self.sequence_length(key)))
+            return {'key': key, 'value': self.split_heads(self.value_dense(value), batch_size)}
+        zeros = tf.zeros((batch_size, self.num_heads, length, self.depth), dtype=self.compute_dtype)
+        return {'key': zeros, 'value': zeros}
+
+    def call(self, inputs: Dict, cache: typing.Optional[Dict] = None, decode_step: typing.Optional[tf.Tensor] = None,
+             training: bool = None):
+        """
+        Args:
+            :param inputs: Dict
+                'query', 'key', 'value' and 'mask' tensors.
+            :param cache: Dict
+                Optional key/value cache from initial_cache, updated in place.
+                If inputs['key'] is None the cached keys & values are reused as is (encoder outputs),
+                otherwise the keys & values of the new token are written into the cache at decode_step.
+            :param decode_step: tf.Tensor
+                Position of the new token in the cache, also the position its query & key are rotated by.
+            :param training: bool
+                Training calls capture the attention when armed, see arm_capture.
+        """
         query, key, value, mask = (inputs['query'], inputs['key'],
                                    inputs['value'], inputs['mask'])
         batch_size = tf.shape(query)[0]
 
-        # linear layers
-        query = self.query_dense(query)
-        key = self.key_dense(key)
-        value = self.value_dense(value)
-
-        # split heads
-        query = self.split_heads(query, batch_size)
-        key = self.split_heads(key, batch_size)
-        value = self.split_heads(value, batch_size)
-
-        scaled_attention, attention_matrix = scaled_dot_product_attention(query, key, value, mask, name_prefix=self.name)
-        self.saved_attention_image = attention_matrix
+        # linear layers & split heads
+        query, key, value = self.project_heads(query, key, value, batch_size)
+
+        if self.rotary_positions:
+            # The new keys of a decode step share the query's positions, cached keys were rotated when written.
+            rotation = self.rotary_embedding(0 if decode_step is None else decode_step, self.sequence_length(query))
+            query = apply_rotary(query, *rotation)
+            if key is not None:
+                if not (self.fused_qkv or cache is not None):
+                    rotation = self.rotary_embedding(0, self.sequence_length(key))
+                key = apply_rotary(key, *rotation)
+
+        if cache is not None and key is None:
+            key, value = cache['key'], cache['value']
+        else:
+            if cache is not None:
+                # Written with a one hot, so the cache keeps a fixed shape inside tf.while_loop & XLA.
+                indices = tf.reshape(tf.one_hot(decode_step, tf.shape(cache['key'])[2], dtype=key.dtype), (1, 1, -1, 1))
+                key = cache['key'] + key * indices
+                value = cache['value'] + value * indices
+                cache['key'], cache['value'] = key, value
+
+        attention_matrix = None
+        if self.block_size:
+            scaled_attention = blockwise_attention(query, key, value, mask, block_size=self.block_size)
+        else:
+            scaled_attention, attention_matrix = scaled_dot_product_attention(query, key, value, mask, name_prefix=self.name)
+        # The capture variables are untracked, so the training calls traced for a SavedModel leave them out.
+        if training and self.capture_armed is not None and not save_context.in_save_context():
+            self.capture_attention(query, key, mask, attention_matrix)
 
         scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
 
@@ -409,7 +1071,10 @@ class GavinMultiHeadAttention(tf.keras.layers.Layer):
 
     def get_config(self):
         cfg = {'d_model': self.d_model,
-               'num_heads': self.num_heads}
+               'num_heads': self.num_heads,
+               'fused_qkv': self.fused_qkv,
+               'block_size': self.block_size,
+               'rotary_positions': self.rotary_positions}
         return cfg
 
 
@@ -429,33 +1094,88 @@ class GavinMultiHeadPerformerAttention(GavinMultiHeadAttention):
             Number of features to be used in Gaussian Matrix
         :param name: str
             The name of layer.
+        :param causal: bool
+            Each position only attends to itself and earlier positions (decoder self attention),
+            which also allows decoding one token at a time with a constant size cache.
     """
+    # The FAVOR+ feature map, None is the softmax kernel.
+    phi_fun = None
+    # FAVOR+ never builds the attention matrix.
+    captures_attention = False
 
-    def __init__(self, d_model: int, num_heads: int, num_features: int, name: str = "MultiHeadPerformer", **kwargs):
+    def __init__(self, d_model: int, num_heads: int, num_features: int, name: str = "MultiHeadPerformer",
+                 causal: bool = False, fused_qkv: bool = False, **kwargs):
         self.num_features = num_features
-        super().__init__(d_model, num_heads, name, **kwargs)
-        self.random_feats = orthogonal_gaussian(self.num_features, self.depth)
-
-    def call(self, inputs: Dict):
+        self.causal = causal
+        super().__init__(d_model, num_heads, name, fused_qkv=fused_qkv, **kwargs)
+        # A weight, so the features are saved with the model & only change when redraw_features is called.
+        self.random_feats = self.add_weight(name="random_feats", shape=(self.num_features, self.depth),
+                                            dtype=tf.float32, trainable=False,
+                                            initializer=lambda shape, dtype=None: orthogonal_gaussian(*shape))
+
+    def redraw_features(self, random_feats: tf.Tensor = None):
+        """Replace the random features, by random_feats (num_features, depth) if given or a new orthogonal_gaussian.
+        FAVOR+ redraws them every so many training steps (see FeatureRedrawCallback), inference keeps the saved ones."""
+        self.random_feats.assign(orthogonal_gaussian(self.num_features, self.depth) if random_feats is None else random_feats)
+
+    def initial_cache(self, batch_size: int, length: int = None, key: tf.Tensor = None, value: tf.Tensor = None) -> Dict:
+        """Create the cache for incremental decoding, running sums of k'ᵀv and k' (see favor_state),
+        so unlike GavinMultiHeadAttention its size does not grow with length.
+        Args:
+            :param batch_size: int
+                The batch size being decoded
+            :param length: int
+                Unused, kept for compatibility with GavinMultiHeadAttention.initial_cache
+            :param key: tf.Tensor
+                Encoder outputs, if given they are summarised once here and reused every step
+            :param value: tf.Tensor
+                Encoder outputs, see key
+        """
+        if key is not None:
+            kv, normalizer = favor_state(self.split_heads(self.key_dense(key), batch_size),
+                                         self.split_heads(self.value_dense(value), batch_size),
+                                         phi_fun=self.phi_fun, random_feats=self.random_feats, causal=self.causal)
+            return {'kv': kv, 'normalizer': normalizer}
+        return {'kv': tf.zeros((batch_size, self.num_heads, self.num_features, self.depth), dtype=self.compute_dtype),
+                'normalizer': tf.zeros((batch_size, self.num_heads, self.num_features), dtype=self.compute_dtype)}
+
+    def call(self, inputs: Dict, cache: typing.Optional[Dict] = None, decode_step: typing.Optional[tf.Tensor] = None,
+             training: bool = None):
+        """
+        Args:
+            :param inputs: Dict
+                'query', 'key', 'value' and 'mask' tensors, the mask is unused.
+            :param cache: Dict
+                Optional cache from initial_cache, updated in place.
+                If inputs['key'] is None the cached sums are used as is (encoder outputs),
+                otherwise the new tokens are added to them, only valid for causal attention.
+            :param decode_step: tf.Tensor
+                Unused, the running sums don't need the position.
+        """
         query, key, value = inputs['query'], inputs['key'], inputs['value']
 
         batch_size = tf.shape(query)[0]
 
-        # linear layers
-        query = self.query_dense(query)
-        key = self.key_dense(key)
-        value = self.value_dense(value)
-
-        # split heads
-        query = self.split_heads(query, batch_size)  # B, H, L, D
-        key = self.split_heads(key, batch_size)  # B, H, L, D
-        value = self.split_heads(value, batch_size)  # B, H, L, D
-
-        scaled_attention = positive_attention(query=query, key=key, value=value,
-                                              random_feats=self.random_feats)
-
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
-
+        # linear layers & split heads
+        query, key, value = self.project_heads(query, key, value, batch_size)  # B, H, L, D
+
+        if cache is not None and key is None:
+            scaled_attention = favor_state_attention(query, cache['kv'], cache['normalizer'],
+                                                     phi_fun=self.phi_fun, random_feats=self.random_feats)
+        else:
+            if cache is not None:
+                if not self.causal:
+                    raise ValueError(f"{self.name} is not causal, so it cannot be decoded one token at a time.")
+                kv, normalizer = favor_state(key, value, phi_fun=self.phi_fun, random_feats=self.random_feats, causal=True)
+                cache['kv'], cache['normalizer'] = cache['kv'] + kv, cache['normalizer'] + normalizer
+                scaled_attention = favor_state_attention(query, cache['kv'], cache['normalizer'],
+                                                         phi_fun=self.phi_fun, random_feats=self.random_feats)
+            elif self.causal:
+                scaled_attention = causal_attn_hat(query, key, value, phi_fun=self.phi_fun, random_feats=self.random_feats)
+            else:
+                scaled_attention = attn_hat(query, key, value, phi_fun=self.phi_fun, random_feats=self.random_feats)
+
+        # scaled_attention is already B, L, H, D
         concat_attention = tf.reshape(scaled_attention,
                                       (batch_size, -1, self.d_model))
 
@@ -466,47 +1186,48 @@ class GavinMultiHeadPerformerAttention(GavinMultiHeadAttention):
     def get_config(self):
         cfg = {'d_model': self.d_model,
                'num_heads': self.num_heads,
-               'num_features': self.num_features}
+               'num_features': self.num_features,
+               'causal': self.causal,
+               'fused_qkv': self.fused_qkv}
         return cfg
 
 
 @tf.keras.utils.register_keras_serializable('GavinCore')
 class MultiHeadPerformerReluAttention(GavinMultiHeadPerformerAttention):
-    def call(self, inputs: Dict):
-        query, key, value = inputs['query'], inputs['key'], inputs['value']
-        batch_size = tf.shape(query)[0]
+    phi_fun = staticmethod(relu_kernel_transformation)
 
-        # linear layers
-        query = self.query_dense(query)
-        key = self.key_dense(key)
-        value = self.value_dense(value)
 
-        # split heads
-        query = self.split_heads(query, batch_size)  # B, H, L, D
-        key = self.split_heads(key, batch_size)  # B, H, L, D
-        value = self.split_heads(value, batch_size)  # B, H, L, D
+# The mask of causal_mask, shared by every look ahead mask & grown like the positional encoding tables.
+_causal_mask = np.zeros((0, 0), dtype=bool)
 
-        scaled_attention = positive_relu_attention(query=query, key=key, value=value,
-                                                   random_feats=self.random_feats)
 
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
-
-        concat_attention = tf.reshape(scaled_attention,
-                                      (batch_size, -1, self.d_model))
-
-        outputs = self.dense(concat_attention)
-
-        return outputs
+def causal_mask(length: typing.Union[int, tf.Tensor]) -> tf.Tensor:
+    """Look ahead mask (length, length), True above the diagonal where a token would attend to later tokens.
+    Lengths known when tracing slice a shared read only mask, only rebuilt (twice as large) for a longer length
+    than ever before, other lengths compare two ranges instead of building a matrix of ones.
+    Args:
+        :param length: int
+            Sequence length
+    """
+    global _causal_mask
+    if isinstance(length, int):
+        if len(_causal_mask) < length:
+            size = max(length, 2 * len(_causal_mask))
+            _causal_mask = np.triu(np.ones((size, size), dtype=bool), k=1)
+            _causal_mask.flags.writeable = False
+        return tf.constant(_causal_mask[:length, :length])
+    positions = tf.range(length)
+    return positions[:, tf.newaxis] < positions[tf.newaxis, :]
 
 
 @tf.keras.utils.register_keras_serializable('GavinCore')
 class PaddingMaskLayer(tf.keras.layers.Layer):
     def __init__(self, name: str = "padding_mask", **kwargs):
+        """Boolean padding mask (batch_size, 1, 1, sequence_length), True at the padding tokens (0)."""
         super(PaddingMaskLayer, self).__init__(name=name, **kwargs)
 
     def call(self, inputs: tf.Tensor, **kwargs):
-        mask = tf.cast(tf.math.equal(inputs, 0), tf.float32)
-        return mask[:, tf.newaxis, tf.newaxis, :]
+        return tf.math.equal(inputs, 0)[:, tf.newaxis, tf.newaxis, :]
 
     def get_config(self):
         cfg = {}
@@ -516,14 +1237,61 @@ class PaddingMaskLayer(tf.keras.layers.Layer):
 @tf.keras.utils.register_keras_serializable('GavinCore')
 class LookAheadMaskLayer(tf.keras.layers.Layer):
     def __init__(self, name: str = "look_ahead_mask", **kwargs):
+        """Boolean look ahead mask (batch_size, 1, sequence_length, sequence_length), the causal_mask & padding mask."""
         super(LookAheadMaskLayer, self).__init__(name=name, **kwargs)
         self.padding_mask = PaddingMaskLayer()
 
     def call(self, inputs: tf.Tensor, **kwargs):
-        seq_len = tf.shape(inputs)[1]
-        look_ahead_mask = 1 - tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0)
-        padding_mask = self.padding_mask(inputs)
-        return tf.maximum(look_ahead_mask, padding_mask)
+        seq_len = inputs.shape[1] if inputs.shape[1] is not None else tf.shape(inputs)[1]
+        return tf.logical_or(causal_mask(seq_len), self.padding_mask(inputs))
+
+    def get_config(self):
+        cfg = {}
+        return cfg
+
+
+@tf.keras.utils.register_keras_serializable('GavinCore')
+class SegmentPaddingMaskLayer(tf.keras.layers.Layer):
+    def __init__(self, name: str = "segment_padding_mask", **kwargs):
+        """Padding mask for packed inputs, tokens only attend to tokens of their own segment."""
+        super(SegmentPaddingMaskLayer, self).__init__(name=name, **kwargs)
+
+    def call(self, inputs: Dict, **kwargs):
+        """
+        Args:
+            :param inputs: Dict
+                'query_segments' (batch_size, query_length) & 'key_segments' (batch_size, key_length),
+                the segment id of every token, 0 is padding.
+        :return: tf.Tensor
+            (batch_size, 1, query_length, key_length)
+        """
+        query_segments, key_segments = inputs['query_segments'], inputs['key_segments']
+        mask = tf.logical_or(tf.not_equal(query_segments[:, :, tf.newaxis], key_segments[:, tf.newaxis, :]),
+                             tf.equal(key_segments, 0)[:, tf.newaxis, :])
+        return mask[:, tf.newaxis, :, :]
+
+    def get_config(self):
+        cfg = {}
+        return cfg
+
+
+@tf.keras.utils.register_keras_serializable('GavinCore')
+class SegmentLookAheadMaskLayer(tf.keras.layers.Layer):
+    def __init__(self, name: str = "segment_look_ahead_mask", **kwargs):
+        """Look ahead mask for packed inputs, tokens only attend to earlier tokens of their own segment."""
+        super(SegmentLookAheadMaskLayer, self).__init__(name=name, **kwargs)
+        self.padding_mask = PaddingMaskLayer()
+        self.segment_padding_mask = SegmentPaddingMaskLayer()
+
+    def call(self, inputs: tf.Tensor, **kwargs):
+        """
+        Args:
+            :param inputs: tf.Tensor
+                The segment id of every token (batch_size, sequence_length), 0 is padding.
+        """
+        seq_len = inputs.shape[1] if inputs.shape[1] is not None else tf.shape(inputs)[1]
+        segment_mask = self.segment_padding_mask({'query_segments': inputs, 'key_segments': inputs})
+        return tf.logical_or(causal_mask(seq_len), segment_mask)
 
     def get_config(self):
         cfg = {}
@@ -534,6 +1302,7 @@ class LookAheadMaskLayer(tf.keras.layers.Layer):
 class GPUEnabledEmbedding(tf.keras.layers.Embedding):
     """Embedding Layers are forced to run on CPUs which seriously
     hurts training performance this fixes that issue."""
+    quantized = False
 
     @tf_utils.shape_type_conversion
     def build(self, _):
@@ -545,3 +1314,25 @@ class GPUEnabledEmbedding(tf.keras.layers.Embedding):
             constraint=self.embeddings_constraint,
         )
         self.built = True
+
+    def quantize(self):
+        """Replace the float table with an int8 table and a float scale per token, for inference only,
+        lookups then read a quarter of the bytes, see QuantizableDense.quantize."""
+        if self.quantized:
+            return
+        embeddings, scale = quantize_per_channel(self.embeddings, axis=0)
+        self.embeddings = None
+        self.quantized_embeddings = self.add_weight(name="quantized_embeddings", shape=embeddings.shape, dtype=tf.int8,
+                                                    initializer="zeros", trainable=False)
+        self.embeddings_scale = self.add_weight(name="embeddings_scale", shape=scale.shape, dtype=tf.float32,
+                                                initializer="ones", trainable=False)
+        self.quantized_embeddings.assign(embeddings)
+        self.embeddings_scale.assign(scale)
+        self.quantized = True
+
+    def call(self, inputs):
+        if not self.quantized:
+            return super(GPUEnabledEmbedding, self).call(inputs)
+        inputs = tf.cast(inputs, tf.int32)
+        outputs = tf.cast(tf.gather(self.quantized_embeddings, inputs), self.compute_dtype)
+        return outputs * tf.cast(tf.gather(self.embeddings_scale, inputs), self.compute_dtype)[..., tf.newaxis]
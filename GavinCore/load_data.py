@@ -1,5 +1,10 @@
+import argparse
 import base64
+import hashlib
+import itertools
+import json
 import pickle
+import shutil
 import typing
 import sys
 import os
@@ -7,11 +12,13 @@ import platform
 import requests
 import urllib.request
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import tqdm
 
+from .token_files import IndexedTokenFile, IndexedTokenFileWriter, token_dtype
+
 root_path = Path(__file__).resolve().parent.parent
 SUPPORTED_VERSIONS = ["3.8", "3.9", "3.10"]
 WINDOWS_NEEDED_DLLs = ["GavinBackendDatasetUtils.pyd", "pi_cuda.dll", "pi_level_zero.dll", "pi_opencl.dll", "sycl.dll", "sycld.dll", "xptifw.dll", "ze_loader.dll"]
@@ -57,23 +64,52 @@ elif "linux" in platform.system().lower():
             sys.path.append(os.path.join(str(root_path), 'CustomPackages/linux', dll))
 
 
+def iter_lines(path: typing.AnyStr, start: int = 0, end: int = None) -> typing.Iterator[str]:
+    """Read the lines of a file starting in the byte range [start, end), so a file can be split between processes.
+    Args:
+        :param path: str
+            The file
+        :param start: int
+            Byte offset, lines starting before it are skipped
+        :param end: int
+            Byte offset, lines starting at or after it are not read, None reads to the end of the file
+    """
+    with open(path, "rb") as f:
+        if start:
+            # finish the line running into start, it belongs to the previous byte range
+            f.seek(start - 1)
+            f.readline()
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode("utf-8", errors="replace")
+
+
+# noinspection PickleLoad
+def iter_tokenized_lines(path: typing.AnyStr, start: int = 0, end: int = None) -> typing.Iterator[typing.List[int]]:
+    """Decode the pickled & base64 encoded token lists of a .from/.to file one line at a time, without start/end tokens.
+    See iter_lines for the arguments."""
+    for line in iter_lines(path, start, end):
+        line = line.strip("'b'")
+        line = line.strip("'\n'")
+        line = line.strip("'")
+        if not line:
+            continue
+        yield pickle.loads(base64.b64decode(line))
+
+
 # noinspection PickleLoad
 def tokenized_read_thread(path: typing.AnyStr, reddit_set_max: int, s_token: typing.List[int],
                           e_token: typing.List[int], thread_id: int = 0, is_url: bool = False):
     lines = []
     pbar = tqdm.tqdm(total=reddit_set_max // 2, desc=f"Thread: {str(thread_id).encode('utf-8', errors='replace').decode('utf-8', errors='replace')}")
     if not is_url:
-        with open(path, "r") as f:
-            for i in range(reddit_set_max // 2):
-                line = next(f).strip("'b'")
-                line = line.strip("'\n'")
-                line = line.strip("'")
-                # line = preprocess_sentence(line)
-                line = pickle.loads(base64.b64decode(line))
-                line.insert(0, s_token[0])
-                line.append(e_token[0])
-                lines.append(line)
-                pbar.update(1)
+        for line in itertools.islice(iter_tokenized_lines(path), reddit_set_max // 2):
+            line.insert(0, s_token[0])
+            line.append(e_token[0])
+            lines.append(line)
+            pbar.update(1)
     else:
         with urllib.request.urlopen(path) as f:
             while len(lines) != reddit_set_max // 2:
@@ -93,6 +129,177 @@ def tokenized_read_thread(path: typing.AnyStr, reddit_set_max: int, s_token: typ
     return lines
 
 
+def write_chunk(path: typing.AnyStr, output_path: typing.AnyStr, start: int, end: int, dtype: str,
+                samples: typing.Iterable[typing.List[int]], write_every: int = 4096) -> typing.Dict:
+    """Stream the samples read from the byte range [start, end) of path into an indexed token file.
+    Returns the chunk's manifest entry, which is also written to {output_path}.done once the chunk is complete."""
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 24))
+            if not block:
+                break
+            checksum.update(block)
+            remaining -= len(block)
+    with IndexedTokenFileWriter(output_path, dtype=np.dtype(dtype)) as writer:
+        for batch in iter(lambda: list(itertools.islice(samples, write_every)), []):
+            writer.write_many(batch)
+    entry = {'start': start, 'end': end, 'sha256': checksum.hexdigest(), 'num_samples': writer.number_of_samples}
+    with open(output_path + ".done", "w") as f:
+        json.dump(entry, f)
+    return entry
+
+
+def convert_tokenized_chunk(path: typing.AnyStr, output_path: typing.AnyStr, start: int, end: int,
+                            dtype: str, write_every: int = 4096) -> typing.Dict:
+    """Convert the lines starting in the byte range [start, end) of a .from/.to file into an indexed token file.
+    Returns the chunk's manifest entry, which is also written to {output_path}.done once the chunk is complete."""
+    return write_chunk(path, output_path, start, end, dtype, iter_tokenized_lines(path, start, end), write_every)
+
+
+def source_fingerprint(path: typing.AnyStr) -> typing.Dict:
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_converted(path: typing.AnyStr, output_path: typing.AnyStr, converter: typing.Dict = None,
+                 any_converter: bool = False) -> bool:
+    """Whether output_path holds an indexed token file converted from the current contents of path
+    (by the same converter, see convert_in_chunks). Readers which don't know the converter, e.g. the tokenizer
+    TokenizationEngine wrote the file with, pass any_converter."""
+    if not (IndexedTokenFile.exists(output_path) and os.path.exists(output_path + ".manifest.json")):
+        return False
+    with open(output_path + ".manifest.json", "r") as f:
+        manifest = json.load(f)
+    fingerprint = source_fingerprint(path)
+    return manifest['source']['size'] == fingerprint['size'] and manifest['source']['mtime_ns'] == fingerprint['mtime_ns'] \
+        and (any_converter or manifest.get('converter') == converter)
+
+
+def convert_in_chunks(path: typing.AnyStr, output_path: typing.AnyStr, dtype: str, chunk_function: typing.Callable,
+                      num_workers: int = None, chunk_size: int = 1 << 26, force: bool = False, converter: typing.Dict = None,
+                      initializer: typing.Callable = None, initargs: typing.Tuple = ()) -> typing.Dict:
+    """Convert a line based file into an indexed token file (see token_files).
+    The file is split into byte range chunks converted by num_workers processes, each chunk is streamed into its
+    own token file under {output_path}.chunks, so an interrupted conversion resumes from the unfinished chunks.
+    The chunks are then concatenated and {output_path}.manifest.json records the source's size, modification time
+    and per chunk sha256, so later runs can skip the conversion (see is_converted).
+    Args:
+        :param path: str
+            The source file
+        :param output_path: str
+            Path of the indexed token file, without suffixes
+        :param dtype: str
+            dtype of the tokens
+        :param chunk_function: Callable
+            chunk_function(path, chunk_output_path, start, end, dtype) converts one chunk, see write_chunk
+        :param num_workers: int
+            Number of processes, defaults to the number of CPUs
+        :param chunk_size: int
+            Bytes of the source file per chunk
+        :param force: bool
+            Convert even if the manifest says output_path is up to date
+        :param converter: Dict
+            Identifies what converts the file, e.g. the tokenizer, output made by another converter is redone
+        :param initializer: Callable
+            Run once in every worker process with initargs
+    :return: Dict
+        The manifest
+    """
+    if not force and is_converted(path, output_path, converter):
+        with open(output_path + ".manifest.json", "r") as f:
+            return json.load(f)
+    fingerprint = source_fingerprint(path)
+    chunks_directory = output_path + ".chunks"
+    plan = {'source': fingerprint, 'chunk_size': chunk_size, 'dtype': dtype}
+    if converter is not None:
+        plan['converter'] = converter
+    plan_path = os.path.join(chunks_directory, "plan.json")
+    if os.path.exists(plan_path):
+        with open(plan_path, "r") as f:
+            if json.load(f) != plan:
+                # The source or chunking changed, finished chunks can't be reused.
+                shutil.rmtree(chunks_directory)
+    os.makedirs(chunks_directory, exist_ok=True)
+    with open(plan_path, "w") as f:
+        json.dump(plan, f)
+
+    ranges = [(start, min(start + chunk_size, fingerprint['size'])) for start in range(0, fingerprint['size'], chunk_size)]
+    chunk_paths = [os.path.join(chunks_directory, f"{index:06d}") for index in range(len(ranges))]
+    entries = {}
+    for index, chunk_path in enumerate(chunk_paths):
+        if os.path.exists(chunk_path + ".done"):
+            with open(chunk_path + ".done", "r") as f:
+                entries[index] = json.load(f)
+    pending = [index for index in range(len(ranges)) if index not in entries]
+    if pending:
+        with ProcessPoolExecutor(num_workers, initializer=initializer, initargs=initargs) as executor, \
+                tqdm.tqdm(total=len(ranges), initial=len(entries), desc=f"Converting {os.path.basename(path)}") as pbar:
+            futures = {executor.submit(chunk_function, path, chunk_paths[index], *ranges[index], dtype): index
+                       for index in pending}
+            for future in as_completed(futures):
+                entries[futures[future]] = future.result()
+                pbar.update(1)
+
+    with IndexedTokenFileWriter(output_path, dtype=np.dtype(dtype)) as writer:
+        for index, chunk_path in enumerate(chunk_paths):
+            entries[index]['tokens_sha256'] = writer.append_file(IndexedTokenFile(chunk_path))
+    manifest = {'source': fingerprint, 'dtype': dtype, 'num_samples': writer.number_of_samples,
+                'num_tokens': writer.number_of_tokens, 'chunk_size': chunk_size,
+                'chunks': [entries[index] for index in range(len(ranges))]}
+    if converter is not None:
+        manifest['converter'] = converter
+    with open(output_path + ".manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(chunks_directory)
+    return manifest
+
+
+def convert_tokenized_file(path: typing.AnyStr, output_path: typing.AnyStr, vocab_size: int,
+                           num_workers: int = None, chunk_size: int = 1 << 26, force: bool = False) -> typing.Dict:
+    """Convert a pickled & base64 encoded .from/.to file into an indexed token file, see convert_in_chunks.
+    Args:
+        :param vocab_size: int
+            The tokenizer's vocab size, picks the token dtype
+    """
+    return convert_in_chunks(path, output_path, token_dtype(vocab_size).name, convert_tokenized_chunk,
+                             num_workers=num_workers, chunk_size=chunk_size, force=force)
+
+
+def convert_tokenized_data(data_path: typing.AnyStr, filename: typing.AnyStr, vocab_size: int,
+                           output_path: typing.AnyStr = None, num_workers: int = None, chunk_size: int = 1 << 26,
+                           force: bool = False) -> typing.Tuple[typing.Dict, typing.Dict]:
+    """Convert {data_path}{filename}.from & .to into the indexed token files {output_path}{filename}-from & -to,
+    which load_tokenized_data and DatasetDirectFromFileAPICreator then use instead of the text files.
+    See convert_tokenized_file for the arguments, output_path defaults to data_path."""
+    output_path = data_path if output_path is None else output_path
+    return tuple(convert_tokenized_file(f"{data_path}{filename}.{part}", f"{output_path}{filename}-{part}", vocab_size,
+                                        num_workers=num_workers, chunk_size=chunk_size, force=force)
+                 for part in ["from", "to"])
+
+
+def load_indexed_data(max_samples: int, data_path: typing.AnyStr, filename: typing.AnyStr,
+                      s_token: typing.List[int], e_token: typing.List[int], max_len: int = None,
+                      python_legacy: bool = False) -> \
+        typing.Optional[typing.Tuple[typing.List, typing.List] or typing.Tuple[np.ndarray, np.ndarray]]:
+    """load_tokenized_data from converted indexed token files, None if there aren't any up to date ones."""
+    paths = []
+    for part in ["from", "to"]:
+        source, output = f"{data_path}{filename}.{part}", f"{data_path}{filename}-{part}"
+        # The reader doesn't know which tokenizer converted the files, only whether the source changed since.
+        if not IndexedTokenFile.exists(output) or \
+                (os.path.exists(source) and not is_converted(source, output, any_converter=True)):
+            return None
+        paths.append(output)
+    inputs, outputs = (IndexedTokenFile(path, s_token[0], e_token[0]) for path in paths)
+    indices = np.arange(min(max_samples // 2, len(inputs), len(outputs)))
+    if python_legacy:
+        return [inputs[i].tolist() for i in indices], [outputs[i].tolist() for i in indices]
+    return inputs.batch(indices, max_len), outputs.batch(indices, max_len)
+
+
 def load_tokenized_data(max_samples: int, data_path: typing.AnyStr, filename: typing.AnyStr,
                         s_token: typing.List[int], e_token: typing.List[int], max_len: int = None,
                         python_legacy: bool = False,
@@ -106,7 +313,22 @@ def load_tokenized_data(max_samples: int, data_path: typing.AnyStr, filename: ty
         raise Exception("Can only use HTTPS with Python legacy files.")
     if not python_legacy and max_len is None:
         raise Exception("Max Length can't be none when Legacy is false.")
+    # Files written by convert_tokenized_data skip parsing the text files altogether.
+    data = None if is_https or cpp_legacy else load_indexed_data(max_samples, data_path, filename, s_token, e_token,
+                                                                 max_len=max_len, python_legacy=python_legacy)
+    if data is not None:
+        return data
+    return load_text_data(max_samples, data_path, filename, s_token, e_token, max_len=max_len,
+                          python_legacy=python_legacy, cpp_legacy=cpp_legacy, single_thread=single_thread)
+
 
+def load_text_data(max_samples: int, data_path: typing.AnyStr, filename: typing.AnyStr,
+                   s_token: typing.List[int], e_token: typing.List[int], max_len: int = None,
+                   python_legacy: bool = False,
+                   cpp_legacy=False, single_thread=True) -> \
+        typing.Tuple[typing.List[str], typing.List[str]] or typing.Tuple[np.ndarray, np.ndarray]:
+    """load_tokenized_data from the .from/.to text files (or the GavinBackendDatasetUtils .BIN files)."""
+    is_https = True if "https" in data_path else False
     if is_https:
         if not single_thread:
             with ProcessPoolExecutor(2) as executor:
@@ -178,3 +400,22 @@ def load_tokenized_data(max_samples: int, data_path: typing.AnyStr, filename: ty
             raise FileNotFoundError(
                 f"Couldn't find appropriate files for {filename} did you mean to load in python_legacy mode?")
         return inputs, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert {filename}.from/.to files into indexed token files.")
+    parser.add_argument("data_path", help="Directory (with trailing separator) holding the .from/.to files")
+    parser.add_argument("filename", help="Name of the files without the .from/.to suffix")
+    parser.add_argument("vocab_size", type=int, help="Vocab size of the tokenizer")
+    parser.add_argument("--output-path", default=None, help="Where to write the indexed files, defaults to data_path")
+    parser.add_argument("--num-workers", type=int, default=None, help="Number of processes")
+    parser.add_argument("--chunk-size", type=int, default=1 << 26, help="Bytes of the text files per chunk")
+    parser.add_argument("--force", action="store_true", help="Convert even if the files are up to date")
+    args = parser.parse_args()
+    for manifest in convert_tokenized_data(args.data_path, args.filename, args.vocab_size, output_path=args.output_path,
+                                           num_workers=args.num_workers, chunk_size=args.chunk_size, force=args.force):
+        print(f"{manifest['source']['path']}: {manifest['num_samples']} samples, {manifest['num_tokens']} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ class Precision(tf.keras.metrics.Precision):
         self.from_logits = from_logits
 
     def update_state(self, y_true, y_pred, sample_weight=None):
-        y_true = tf.reshape(y_true, shape=(-1, self.max_len))
+        y_true = tf.reshape(y_true, shape=(tf.shape(y_pred)[0], -1))
         super(Precision, self).update_state(
             y_true, y_pred if not self.from_logits else tf.argmax(y_pred, axis=2),
             sample_weight=sample_weight)
@@ -8,10 +8,13 @@ import numpy as np
 import tensorflow_datasets as tfds
 
 from .layers import PositionalEncoding, GavinMultiHeadAttention, GPUEnabledEmbedding, GavinMultiHeadPerformerAttention, \
-    FourierTransformationLayer, MultiHeadPerformerReluAttention, RotaryPositionalEncoding, PaddingMaskLayer, LookAheadMaskLayer
-from .utils import tf
-from .preprocessing.text import preprocess_sentence
-from .callbacks import PredictCallback, AttentionImageLoggingCallback
+    FourierTransformationLayer, MultiHeadPerformerReluAttention, PaddingMaskLayer, LookAheadMaskLayer, \
+    SegmentPaddingMaskLayer, SegmentLookAheadMaskLayer, QuantizableDense
+from .utils import tf, PhaseTimer
+from .preprocessing.tokenization import TokenizationEngine
+from .decoding import Decoder, GreedyDecoder
+from .serving import ServingModule
+from .callbacks import PredictCallback, AttentionImageLoggingCallback, FeatureRedrawCallback
 from .metrics import Perplexity
 
 
@@ -48,13 +51,22 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
 
 class TransformerAbstract(abc.ABC):
     custom_objects = {'loss_function': 'GavinCore>loss_function'}
+    # Whether decode_state/decode_logits implement key/value cached decoding.
+    incremental_decoding = False
+    # Whether the model is always fed max_len tokens and predicts from the last position.
+    fixed_length_decoding = False
+    # Whether the encoder is always fed max_len tokens, because it doesn't mask the padding.
+    fixed_length_inputs = False
+    # Whether the model can be trained on packed inputs, see packed_inputs.
+    supports_packed_inputs = False
 
     def __init__(self, num_layers: int, units: int, d_model: int, num_heads: int, dropout: float, batch_size: int,
                  max_len: int, base_log_dir: typing.AnyStr, tokenizer: tfds.deprecated.text.SubwordTextEncoder = None,
                  name: typing.AnyStr = "transformer", mixed: bool = False, epochs: int = 0,
                  warmup_steps_learning_rate: int = 4000,
                  save_freq: typing.Union[int, typing.AnyStr] = 'epoch',
-                 metadata=None, strategy=None, **kwargs):
+                 metadata=None, strategy=None, decoding_strategy: Decoder = None, packed_inputs: bool = False,
+                 inference_only: bool = False, attention_block_size: int = None, **kwargs):
         """
         Abstract class to define functions needed by all Transformer architecture.
         Args:
@@ -91,7 +103,20 @@ class TransformerAbstract(abc.ABC):
             :param metrics: typing.Dict
                 Key should be your metric, and the value should be a tuple.
                 The metrics the model should call back to.
+            :param decoding_strategy: Decoder
+                How evaluate/predict decode replies, defaults to GreedyDecoder
+            :param packed_inputs: bool
+                Train on rows packing several samples, the model takes 'inputs_segments' & 'dec_segments'
+                segment ids and tokens only attend within their segment, see DatasetAPICreator.pack_samples.
+            :param inference_only: bool
+                For serving, uses the default strategy instead of creating a MirroredStrategy, doesn't create the log
+                directories and builds the model lazily (setup_model), the model can't be trained.
+            :param attention_block_size: int
+                Compute softmax attention over blocks of this many keys (see blockwise_attention), so its memory
+                grows linearly with max_len instead of quadratically, with the same results.
         """
+        if packed_inputs and not self.supports_packed_inputs:
+            raise ValueError(f"{type(self).__name__} can't mask attention between segments, so it can't use packed_inputs.")
         self.num_layers = num_layers
         self.units = units
         self.d_model = d_model
@@ -100,22 +125,30 @@ class TransformerAbstract(abc.ABC):
         self.max_len = max_len
         self.tokenizer = tokenizer
         self.start_token, self.end_token = [self.tokenizer.vocab_size + 1], [self.tokenizer.vocab_size + 2]
+        self.tokenization_engine = TokenizationEngine(self.tokenizer)
         self.vocab_size = self.tokenizer.vocab_size + 2
         self.default_dtype = tf.float32 if not mixed else tf.float16
         self.save_freq = save_freq
         self.batch_size = batch_size
         self.warmup_steps = warmup_steps_learning_rate
         self.model = None
+        self.decode_functions = {}
+        self.decoding_strategy = GreedyDecoder() if decoding_strategy is None else decoding_strategy
+        self.packed_inputs = packed_inputs
+        self.inference_only = inference_only
+        self.quantized = False
+        self.attention_block_size = attention_block_size
 
         self.name = name
         self.log_dir = os.path.join(base_log_dir, self.name)
 
-        dirs_needed = ['images', 'tokenizer', 'config']
-        if not os.path.exists(self.log_dir):
-            os.mkdir(self.log_dir)
-        for dir_needed in dirs_needed:
-            if not os.path.exists(os.path.join(self.log_dir, dir_needed)):
-                os.mkdir(os.path.join(self.log_dir, dir_needed))
+        if not inference_only:
+            dirs_needed = ['images', 'tokenizer', 'config']
+            if not os.path.exists(self.log_dir):
+                os.mkdir(self.log_dir)
+            for dir_needed in dirs_needed:
+                if not os.path.exists(os.path.join(self.log_dir, dir_needed)):
+                    os.mkdir(os.path.join(self.log_dir, dir_needed))
 
         self.config = {
             'NUM_LAYERS': self.num_layers,
@@ -131,11 +164,18 @@ class TransformerAbstract(abc.ABC):
             'SAVE_FREQ': save_freq,
             'BATCH_SIZE': batch_size
         }
+        if packed_inputs:
+            self.config['PACKED_INPUTS'] = True
+        if attention_block_size:
+            self.config['ATTENTION_BLOCK_SIZE'] = attention_block_size
         if metadata is None:
             metadata = {}
         self.metadata = metadata
 
-        self.strategy = tf.distribute.MirroredStrategy() if strategy is None else strategy
+        if strategy is None:
+            # Creating a MirroredStrategy enumerates the devices & sets up cross device ops, serving doesn't need it.
+            strategy = tf.distribute.get_strategy() if inference_only else tf.distribute.MirroredStrategy()
+        self.strategy = strategy
 
         with self.strategy.scope():
             self.scce = tf.keras.losses.SparseCategoricalCrossentropy(
@@ -193,6 +233,10 @@ class TransformerAbstract(abc.ABC):
         """Return Start and End Tokens."""
         return self.start_token, self.end_token
 
+    def get_max_positions(self) -> int:
+        """Longest input the model is built for, the decoder's output buffer holds the start token & max_len tokens."""
+        return self.max_len + 1
+
     def get_optimizer(self) -> tf.keras.optimizers.Adam:
         learning_rate = CustomSchedule(self.d_model, warmup_steps=self.warmup_steps)
         return tf.keras.optimizers.Adam(learning_rate, beta_1=0.91, beta_2=0.98, epsilon=1e-9, clipnorm=5.0)
@@ -209,7 +253,11 @@ class TransformerAbstract(abc.ABC):
 
     @tf.keras.utils.register_keras_serializable(package='GavinCore')
     def loss_function(self, y_true, y_pred) -> tf.Tensor:
-        y_true = tf.reshape(y_true, shape=(-1, self.max_len))
+        """Sparse categorical crossentropy over the non padding targets.
+        Packed rows are shifted for teacher forcing per segment (see DatasetAPICreator.pack_samples), so the last
+        position of a segment targets padding rather than the next segment, and is masked like padding."""
+        # batches may be padded to less than max_len, so only the batch size is taken from y_pred
+        y_true = tf.reshape(y_true, shape=(tf.shape(y_pred)[0], -1))
 
         loss = self.scce(tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32))
         mask = tf.cast(tf.not_equal(y_true, 0), tf.float32)
@@ -217,42 +265,217 @@ class TransformerAbstract(abc.ABC):
 
         return tf.reduce_mean(loss)
 
-    def evaluate(self, sentence: typing.AnyStr) -> tf.Tensor:
+    def tokenize_batch(self, sentences: typing.List[typing.AnyStr], max_len: int = None) -> tf.Tensor:
+        """Preprocess & tokenize sentences, adding the start and end tokens.
+        Args:
+            :param sentences: List[str]
+                The raw input sentences
+            :param max_len: int
+                Length to pad (or truncate) every row to, defaults to the longest sentence
+        :return: tf.Tensor
+            Token ids padded with 0s (batch_size, sequence_length)
+        """
+        sentences = [self.start_token + tokens + self.end_token for tokens in self.tokenization_engine.encode_batch(sentences)]
+        return tf.convert_to_tensor(tf.keras.preprocessing.sequence.pad_sequences(sentences, maxlen=max_len, padding='post'),
+                                    dtype=tf.int32)
+
+    def model_inputs(self, sentences: tf.Tensor, output: tf.Tensor) -> typing.List[tf.Tensor]:
+        """Inputs of self.model for unpacked sentences, packed models see every row as a single segment."""
+        if not self.packed_inputs:
+            return [sentences, output]
+        return [sentences, output, tf.cast(tf.not_equal(sentences, 0), tf.int32), tf.cast(tf.not_equal(output, 0), tf.int32)]
+
+    def decode_state(self, sentences: tf.Tensor, buffer_length: int, use_cache: bool = True) -> typing.Dict:
+        """State carried between decode steps, e.g. key/value caches. Empty when the model is re-run every step."""
+        return {}
+
+    def decode_logits(self, sentences: tf.Tensor, output: tf.Tensor, step: tf.Tensor,
+                      state: typing.Dict) -> typing.Tuple[tf.Tensor, typing.Dict]:
+        """Predict the logits of the token following position step.
+        Args:
+            :param sentences: tf.Tensor
+                Tokenized sentences (batch_size, sequence_length)
+            :param output: tf.Tensor
+                The fixed size buffer of decoded tokens, padded with 0s after step
+            :param step: tf.Tensor
+                The position of the newest decoded token
+            :param state: Dict
+                The state from decode_state
+        :return: Tuple[tf.Tensor, Dict]
+            Logits (batch_size, vocab_size) and the updated state
+        """
+        predictions = self.model(inputs=self.model_inputs(sentences, output), training=False)
+        if self.fixed_length_decoding:
+            # Fixed length models see the whole padded buffer and predict from the last position.
+            return predictions[:, -1, :], state
+        # The look ahead mask hides the padding after step, so this matches running on output[:, :step + 1].
+        return tf.gather(predictions, step, axis=1), state
+
+    def decode(self, sentences: tf.Tensor, decoding_strategy: Decoder = None,
+               use_cache: bool = True) -> typing.Tuple[tf.Tensor, tf.Tensor]:
+        """Decode replies to tokenized sentences with decoding_strategy, see Decoder.decode.
+        Args:
+            :param sentences: tf.Tensor
+                Tokenized sentences (batch_size, sequence_length)
+            :param decoding_strategy: Decoder
+                The decoding strategy, defaults to self.decoding_strategy
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+        :return: Tuple[tf.Tensor, tf.Tensor]
+            The output buffer and the number of decoded positions in it
+        """
+        decoding_strategy = self.decoding_strategy if decoding_strategy is None else decoding_strategy
+        return decoding_strategy.decode(self, sentences, use_cache=use_cache)
+
+    def get_decode_function(self, decoding_strategy: Decoder = None, use_cache: bool = True,
+                            jit_compile: bool = False) -> tf.types.experimental.GenericFunction:
+        """decode compiled with tf.function (and XLA when jit_compile), traced once per model and decoding strategy."""
+        decoding_strategy = self.decoding_strategy if decoding_strategy is None else decoding_strategy
+        key = (id(self.model), decoding_strategy, use_cache, jit_compile)
+        if key not in self.decode_functions:
+            self.decode_functions[key] = tf.function(
+                lambda sentences: self.decode(sentences, decoding_strategy=decoding_strategy, use_cache=use_cache),
+                input_signature=[tf.TensorSpec(shape=(None, None), dtype=tf.int32)],
+                jit_compile=jit_compile)
+        return self.decode_functions[key]
+
+    def evaluate(self, sentence: typing.AnyStr, use_cache: bool = True, compiled: bool = True,
+                 jit_compile: bool = False, decoding_strategy: Decoder = None) -> tf.Tensor:
+        """Decode a reply to sentence.
+        Args:
+            :param sentence: str
+                The raw input sentence
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+            :param compiled: bool
+                Run the decode loop as a single tf.function graph instead of eagerly.
+            :param jit_compile: bool
+                Compile the decode loop with XLA.
+            :param decoding_strategy: Decoder
+                Greedy, beam search or sampling, defaults to self.decoding_strategy
+        :return: tf.Tensor
+            The predicted token ids, starting with the start token
+        """
+        return tf.squeeze(self.evaluate_batch([sentence], use_cache=use_cache, compiled=compiled, jit_compile=jit_compile,
+                                              decoding_strategy=decoding_strategy), axis=0)
+
+    def evaluate_batch(self, sentences: typing.List[typing.AnyStr], use_cache: bool = True, compiled: bool = True,
+                       jit_compile: bool = False, decoding_strategy: Decoder = None) -> tf.Tensor:
+        """Decode replies to all sentences together, stops once every row has predicted the end token.
+        Args:
+            :param sentences: List[str]
+                The raw input sentences
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+            :param compiled: bool
+                Run the decode loop as a single tf.function graph instead of eagerly.
+            :param jit_compile: bool
+                Compile the decode loop with XLA, inputs are padded (or truncated) to max_len.
+            :param decoding_strategy: Decoder
+                Greedy, beam search or sampling, defaults to self.decoding_strategy
+        :return: tf.Tensor
+            The predicted token ids (batch_size, sequence_length), starting with the start token,
+            rows which finished early are padded with 0s
+        """
         if self.model is None:
             self.setup_model()
-        sentence = preprocess_sentence(sentence)
-
-        sentence = tf.expand_dims(self.start_token + self.tokenizer.encode(sentence) + self.end_token, axis=0)
-
-        output = tf.expand_dims(self.start_token, 0)
-
-        for i in range(self.max_len):
-            predictions = self.model(inputs=[sentence, output], training=False)
-
-            # select the last word from the seq length dimension
-            predictions = predictions[:, -1:, :]
-            predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
-
-            if tf.equal(predicted_id, self.end_token[0]):
-                break
-
-            # concatenated the predicted_id to the output which is given the decoder
-            # as its input
-            output = tf.concat([output, predicted_id], axis=-1)
-        return tf.squeeze(output, axis=0)
+        # XLA compiles once per input shape, so its inputs are padded to max_len like the fixed length models.
+        sentences = self.tokenize_batch(sentences, max_len=self.max_len if self.fixed_length_inputs or jit_compile else None)
+        if compiled or jit_compile:
+            output, length = self.get_decode_function(decoding_strategy=decoding_strategy, use_cache=use_cache,
+                                                      jit_compile=jit_compile)(sentences)
+        else:
+            output, length = self.decode(sentences, decoding_strategy=decoding_strategy, use_cache=use_cache)
+        return output[:, :length]
 
     def accuracy(self, y_true, y_pred) -> tf.Tensor:
-        # ensure labels have shape (batch_size, MAX_LENGTH)
-        y_true = tf.reshape(y_true, shape=(-1, self.max_len))
+        # ensure labels have shape (batch_size, sequence_length)
+        y_true = tf.reshape(y_true, shape=(tf.shape(y_pred)[0], -1))
         return tf.metrics.SparseCategoricalAccuracy()(y_true, y_pred)
 
-    def predict(self, sentence: str) -> typing.AnyStr:
-        prediction = self.evaluate(sentence)
+    def predict(self, sentence: str, decoding_strategy: Decoder = None) -> typing.AnyStr:
+        prediction = self.evaluate(sentence, decoding_strategy=decoding_strategy)
 
         predicated_sentence = self.tokenizer.decode([i for i in prediction if i < self.tokenizer.vocab_size])
 
         return predicated_sentence
 
+    def predict_batch(self, sentences: typing.List[str], decoding_strategy: Decoder = None) -> typing.List[typing.AnyStr]:
+        """Predict replies for many sentences with batched decoding."""
+        predictions = self.evaluate_batch(sentences, decoding_strategy=decoding_strategy)
+
+        return [self.tokenizer.decode([i for i in prediction if i < self.tokenizer.vocab_size])
+                for prediction in predictions.numpy()]
+
+    def export_serving_model(self, export_dir: typing.AnyStr = None, decoding_strategy: Decoder = None,
+                             use_cache: bool = True, jit_compile: bool = False) -> typing.AnyStr:
+        """Save a SavedModel whose serving_default signature maps raw sentences to replies, like predict_batch,
+        with normalisation, tokenization, decoding & detokenisation all in graph, see ServingModule.
+        It runs under TF Serving or tf.saved_model.load without this class, the tokenizer or Keras.
+        Args:
+            :param export_dir: str
+                Where to save it, defaults to {log_dir}/serving/1 (TF Serving expects numbered versions)
+            :param decoding_strategy: Decoder
+                The decoding strategy, defaults to self.decoding_strategy
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+            :param jit_compile: bool
+                Compile the decode loop with XLA.
+        :return: str
+            export_dir
+        """
+        if self.model is None:
+            self.setup_model()
+        export_dir = os.path.join(self.log_dir, 'serving', '1') if export_dir is None else export_dir
+        module = ServingModule(self, decoding_strategy=decoding_strategy, use_cache=use_cache, jit_compile=jit_compile)
+        tf.saved_model.save(module, export_dir, signatures={'serving_default': module.serve})
+        return export_dir
+
+    def quantize(self) -> None:
+        """Post training int8 quantisation of an inference_only model, the Dense kernels (attention, feed forward &
+        output projection) get a scale per output unit and the embedding tables a scale per token,
+        see QuantizableDense.quantize. Compare it against the float model with quantization_report.
+        """
+        if not self.inference_only:
+            raise ValueError("Quantised weights can't be trained, only inference_only models can be quantised.")
+        if self.model is None:
+            self.setup_model()
+        for layer in self.model.submodules:
+            if isinstance(layer, (QuantizableDense, GPUEnabledEmbedding)):
+                layer.quantize()
+        # The traced decode functions captured the float weights.
+        self.decode_functions = {}
+        self.quantized = True
+
+    def export_tflite(self, path: typing.AnyStr = None, decoding_strategy: Decoder = None,
+                      use_cache: bool = True) -> typing.AnyStr:
+        """Convert the compiled decode loop to TFLite for CPU serving, token ids in, output buffer & its length out,
+        like get_decode_function, tokenization is left to the caller, see load_tflite_model.
+        Weights are stored as int8, the int8 weights of a quantized model or the converter's own (dynamic range)
+        quantisation of a float model. Ops without a TFLite kernel run as TensorFlow select ops.
+        Args:
+            :param path: str
+                Where to write the .tflite file, defaults to {log_dir}/tflite/model.tflite
+            :param decoding_strategy: Decoder
+                The decoding strategy, defaults to self.decoding_strategy
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+        :return: str
+            path
+        """
+        if self.model is None:
+            self.setup_model()
+        path = os.path.join(self.log_dir, 'tflite', 'model.tflite') if path is None else path
+        function = self.get_decode_function(decoding_strategy=decoding_strategy, use_cache=use_cache)
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()], self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        tflite_model = converter.convert()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(tflite_model)
+        return path
+
     def compile(self) -> None:
         """Compile the model attribute to allow for training."""
         self.model.compile(optimizer=self.get_optimizer(), loss=self.loss_function, metrics=self.metrics)
@@ -275,36 +498,74 @@ class TransformerAbstract(abc.ABC):
         self.write_embeddings()
 
     @classmethod
-    def load_model(cls, models_path, model_name):
-        file = open(os.path.join(os.path.join(models_path, model_name), os.path.join('config', 'config.json')))
-        # Prep the hparams for loading.
-        hparams = json.load(file)
-        file.close()
-        tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
-            os.path.join(models_path, os.path.join(model_name, f'tokenizer/{model_name}_tokenizer')))
-        hparams['TOKENIZER'] = tokenizer
+    def load_hparams(cls, models_path: typing.AnyStr, model_name: typing.AnyStr) -> typing.Dict:
+        """The constructor arguments saved by save_hparams, without the tokenizer."""
+        with open(os.path.join(os.path.join(models_path, model_name), os.path.join('config', 'config.json'))) as file:
+            hparams = json.load(file)
         hparams = {k.lower(): v for k, v in hparams.items()}
         hparams['max_len'] = hparams['max_length']
         hparams['name'] = hparams['model_name']
         hparams['mixed'] = hparams['float16']
         hparams['base_log_dir'] = models_path
-        del hparams['max_length'], hparams['model_name'], hparams['float16']
+        del hparams['max_length'], hparams['model_name'], hparams['float16'], hparams['tokenizer']
+        return hparams
 
-        base = cls(**hparams)
-        if glob.glob(os.path.join(base.log_dir, 'cp.ckpt.*')) or os.path.exists(os.path.join(base.log_dir, 'cp.ckpt')):
-            base.get_model().load_weights(os.path.join(base.log_dir, 'cp.ckpt')).expect_partial()
-            return base
-        else:
-            if os.path.exists(os.path.join(base.log_dir, 'saved_model')):
-                base.model = tf.keras.models.load_model(os.path.join(base.log_dir, 'saved_model'), custom_objects=cls.custom_objects)
-                return base
-            raise FileNotFoundError(f'No weights found for model {model_name}, with path {os.path.join(base.log_dir, "cp.ckpt")}')
+    @classmethod
+    def load_model(cls, models_path, model_name, inference_only: bool = False, warmup: bool = False,
+                   quantize: bool = False, **kwargs):
+        """Load a saved model, the seconds spent in every phase of the load are in its startup_timings.
+        Weights are restored from the cp.ckpt checkpoint, or straight from the variables of the saved_model
+        directory into the built model, which is much faster than loading the SavedModel with Keras.
+        Args:
+            :param models_path: str
+                The models' directory
+            :param model_name: str
+                Name of the model
+            :param inference_only: bool
+                Load for serving, see the inference_only argument of the constructor
+            :param warmup: bool
+                Trace the compiled decode loop with one prediction, so the first request doesn't pay for it
+            :param quantize: bool
+                Quantise the weights to int8 once loaded, see quantize, needs inference_only
+            :param kwargs:
+                Overrides of the saved constructor arguments
+        """
+        timer = PhaseTimer()
+        with timer.phase('config'):
+            hparams = cls.load_hparams(models_path, model_name)
+        with timer.phase('tokenizer'):
+            hparams['tokenizer'] = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
+                os.path.join(models_path, os.path.join(model_name, f'tokenizer/{model_name}_tokenizer')))
+        hparams.update(kwargs, inference_only=inference_only)
+        with timer.phase('construct'):
+            base = cls(**hparams)
+
+        checkpoint = os.path.join(base.log_dir, 'cp.ckpt')
+        if not (glob.glob(checkpoint + '.*') or os.path.exists(checkpoint)):
+            checkpoint = os.path.join(base.log_dir, 'saved_model', 'variables', 'variables')
+            if not glob.glob(checkpoint + '.*'):
+                raise FileNotFoundError(f'No weights found for model {model_name}, with path {os.path.join(base.log_dir, "cp.ckpt")}')
+        with timer.phase('build'):
+            if base.model is None:
+                base.setup_model()
+        with timer.phase('weights'):
+            base.get_model().load_weights(checkpoint).expect_partial()
+        if quantize:
+            with timer.phase('quantize'):
+                base.quantize()
+        if warmup:
+            with timer.phase('warmup'):
+                base.evaluate_batch([""])
+        base.startup_timings = timer.report()
+        return base
 
     def fit(self, training_dataset: tf.data.Dataset, epochs: int,
             callbacks: typing.List = None, validation_dataset: tf.data.Dataset = None,
             **kwargs) -> tf.keras.callbacks.History:
         """Call .fit() on the model attribute.
         Runs the train sequence for the model"""
+        if self.inference_only:
+            raise ValueError(f"{self.name} was created inference only, so it can't be trained.")
         with self.strategy.scope():
             self.setup_model()
             self.compile()
@@ -332,6 +593,11 @@ class TransformerIntegration(TransformerAbstract):
     Based off paper: https://arxiv.org/pdf/1706.03762.pdf
     ...
     """
+    incremental_decoding = True
+    supports_packed_inputs = True
+    # Positions are given by rotating the query & key of self attention (rotary embeddings)
+    # instead of adding a PositionalEncoding to the embeddings.
+    rotary_embeddings = False
 
     def __init__(self, num_layers: int, units: int, d_model: int, num_heads: int, dropout: float, batch_size: int,
                  max_len: int, base_log_dir: typing.AnyStr, tokenizer: tfds.deprecated.text.SubwordTextEncoder = None,
@@ -352,25 +618,38 @@ class TransformerIntegration(TransformerAbstract):
         self.default_dtype = tf.float32 if not mixed else tf.float16
         self.model = None  # This is set later
 
-        # Create the tensorflow model
-        self.setup_model()
+        # Create the tensorflow model, inference only models are built when they are first needed
+        if not self.inference_only:
+            self.setup_model()
 
     def setup_model(self):
         inputs = tf.keras.Input(shape=(None,), name="inputs")
         dec_inputs = tf.keras.Input(shape=(None,), name="dec_inputs")
-
-        enc_padding_mask = PaddingMaskLayer(name="enc_padding_mask")(inputs)
-        look_ahead_mask = LookAheadMaskLayer(name="look_ahead_mask")(dec_inputs)
-        dec_padding_mask = PaddingMaskLayer(name="dec_padding_mask")(inputs)
+        model_inputs = [inputs, dec_inputs]
+
+        if self.packed_inputs:
+            inputs_segments = tf.keras.Input(shape=(None,), name="inputs_segments")
+            dec_segments = tf.keras.Input(shape=(None,), name="dec_segments")
+            model_inputs += [inputs_segments, dec_segments]
+            enc_padding_mask = SegmentPaddingMaskLayer(name="enc_padding_mask")({'query_segments': inputs_segments,
+                                                                                 'key_segments': inputs_segments})
+            look_ahead_mask = SegmentLookAheadMaskLayer(name="look_ahead_mask")(dec_segments)
+            dec_padding_mask = SegmentPaddingMaskLayer(name="dec_padding_mask")({'query_segments': dec_segments,
+                                                                                 'key_segments': inputs_segments})
+        else:
+            enc_padding_mask = PaddingMaskLayer(name="enc_padding_mask")(inputs)
+            look_ahead_mask = LookAheadMaskLayer(name="look_ahead_mask")(dec_inputs)
+            # the decoder attends over the same encoder inputs, so it shares their padding mask
+            dec_padding_mask = enc_padding_mask
 
         enc_outputs = self.encoder()(inputs=[inputs, enc_padding_mask])
 
         dec_outputs = self.decoder()(inputs=[dec_inputs, enc_outputs, look_ahead_mask, dec_padding_mask])
 
-        outputs = tf.keras.layers.Dense(units=self.vocab_size, dtype=tf.float32)(dec_outputs)
+        outputs = QuantizableDense(units=self.vocab_size, dtype=tf.float32)(dec_outputs)
         outputs = tf.keras.layers.Activation('linear', dtype='float32', name="outputs")(outputs)
 
-        self.model = tf.keras.Model(inputs=[inputs, dec_inputs], outputs=outputs, name=self.name)
+        self.model = tf.keras.Model(inputs=model_inputs, outputs=outputs, name=self.name)
 
     def encoder_layer(self, name: str = "encoder_layer") -> tf.keras.Model:
         """Encoder Layer
@@ -379,20 +658,22 @@ class TransformerIntegration(TransformerAbstract):
                 The name for the layer, returned in model.summary()
         """
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
+        padding_mask = tf.keras.Input(shape=(1, None, None), name="padding_mask", dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         attention = GavinMultiHeadAttention(
-            self.d_model, self.num_heads, name="attention")({'query': inputs,
-                                                             'key': inputs,
-                                                             'value': inputs,
-                                                             'mask': padding_mask})
+            self.d_model, self.num_heads, name="attention", fused_qkv=True,
+            block_size=self.attention_block_size,
+            rotary_positions=self.get_rotary_positions())({'query': inputs,
+                                                           'key': inputs,
+                                                           'value': inputs,
+                                                           'mask': padding_mask})
         attention = tf.keras.layers.Dropout(rate=self.dropout)(attention)
         attention = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(inputs + attention)
 
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention + outputs)
@@ -400,22 +681,117 @@ class TransformerIntegration(TransformerAbstract):
         return tf.keras.Model(
             inputs=[inputs, padding_mask], outputs=outputs, name=name)
 
+    def get_rotary_positions(self) -> typing.Optional[int]:
+        """rotary_positions of the self attention layers, None without rotary embeddings."""
+        return self.get_max_positions() if self.rotary_embeddings else None
+
+    def positional_encoding(self, embeddings: tf.Tensor, attention_mask: tf.Tensor) -> tf.Tensor:
+        """Add the PositionalEncoding to the embeddings of the encoder or decoder,
+        rotary models leave them as they are, their positions are applied by the attention layers."""
+        if self.rotary_embeddings:
+            return embeddings
+        # noinspection PyCallingNonCallable
+        return PositionalEncoding(self.get_max_positions(), self.d_model)(
+            embeddings, attention_mask=attention_mask if self.packed_inputs else None)
+
+    def decoder_blocks(self) -> typing.Dict:
+        """Collect the layers of the decoder sub model, so the decoder can be stepped
+        one token at a time by decode_step, reusing the trained weights."""
+        decoder = self.model.get_layer('decoder')
+        positional_encodings = [layer for layer in decoder.layers if isinstance(layer, PositionalEncoding)]
+        blocks = {'embedding': [layer for layer in decoder.layers if isinstance(layer, GPUEnabledEmbedding)][0],
+                  'positional_encoding': positional_encodings[0] if positional_encodings else None,
+                  'layers': [],
+                  'final_dense': [layer for layer in self.model.layers if isinstance(layer, tf.keras.layers.Dense)][-1],
+                  'final_activation': self.model.get_layer('outputs')}
+        for i in range(self.num_layers):
+            decoder_layer = decoder.get_layer('decoder_layer_{}'.format(i))
+            attention = [layer for layer in decoder_layer.layers if isinstance(layer, GavinMultiHeadAttention)]
+            norms = [layer for layer in decoder_layer.layers if isinstance(layer, tf.keras.layers.LayerNormalization)]
+            dense = [layer for layer in decoder_layer.layers if isinstance(layer, tf.keras.layers.Dense)]
+            blocks['layers'].append({'attention_1': attention[0], 'attention_2': attention[1], 'norms': norms, 'dense': dense})
+        return blocks
+
+    def decode_step(self, dec_inputs: tf.Tensor, enc_padding_mask: tf.Tensor, look_ahead_mask: tf.Tensor,
+                    caches: typing.List[typing.Dict], position: tf.Tensor, blocks: typing.Dict = None) -> tf.Tensor:
+        """Run the decoder on the newest token only, the keys & values of previous tokens come from caches.
+        Args:
+            :param dec_inputs: tf.Tensor
+                The newest decoder token (batch_size, 1)
+            :param enc_padding_mask: tf.Tensor
+                Padding mask of the encoder inputs
+            :param look_ahead_mask: tf.Tensor
+                Mask for the self attention over the cached positions
+            :param caches: List[Dict]
+                One {'attention_1': cache, 'attention_2': cache} dict per decoder layer, updated in place
+            :param position: tf.Tensor
+                Position of the new token
+            :param blocks: Dict
+                The output of decoder_blocks, looked up when None
+        :return: tf.Tensor
+            Logits for the new token (batch_size, 1, vocab_size)
+        """
+        blocks = self.decoder_blocks() if blocks is None else blocks
+        embeddings = blocks['embedding'](dec_inputs)
+        embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
+        embeddings = tf.cast(embeddings, self.default_dtype)
+        if blocks['positional_encoding'] is not None:
+            outputs = blocks['positional_encoding'](embeddings, position=position)
+        else:
+            outputs = embeddings
+
+        for block, cache in zip(blocks['layers'], caches):
+            attention1 = block['attention_1']({'query': outputs,
+                                               'key': outputs,
+                                               'value': outputs,
+                                               'mask': look_ahead_mask}, cache=cache['attention_1'], decode_step=position)
+            attention1 = block['norms'][0](attention1 + outputs)
+            attention2 = block['attention_2']({'query': attention1,
+                                               'key': None,
+                                               'value': None,
+                                               'mask': enc_padding_mask}, cache=cache['attention_2'])
+            attention2 = block['norms'][1](attention2 + attention1)
+            outputs = block['dense'][1](block['dense'][0](attention2))
+            outputs = block['norms'][2](outputs + attention2)
+
+        return blocks['final_activation'](blocks['final_dense'](outputs))
+
+    def decode_state(self, sentences: tf.Tensor, buffer_length: int, use_cache: bool = True) -> typing.Dict:
+        """Runs the encoder once and creates the key/value caches of every decoder layer."""
+        if not (use_cache and self.incremental_decoding):
+            return TransformerAbstract.decode_state(self, sentences, buffer_length, use_cache=use_cache)
+        batch_size = tf.shape(sentences)[0]
+        # A sentence is a single segment, so packed models mask it like unpacked ones.
+        enc_padding_mask = PaddingMaskLayer()(sentences)
+        enc_outputs = self.model.get_layer('encoder')(inputs=[sentences, enc_padding_mask], training=False)
+        caches = [{'attention_1': block['attention_1'].initial_cache(batch_size, length=buffer_length),
+                   'attention_2': block['attention_2'].initial_cache(batch_size, key=enc_outputs, value=enc_outputs)}
+                  for block in self.decoder_blocks()['layers']]
+        return {'enc_padding_mask': enc_padding_mask, 'caches': caches}
+
+    def decode_logits(self, sentences: tf.Tensor, output: tf.Tensor, step: tf.Tensor,
+                      state: typing.Dict) -> typing.Tuple[tf.Tensor, typing.Dict]:
+        """Only feeds the newest token through the decoder when decode_state holds key/value caches."""
+        if not state:
+            return TransformerAbstract.decode_logits(self, sentences, output, step, state)
+        # Padding mask over the buffer, hides the positions not decoded yet like the look ahead mask would.
+        look_ahead_mask = self.model.get_layer('look_ahead_mask').padding_mask(output)
+        predictions = self.decode_step(tf.gather(output, step, axis=1)[:, tf.newaxis], state['enc_padding_mask'], look_ahead_mask,
+                                       state['caches'], position=step)
+        return predictions[:, -1, :], state
+
     def create_padding_mask(self, x) -> tf.keras.Model:
         """Create a padding mask
 
         Mask the outputs for attention layers"""
-        mask = tf.cast(tf.math.equal(x, 0), self.default_dtype)
         # batch_size, 1, 1, sequence_length
-        return mask[:, tf.newaxis, tf.newaxis, :]
+        return PaddingMaskLayer()(x)
 
     def create_look_ahead_mask(self, x) -> tf.Tensor:
         """Create a Look Ahead mask
 
         Allows to "look" ahead into the sentence and make predictions based on that."""
-        seq_len = tf.shape(x)[1]
-        look_ahead_mask = 1 - tf.linalg.band_part(tf.ones((seq_len, seq_len), dtype=self.default_dtype), -1, 0)
-        padding_mask = self.create_padding_mask(x)
-        return tf.maximum(look_ahead_mask, padding_mask)
+        return LookAheadMaskLayer()(x)
 
     def encoder(self, name: str = 'encoder') -> tf.keras.Model:
         """Encoder Sub Model
@@ -425,14 +801,13 @@ class TransformerIntegration(TransformerAbstract):
                 The name for the sub model
         """
         inputs = tf.keras.Input(shape=(None,), name="inputs")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
+        padding_mask = tf.keras.Input(shape=(1, None, None), name="padding_mask", dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, name="Embedding_Encoder")(inputs)
         embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
         embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = PositionalEncoding(self.vocab_size, self.d_model)(embeddings)
+        embeddings = self.positional_encoding(embeddings, attention_mask=padding_mask)
 
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
 
@@ -453,30 +828,33 @@ class TransformerIntegration(TransformerAbstract):
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
         enc_outputs = tf.keras.Input(shape=(None, self.d_model), name="encoder_outputs", dtype=self.default_dtype)
         look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name="look_ahead_mask")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
+            shape=(1, None, None), name="look_ahead_mask", dtype=tf.bool)
+        padding_mask = tf.keras.Input(shape=(1, None, None), name='padding_mask', dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         attention1 = GavinMultiHeadAttention(
-            self.d_model, self.num_heads, name="attention_1")(inputs={'query': inputs,
-                                                                      'key': inputs,
-                                                                      'value': inputs,
-                                                                      'mask': look_ahead_mask})
+            self.d_model, self.num_heads, name="attention_1", fused_qkv=True,
+            block_size=self.attention_block_size,
+            rotary_positions=self.get_rotary_positions())(inputs={'query': inputs,
+                                                                  'key': inputs,
+                                                                  'value': inputs,
+                                                                  'mask': look_ahead_mask})
         attention1 = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention1 + inputs)
 
         # noinspection PyCallingNonCallable
         attention2 = GavinMultiHeadAttention(
-            self.d_model, self.num_heads, name="attention_2")(inputs={'query': attention1,
-                                                                      'key': enc_outputs,
-                                                                      'value': enc_outputs,
-                                                                      'mask': padding_mask})
+            self.d_model, self.num_heads, name="attention_2",
+            block_size=self.attention_block_size)(inputs={'query': attention1,
+                                                          'key': enc_outputs,
+                                                          'value': enc_outputs,
+                                                          'mask': padding_mask})
         attention2 = tf.keras.layers.Dropout(rate=self.dropout)(attention2)
         attention2 = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention2 + attention1)
 
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention2)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention2)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(outputs + attention2)
@@ -495,15 +873,14 @@ class TransformerIntegration(TransformerAbstract):
         inputs = tf.keras.Input(shape=(None,), name='inputs')
         enc_outputs = tf.keras.Input(shape=(None, self.d_model), name='encoder_outputs')
         look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name='look_ahead_mask')
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
+            shape=(1, None, None), name='look_ahead_mask', dtype=tf.bool)
+        padding_mask = tf.keras.Input(shape=(1, None, None), name='padding_mask', dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, name="Embedding_Decoder")(inputs)
         embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
         embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = PositionalEncoding(self.vocab_size, self.d_model)(embeddings)
+        embeddings = self.positional_encoding(embeddings, attention_mask=look_ahead_mask)
 
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
 
@@ -521,64 +898,10 @@ class RotaryTransformerIntegration(TransformerIntegration):
     """
     Transformer Integration with Rotary Positional Encoding, as described in
     https://arxiv.org/pdf/2104.09864.pdf
+    The query & key of every self attention layer are rotated by the angles of their positions,
+    including the cached keys of incremental decoding, see GavinMultiHeadAttention.rotary_embedding.
     """
-
-    def encoder(self, name: str = 'encoder') -> tf.keras.Model:
-        """Encoder Sub Model
-
-        Arguments:
-            :arg name: str
-                The name for the sub model
-        """
-        inputs = tf.keras.Input(shape=(None,), name="inputs")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
-
-        # noinspection PyCallingNonCallable
-        embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, name="Embedding_Encoder")(inputs)
-        embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
-        embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = RotaryPositionalEncoding()(embeddings)
-
-        outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
-
-        for i in range(self.num_layers):
-            outputs = self.encoder_layer(
-                name="encoder_layer_{}".format(i),
-            )([outputs, padding_mask])
-
-        return tf.keras.Model(
-            inputs=[inputs, padding_mask], outputs=outputs, name=name)
-
-    def decoder(self, name: str = 'decoder') -> tf.keras.Model:
-        """Decoder Sub Model
-
-                Arguments:
-                    :arg name: str
-                        The name for the sub model"""
-        inputs = tf.keras.Input(shape=(None,), name='inputs')
-        enc_outputs = tf.keras.Input(shape=(None, self.d_model), name='encoder_outputs')
-        look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name='look_ahead_mask')
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
-
-        # noinspection PyCallingNonCallable
-        embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, name="Embedding_Decoder")(inputs)
-        embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
-        embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = RotaryPositionalEncoding()(embeddings)
-
-        outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
-
-        for i in range(self.num_layers):
-            outputs = self.decoder_layer(name='decoder_layer_{}'.format(i),
-                                         )(inputs=[outputs, enc_outputs, look_ahead_mask, padding_mask])
-
-        return tf.keras.Model(
-            inputs=[inputs, enc_outputs, look_ahead_mask, padding_mask],
-            outputs=outputs,
-            name=name)
+    rotary_embeddings = True
 
 
 class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
@@ -593,7 +916,9 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
                  name: typing.AnyStr = "transformer", mixed: bool = False, epochs: int = 0,
                  warmup_steps_learning_rate: int = 4000,
                  save_freq: typing.Union[int, typing.AnyStr] = 'epoch',
-                 metadata=None, strategy=None, embedding_matrix: typing.Union[tf.Tensor, np.ndarray] = None, **kwargs):
+                 metadata=None, strategy=None, embedding_matrix: typing.Union[tf.Tensor, np.ndarray] = None,
+                 decoding_strategy: Decoder = None, packed_inputs: bool = False, inference_only: bool = False,
+                 attention_block_size: int = None, **kwargs):
 
         self.num_layers = num_layers
         self.units = units
@@ -603,6 +928,7 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
         self.max_len = max_len
         self.tokenizer = tokenizer
         self.start_token, self.end_token = [self.tokenizer.vocab_size + 1], [self.tokenizer.vocab_size + 2]
+        self.tokenization_engine = TokenizationEngine(self.tokenizer)
         if embedding_matrix is None:
             raise Exception("Embedding matrix cannot be none.")
         self.embedding_matrix = embedding_matrix
@@ -612,16 +938,23 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
         self.batch_size = batch_size
         self.warmup_steps = warmup_steps_learning_rate
         self.model = None
+        self.decode_functions = {}
+        self.decoding_strategy = GreedyDecoder() if decoding_strategy is None else decoding_strategy
+        self.packed_inputs = packed_inputs
+        self.inference_only = inference_only
+        self.quantized = False
+        self.attention_block_size = attention_block_size
 
         self.name = name
         self.log_dir = os.path.join(base_log_dir, self.name)
 
-        dirs_needed = ['images', 'tokenizer', 'config']
-        if not os.path.exists(self.log_dir):
-            os.mkdir(self.log_dir)
-        for dir_needed in dirs_needed:
-            if not os.path.exists(os.path.join(self.log_dir, dir_needed)):
-                os.mkdir(os.path.join(self.log_dir, dir_needed))
+        if not inference_only:
+            dirs_needed = ['images', 'tokenizer', 'config']
+            if not os.path.exists(self.log_dir):
+                os.mkdir(self.log_dir)
+            for dir_needed in dirs_needed:
+                if not os.path.exists(os.path.join(self.log_dir, dir_needed)):
+                    os.mkdir(os.path.join(self.log_dir, dir_needed))
 
         self.config = {
             'NUM_LAYERS': self.num_layers,
@@ -637,19 +970,27 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
             'SAVE_FREQ': save_freq,
             'BATCH_SIZE': batch_size
         }
+        if packed_inputs:
+            self.config['PACKED_INPUTS'] = True
+        if attention_block_size:
+            self.config['ATTENTION_BLOCK_SIZE'] = attention_block_size
         if metadata is None:
             metadata = {}
         self.metadata = metadata
 
-        self.strategy = tf.distribute.MirroredStrategy() if strategy is None else strategy
+        if strategy is None:
+            # Creating a MirroredStrategy enumerates the devices & sets up cross device ops, serving doesn't need it.
+            strategy = tf.distribute.get_strategy() if inference_only else tf.distribute.MirroredStrategy()
+        self.strategy = strategy
 
         with self.strategy.scope():
             self.scce = tf.keras.losses.SparseCategoricalCrossentropy(
                 reduction='none', from_logits=True)
             self.metrics = [tf.keras.metrics.SparseCategoricalAccuracy()]
 
-        # Create the tensorflow model
-        self.setup_model()
+        # Create the tensorflow model, inference only models are built when they are first needed
+        if not self.inference_only:
+            self.setup_model()
 
     def encoder(self, name: str = 'encoder') -> tf.keras.Model:
         """Encoder Sub Model
@@ -659,7 +1000,7 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
                 The name for the sub model
         """
         inputs = tf.keras.Input(shape=(None,), name="inputs")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
+        padding_mask = tf.keras.Input(shape=(1, None, None), name="padding_mask", dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, trainable=False,
@@ -667,8 +1008,7 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
                                          )(inputs)
         embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
         embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = PositionalEncoding(self.vocab_size, self.d_model)(embeddings)
+        embeddings = self.positional_encoding(embeddings, attention_mask=padding_mask)
 
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
 
@@ -689,8 +1029,8 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
         inputs = tf.keras.Input(shape=(None,), name='inputs')
         enc_outputs = tf.keras.Input(shape=(None, self.d_model), name='encoder_outputs')
         look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name='look_ahead_mask')
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
+            shape=(1, None, None), name='look_ahead_mask', dtype=tf.bool)
+        padding_mask = tf.keras.Input(shape=(1, None, None), name='padding_mask', dtype=tf.bool)
 
         # noinspection PyCallingNonCallable
         embeddings = GPUEnabledEmbedding(self.vocab_size, self.d_model, trainable=False,
@@ -698,8 +1038,7 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
                                          )(inputs)
         embeddings *= tf.math.sqrt(tf.cast(self.d_model, embeddings.dtype))
         embeddings = tf.cast(embeddings, self.default_dtype)
-        # noinspection PyCallingNonCallable
-        embeddings = PositionalEncoding(self.vocab_size, self.d_model)(embeddings)
+        embeddings = self.positional_encoding(embeddings, attention_mask=look_ahead_mask)
 
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(embeddings)
 
@@ -716,40 +1055,30 @@ class PreTrainedEmbeddingTransformerIntegration(TransformerIntegration):
         return super(PreTrainedEmbeddingTransformerIntegration, self).loss_function(y_true, y_pred)
 
     @classmethod
-    def load_model(cls, models_path, model_name, embedding_matrix):
+    def load_model(cls, models_path, model_name, embedding_matrix=None, inference_only: bool = False,
+                   warmup: bool = False, **kwargs):
         """
-        Load a saved model
+        Load a saved model, see TransformerAbstract.load_model
         :param embedding_matrix: The matrix used for embedding
         :param models_path: Path to the models' directory
         :param model_name: Name of the model
         :return: The loaded model
         """
-        file = open(os.path.join(os.path.join(models_path, model_name), os.path.join('config', 'config.json')))
-        # Prep the hparams for loading.
-        hparams = json.load(file)
-        file.close()
-        tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
-            os.path.join(models_path, os.path.join(model_name, f'tokenizer/{model_name}_tokenizer')))
-        hparams['TOKENIZER'] = tokenizer
-        hparams = {k.lower(): v for k, v in hparams.items()}
-        hparams['max_len'] = hparams['max_length']
-        hparams['name'] = hparams['model_name']
-        hparams['mixed'] = hparams['float16']
-        hparams['base_log_dir'] = models_path
-        del hparams['max_length'], hparams['model_name'], hparams['float16']
-        hparams['embedding_matrix'] = embedding_matrix
-
-        base = cls(**hparams)
-        if glob.glob(os.path.join(base.log_dir, 'cp.ckpt.*')) or os.path.exists(os.path.join(base.log_dir, 'cp.ckpt')):
-            base.get_model().load_weights(os.path.join(base.log_dir, 'cp.ckpt')).expect_partial()
-        return base
+        return super().load_model(models_path, model_name, inference_only=inference_only, warmup=warmup,
+                                  embedding_matrix=embedding_matrix, **kwargs)
 
 
 class PerformerIntegration(TransformerIntegration):
     """Improvement upon the original Transformer,
     the performer seeks to greatly decrease the time and memory
     complexity of the original transformer model in terms of
-    sequence length."""
+    sequence length.
+    The decoder self attention is causal FAVOR+, so replies are decoded one token at a time
+    with a constant size cache."""
+    incremental_decoding = True
+    fixed_length_inputs = True
+    # FAVOR+ never builds the attention matrix, so there is nothing to apply a segment mask to.
+    supports_packed_inputs = False
 
     def __init__(self, num_layers: int, units: int, d_model: int, num_heads: int, dropout: float, max_len: int,
                  num_features: int, base_log_dir: typing.AnyStr, batch_size: int,
@@ -757,7 +1086,7 @@ class PerformerIntegration(TransformerIntegration):
                  name: typing.AnyStr = "performer", mixed: bool = False, epochs: int = 0,
                  warmup_steps_learning_rate: int = 4000,
                  save_freq: typing.Union[int, typing.AnyStr] = 'epoch',
-                 metadata=None, strategy=None, **kwargs):
+                 metadata=None, strategy=None, feature_redraw_steps: int = None, **kwargs):
         if num_features > d_model:
             raise ValueError(f"Value for Num_Features {num_features} must be LESS THAN or EQUAL to d_model {d_model}")
         self.use_relu = False
@@ -772,6 +1101,20 @@ class PerformerIntegration(TransformerIntegration):
                                                    warmup_steps_learning_rate=warmup_steps_learning_rate,
                                                    strategy=strategy, **kwargs)
         self.config['NUM_FEATURES'] = self.num_features
+        self.set_feature_redraw_steps(feature_redraw_steps)
+
+    def set_feature_redraw_steps(self, feature_redraw_steps: typing.Optional[int]) -> None:
+        """Redraw the attention layers' random features every feature_redraw_steps training batches
+        (see FeatureRedrawCallback), otherwise they are drawn once. Either way they are saved with the model."""
+        self.feature_redraw_steps = feature_redraw_steps
+        if feature_redraw_steps:
+            self.config['FEATURE_REDRAW_STEPS'] = feature_redraw_steps
+
+    def get_default_callbacks(self) -> typing.List:
+        callbacks = super(PerformerIntegration, self).get_default_callbacks()
+        if self.feature_redraw_steps:
+            callbacks.append(FeatureRedrawCallback(self.feature_redraw_steps))
+        return callbacks
 
     def encoder_layer(self, name: str = "encoder_layer") -> tf.keras.Model:
         """Encoder Layer
@@ -780,28 +1123,28 @@ class PerformerIntegration(TransformerIntegration):
                         The name for the layer, returned in model.summary()
                 """
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
+        padding_mask = tf.keras.Input(shape=(1, None, None), name="padding_mask", dtype=tf.bool)
         attention = None
         if not self.use_relu:
             # noinspection PyCallingNonCallable
             attention = GavinMultiHeadPerformerAttention(
-                self.d_model, self.num_heads, self.num_features, name="attention")({'query': inputs,
-                                                                                    'key': inputs,
-                                                                                    'value': inputs,
-                                                                                    'mask': padding_mask})
+                self.d_model, self.num_heads, self.num_features, name="attention", fused_qkv=True)({'query': inputs,
+                                                                                                    'key': inputs,
+                                                                                                    'value': inputs,
+                                                                                                    'mask': padding_mask})
         else:
             # noinspection PyCallingNonCallable
             attention = MultiHeadPerformerReluAttention(
-                self.d_model, self.num_heads, self.num_features, name="attention")({'query': inputs,
-                                                                                    'key': inputs,
-                                                                                    'value': inputs,
-                                                                                    'mask': padding_mask})
+                self.d_model, self.num_heads, self.num_features, name="attention", fused_qkv=True)({'query': inputs,
+                                                                                                    'key': inputs,
+                                                                                                    'value': inputs,
+                                                                                                    'mask': padding_mask})
         attention = tf.keras.layers.Dropout(rate=self.dropout)(attention)
         attention = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(inputs + attention)
 
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention + outputs)
@@ -818,23 +1161,25 @@ class PerformerIntegration(TransformerIntegration):
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
         enc_outputs = tf.keras.Input(shape=(None, self.d_model), name="encoder_outputs", dtype=self.default_dtype)
         look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name="look_ahead_mask")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
+            shape=(1, None, None), name="look_ahead_mask", dtype=tf.bool)
+        padding_mask = tf.keras.Input(shape=(1, None, None), name='padding_mask', dtype=tf.bool)
         attention1 = None
         if not self.use_relu:
             # noinspection PyCallingNonCallable
             attention1 = GavinMultiHeadPerformerAttention(
-                self.d_model, self.num_heads, self.num_features, name="attention_1")(inputs={'query': inputs,
-                                                                                             'key': inputs,
-                                                                                             'value': inputs,
-                                                                                             'mask': look_ahead_mask})
+                self.d_model, self.num_heads, self.num_features, name="attention_1",
+                causal=True, fused_qkv=True)(inputs={'query': inputs,
+                                                     'key': inputs,
+                                                     'value': inputs,
+                                                     'mask': look_ahead_mask})
         else:
             # noinspection PyCallingNonCallable
             attention1 = MultiHeadPerformerReluAttention(
-                self.d_model, self.num_heads, self.num_features, name="attention_1")(inputs={'query': inputs,
-                                                                                             'key': inputs,
-                                                                                             'value': inputs,
-                                                                                             'mask': look_ahead_mask})
+                self.d_model, self.num_heads, self.num_features, name="attention_1",
+                causal=True, fused_qkv=True)(inputs={'query': inputs,
+                                                     'key': inputs,
+                                                     'value': inputs,
+                                                     'mask': look_ahead_mask})
         attention1 = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention1 + inputs)
 
@@ -856,8 +1201,8 @@ class PerformerIntegration(TransformerIntegration):
         attention2 = tf.keras.layers.Dropout(rate=self.dropout)(attention2)
         attention2 = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention2 + attention1)
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention2)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention2)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(outputs + attention2)
@@ -867,34 +1212,6 @@ class PerformerIntegration(TransformerIntegration):
             outputs=outputs,
             name=name)
 
-    def evaluate(self, sentence: typing.AnyStr) -> tf.Tensor:
-        if self.model is None:
-            self.setup_model()
-        sentence = preprocess_sentence(sentence)
-
-        sentence = tf.expand_dims(self.start_token + self.tokenizer.encode(sentence) + self.end_token, axis=0)
-
-        output = tf.expand_dims(self.start_token, 0)
-        sentence = tf.keras.preprocessing.sequence.pad_sequences(sentence, maxlen=self.max_len, padding='post')
-
-        for i in range(self.max_len - 1):
-            predictions = self.model(inputs=[sentence,
-                                             tf.keras.preprocessing.sequence.pad_sequences(output, maxlen=self.max_len,
-                                                                                           padding='post')],
-                                     training=False)
-
-            # select the last word from the seq length dimension
-            predictions = predictions[:, -1:, :]
-            predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
-
-            if tf.equal(predicted_id, self.end_token[0]):
-                break
-
-            # concatenated the predicted_id to the output which is given the decoder
-            # as its input
-            output = tf.concat([output, predicted_id], axis=-1)
-        return tf.squeeze(output, axis=0)
-
 
 class PerformerReluIntegration(PerformerIntegration):
     def __init__(self, num_layers: int, units: int, d_model: int, num_heads: int, dropout: float, max_len: int,
@@ -903,7 +1220,7 @@ class PerformerReluIntegration(PerformerIntegration):
                  name: typing.AnyStr = "performer", mixed: bool = False, epochs: int = 0,
                  warmup_steps_learning_rate: int = 4000,
                  save_freq: typing.Union[int, typing.AnyStr] = 'epoch',
-                 metadata=None, strategy=None, **kwargs):
+                 metadata=None, strategy=None, feature_redraw_steps: int = None, **kwargs):
         kwargs['use_relu'] = True
         if num_features > d_model:
             raise ValueError(f"Value for Num_Features {num_features} must be LESS THAN or EQUAL to d_model {d_model}")
@@ -922,16 +1239,24 @@ class PerformerReluIntegration(PerformerIntegration):
                                                    warmup_steps_learning_rate=warmup_steps_learning_rate,
                                                    strategy=strategy, **kwargs)
         self.config['NUM_FEATURES'] = self.num_features
+        self.set_feature_redraw_steps(feature_redraw_steps)
 
 
 class FNetIntegration(TransformerIntegration):
+    incremental_decoding = False
+    fixed_length_decoding = True
+    fixed_length_inputs = True
+    # Fourier mixing always mixes every token of a row.
+    supports_packed_inputs = False
+
     def __init__(self, num_layers: int, units: int, d_model: int, num_heads: int, dropout: float, batch_size: int,
                  max_len: int, base_log_dir: typing.AnyStr, tokenizer: tfds.deprecated.text.SubwordTextEncoder = None,
                  name: typing.AnyStr = "transformer", mixed: bool = False, epochs: int = 0,
                  warmup_steps_learning_rate: int = 4000,
                  save_freq: typing.Union[int, typing.AnyStr] = 'epoch',
-                 metadata=None, strategy=None, **kwargs):
-        self.fourier_layer = FourierTransformationLayer()
+                 metadata=None, strategy=None, fourier_mode: str = 'rfft', **kwargs):
+        # The inputs' dtype, so the (float16) inputs aren't cast to float32 & the mode decides the precision.
+        self.fourier_layer = FourierTransformationLayer(mode=fourier_mode, dtype=tf.float16 if mixed else tf.float32)
         super(TransformerIntegration, self).__init__(num_layers=num_layers, units=units, d_model=d_model,
                                                      num_heads=num_heads, dropout=dropout, batch_size=batch_size,
                                                      max_len=max_len, base_log_dir=base_log_dir, tokenizer=tokenizer,
@@ -943,10 +1268,12 @@ class FNetIntegration(TransformerIntegration):
         self.start_token, self.end_token = [self.tokenizer.vocab_size], [self.tokenizer.vocab_size + 1]
         self.vocab_size = self.tokenizer.vocab_size + 2
         self.default_dtype = tf.float32 if not mixed else tf.float16
+        self.config['FOURIER_MODE'] = self.fourier_layer.mode
         self.model = None  # This is set later
 
-        # Create the tensorflow model
-        self.setup_model()
+        # Create the tensorflow model, inference only models are built when they are first needed
+        if not self.inference_only:
+            self.setup_model()
 
     def encoder_layer(self, name: str = "encoder_layer") -> tf.keras.Model:
         """Encoder Layer
@@ -955,15 +1282,15 @@ class FNetIntegration(TransformerIntegration):
                         The name for the layer, returned in model.summary()
                 """
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name="padding_mask")
+        padding_mask = tf.keras.Input(shape=(1, None, None), name="padding_mask", dtype=tf.bool)
         # noinspection PyCallingNonCallable
         attention = self.fourier_layer(inputs)
         attention = tf.keras.layers.Dropout(rate=self.dropout)(attention)
         attention = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(inputs + attention)
 
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention + outputs)
@@ -980,8 +1307,8 @@ class FNetIntegration(TransformerIntegration):
         inputs = tf.keras.Input(shape=(None, self.d_model), name="inputs", dtype=self.default_dtype)
         enc_outputs = tf.keras.Input(shape=(None, self.d_model), name="encoder_outputs", dtype=self.default_dtype)
         look_ahead_mask = tf.keras.Input(
-            shape=(1, None, None), name="look_ahead_mask")
-        padding_mask = tf.keras.Input(shape=(1, 1, None), name='padding_mask')
+            shape=(1, None, None), name="look_ahead_mask", dtype=tf.bool)
+        padding_mask = tf.keras.Input(shape=(1, None, None), name='padding_mask', dtype=tf.bool)
         # noinspection PyCallingNonCallable
         attention1 = self.fourier_layer(inputs)
 
@@ -994,8 +1321,8 @@ class FNetIntegration(TransformerIntegration):
         attention2 = tf.keras.layers.Dropout(rate=self.dropout)(attention2)
         attention2 = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(attention2 + attention1)
-        outputs = tf.keras.layers.Dense(units=self.units, activation='relu')(attention2)
-        outputs = tf.keras.layers.Dense(units=self.d_model)(outputs)
+        outputs = QuantizableDense(units=self.units, activation='relu')(attention2)
+        outputs = QuantizableDense(units=self.d_model)(outputs)
         outputs = tf.keras.layers.Dropout(rate=self.dropout)(outputs)
         outputs = tf.keras.layers.LayerNormalization(
             epsilon=1e-6)(outputs + attention2)
@@ -1004,29 +1331,3 @@ class FNetIntegration(TransformerIntegration):
             inputs=[inputs, enc_outputs, look_ahead_mask, padding_mask],
             outputs=outputs,
             name=name)
-
-    def evaluate(self, sentence: typing.AnyStr) -> tf.Tensor:
-        sentence = preprocess_sentence(sentence)
-
-        sentence = tf.expand_dims(self.start_token + self.tokenizer.encode(sentence) + self.end_token, axis=0)
-
-        output = tf.expand_dims(self.start_token, 0)
-        sentence = tf.keras.preprocessing.sequence.pad_sequences(sentence, maxlen=self.max_len, padding='post')
-
-        for i in range(self.max_len - 1):
-            predictions = self.model(inputs=[sentence,
-                                             tf.keras.preprocessing.sequence.pad_sequences(output, maxlen=self.max_len,
-                                                                                           padding='post')],
-                                     training=False)
-
-            # select the last word from the seq length dimension
-            predictions = predictions[:, -1:, :]
-            predicted_id = tf.cast(tf.argmax(predictions, axis=-1), tf.int32)
-
-            if tf.equal(predicted_id, self.end_token[0]):
-                break
-
-            # concatenated the predicted_id to the output which is given the decoder
-            # as its input
-            output = tf.concat([output, predicted_id], axis=-1)
-        return tf.squeeze(output, axis=0)
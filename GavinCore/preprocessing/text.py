@@ -6,19 +6,49 @@ import tensorflow as tf
 import numpy as np
 
 from concurrent.futures import ProcessPoolExecutor
-from typing import AnyStr, List, Tuple
+from typing import AnyStr, List, Tuple, Union
+
+
+# Characters preprocess_sentence keeps, the A-z range (rather than A-Z) also keeps [\]^_` and is kept for compatibility.
+LETTERS = "a-zA-z"
+PUNCTUATION = "?.!,'*\":@"
+
+
+class TextNormaliser:
+    def __init__(self):
+        """Single pass, precompiled version of the preprocess_sentence regex chain.
+        preprocess_sentence pads punctuation with spaces, replaces every run of other characters with a space & strips,
+        which leaves the words (runs of letters) & punctuation of the sentence joined by single spaces. The normaliser
+        finds those tokens in one scan & joins them, producing identical output.
+        """
+        self.token_pattern = re.compile(f"[{LETTERS}]+|[{re.escape(PUNCTUATION)}]")
+
+    def __call__(self, sentence: AnyStr) -> AnyStr:
+        return " ".join(self.token_pattern.findall(sentence))
+
+    def normalise_batch(self, sentences: Union[List[AnyStr], np.ndarray]) -> Union[List[AnyStr], np.ndarray]:
+        """Normalise a list of sentences, or a NumPy array of str or UTF-8 bytes (returned as str, in the same shape)."""
+        if isinstance(sentences, np.ndarray):
+            flat = [self(sentence.decode("utf-8") if isinstance(sentence, bytes) else sentence)
+                    for sentence in sentences.ravel().tolist()]
+            return np.array(flat, dtype=object if sentences.dtype == object else str).reshape(sentences.shape)
+        return [self(sentence) for sentence in sentences]
+
+    @staticmethod
+    def tf_normalise(sentences: tf.Tensor) -> tf.Tensor:
+        """Graph version for tf.data pipelines & serving signatures, takes and returns a tf.string tensor of any shape.
+        RE2 has no findall, so this runs the original regex chain."""
+        sentences = tf.strings.regex_replace(sentences, f"([{re.escape(PUNCTUATION)}])", r" \1 ")
+        sentences = tf.strings.regex_replace(sentences, f"[^{LETTERS}{re.escape(PUNCTUATION)}]+", " ")
+        return tf.strings.strip(sentences)
+
+
+normaliser = TextNormaliser()
 
 
 def preprocess_sentence(sentence: AnyStr) -> AnyStr:
-    sentence = sentence.strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,'*\":@])", r" \1 ", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",", "'")
-    sentence = re.sub(r"[^a-zA-z?.!,'*:\"@]+", " ", sentence)
-    sentence = sentence.strip()
-    # adding start and an end token to the sentence
-    return sentence
+    # "he is a boy." => "he is a boy ." & everything except (a-z, A-Z, ".", "?", "!", ",", "'", ...) replaced with a space
+    return normaliser(sentence)
 
 
 def preprocess_context(sentence: AnyStr) -> AnyStr:
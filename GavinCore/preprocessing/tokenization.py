@@ -0,0 +1,254 @@
+import argparse
+import functools
+import hashlib
+import itertools
+import re
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from .text import normaliser, preprocess_sentence
+from ..load_data import convert_in_chunks, iter_lines, write_chunk
+from ..token_files import token_dtype
+
+NEWLINE = " newlinechar "
+# How SubwordTextEncoder escapes "_" inside tokens, a trailing "_" marks the end of a word.
+UNDERSCORE_REPLACEMENT = "\\&undsc"
+
+# Set in every worker process by init_worker, so the tokenizer is pickled once per process instead of once per task.
+_worker_tokenizer = None
+
+
+def init_worker(tokenizer: tfds.deprecated.text.SubwordTextEncoder):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def tokenizer_fingerprint(tokenizer: tfds.deprecated.text.SubwordTextEncoder) -> typing.Dict:
+    """Identifies a tokenizer's vocabulary, token files made with another vocabulary are tokenized again."""
+    return {'vocab_size': tokenizer.vocab_size,
+            'sha256': hashlib.sha256("\n".join(tokenizer.subwords).encode("utf-8")).hexdigest()}
+
+
+def encode_line(tokenizer: tfds.deprecated.text.SubwordTextEncoder, line: typing.AnyStr) -> typing.List[int]:
+    """Preprocess & tokenize one sentence, without start/end tokens."""
+    return tokenizer.encode(preprocess_sentence(line))
+
+
+def encode_lines(lines: typing.List[typing.AnyStr]) -> typing.List[typing.List[int]]:
+    return [encode_line(_worker_tokenizer, line) for line in lines]
+
+
+def tokenize_text_chunk(path: typing.AnyStr, output_path: typing.AnyStr, start: int, end: int,
+                        dtype: str, write_every: int = 4096) -> typing.Dict:
+    """Tokenize the lines starting in the byte range [start, end) of a raw text file into an indexed token file,
+    every line is one sample (empty lines included, so .from & .to files stay aligned). Lines are read like read_thread
+    does. See write_chunk."""
+    samples = (encode_line(_worker_tokenizer, line.replace(NEWLINE, "\n")) for line in iter_lines(path, start, end))
+    return write_chunk(path, output_path, start, end, dtype, samples, write_every)
+
+
+class TokenizationEngine:
+    def __init__(self, tokenizer: tfds.deprecated.text.SubwordTextEncoder, num_workers: int = None,
+                 cache_size: int = 1 << 16):
+        """Preprocesses & tokenizes raw text with SubwordTextEncoder.
+        Bulk tokenization splits the work between num_workers processes & streams it into indexed token files,
+        single sentences (the serving path) go through an LRU cache of encoded sentences.
+        Args:
+            :param tokenizer: tfds.deprecated.text.SubwordTextEncoder
+                The tokenizer
+            :param num_workers: int
+                Number of processes for bulk tokenization, defaults to the number of CPUs
+            :param cache_size: int
+                Number of encoded sentences to keep, 0 disables the cache
+        """
+        self.tokenizer = tokenizer
+        self.num_workers = num_workers
+        self._cached_encode = functools.lru_cache(maxsize=cache_size)(self._encode)
+
+    def _encode(self, sentence: typing.AnyStr) -> typing.Tuple[int, ...]:
+        # tuples so callers can't modify the cached value
+        return tuple(encode_line(self.tokenizer, sentence))
+
+    def encode(self, sentence: typing.AnyStr) -> typing.List[int]:
+        """Preprocess & tokenize one sentence, without start/end tokens."""
+        return list(self._cached_encode(sentence))
+
+    def encode_batch(self, sentences: typing.Iterable[typing.AnyStr]) -> typing.List[typing.List[int]]:
+        return [self.encode(sentence) for sentence in sentences]
+
+    def cache_info(self):
+        return self._cached_encode.cache_info()
+
+    def clear_cache(self):
+        self._cached_encode.cache_clear()
+
+    def executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.num_workers, initializer=init_worker, initargs=(self.tokenizer,))
+
+    def tokenize_lines(self, lines: typing.Iterable[typing.AnyStr],
+                       lines_per_task: int = 1024) -> typing.List[typing.List[int]]:
+        """Preprocess & tokenize many lines across the worker processes, in order & bypassing the cache.
+        Args:
+            :param lines: Iterable[str]
+                The raw lines
+            :param lines_per_task: int
+                Lines sent to a worker at once
+        """
+        lines = iter(lines)
+        tasks = iter(lambda: list(itertools.islice(lines, lines_per_task)), [])
+        if self.num_workers == 1:
+            return [encode_line(self.tokenizer, line) for task in tasks for line in task]
+        with self.executor() as executor:
+            return [sample for samples in executor.map(encode_lines, tasks) for sample in samples]
+
+    def tokenize_file(self, path: typing.AnyStr, output_path: typing.AnyStr, chunk_size: int = 1 << 24,
+                      force: bool = False) -> typing.Dict:
+        """Tokenize a raw text file (one sample per line) into an indexed token file, see convert_in_chunks.
+        The output is redone if the file or the tokenizer changed since it was made."""
+        return convert_in_chunks(path, output_path, token_dtype(self.tokenizer.vocab_size).name, tokenize_text_chunk,
+                                 num_workers=self.num_workers, chunk_size=chunk_size, force=force,
+                                 converter={'tokenizer': tokenizer_fingerprint(self.tokenizer)},
+                                 initializer=init_worker, initargs=(self.tokenizer,))
+
+    def tokenize_corpus(self, data_path: typing.AnyStr, name: typing.AnyStr, filename: typing.AnyStr = "train",
+                        output_path: typing.AnyStr = None, chunk_size: int = 1 << 24,
+                        force: bool = False) -> typing.Tuple[typing.Dict, typing.Dict]:
+        """Tokenize {data_path}{filename}.from & .to into the indexed token files {output_path}{name}-from & -to,
+        which load_tokenized_data(..., filename=name) and DatasetDirectFromFileAPICreator read.
+        output_path defaults to data_path."""
+        output_path = data_path if output_path is None else output_path
+        return tuple(self.tokenize_file(f"{data_path}{filename}.{part}", f"{output_path}{name}-{part}",
+                                        chunk_size=chunk_size, force=force)
+                     for part in ["from", "to"])
+
+
+class GraphSubwordEncoder(tf.Module):
+    def __init__(self, tokenizer: tfds.deprecated.text.SubwordTextEncoder, name: str = None):
+        """SubwordTextEncoder's encode & decode as TensorFlow ops, so tokenization can be part of a SavedModel.
+        encode takes normalised text (see TextNormaliser.tf_normalise), which is ASCII only, so characters & bytes
+        are the same thing and the byte fallback is one id per character. For such text it matches tokenizer.encode:
+        text is split into word & non word runs (after splitting out the tokenizer's reserved tokens), "_" is
+        escaped, a token followed by a single space gets the "_" suffix & the space is dropped, then every token is
+        split into the longest matching subwords, for all tokens of the batch at once.
+        Args:
+            :param tokenizer: tfds.deprecated.text.SubwordTextEncoder
+                The tokenizer
+            :param name: str
+                Name of the module
+        """
+        super().__init__(name=name)
+        subwords = tokenizer.subwords
+        self.byte_offset = len(subwords)
+        self.vocab_size = tokenizer.vocab_size
+        # later duplicates win, like SubwordTextEncoder's dict
+        subword_ids = {subword: i for i, subword in enumerate(subwords)}
+        subword_ids[UNDERSCORE_REPLACEMENT] = self.byte_offset + ord("_")
+        self.max_subword_length = max([len(subword) for subword in subword_ids])
+        self.subword_table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant(list(subword_ids.keys())),
+                                                tf.constant(list(subword_ids.values()), dtype=tf.int32)), -1)
+        self.id_to_string = tf.constant([(subword[:-1] + " " if subword.endswith("_") else subword).encode("utf-8")
+                                         for subword in subwords] + [bytes([byte]) for byte in range(256)])
+
+        # Reserved tokens (subwords mixing word & non word characters) are split out first, trying them in the order of
+        # the tokenizer's regex. Only those normalised text can hold are kept, which keeps the RE2 pattern small.
+        reserved_pattern = tokenizer._tokenizer._reserved_tokens_re
+        alternatives = re.findall(r"(?:\\.|[^|\\])+", reserved_pattern.pattern[1:-1]) if reserved_pattern else []
+        self.reserved_pattern = "|".join(alternative for alternative in alternatives
+                                         if self.in_normalised_text(re.sub(r"\\(.)", r"\1", alternative)))
+
+    @staticmethod
+    def in_normalised_text(token: str) -> bool:
+        """Whether token can be part of normalised text, words & punctuation separated by single spaces."""
+        return all(normaliser(part) == part for part in token.split(" "))
+
+    def split_tokens(self, sentences: tf.Tensor) -> tf.RaggedTensor:
+        """Tokens of every sentence (batch_size, None) ready to be split into subwords."""
+        # \x01 separates tokens & \x02 marks reserved tokens, neither is in normalised text
+        if self.reserved_pattern:
+            sentences = tf.strings.regex_replace(sentences, f"({self.reserved_pattern})", "\x01\x02\\1\x01")
+        sentences = tf.strings.regex_replace(sentences, "(\x01\x02[^\x01]*\x01)|([^\\w\x01\x02]+)", "\x01\\1\\2\x01")
+        tokens = tf.strings.split(sentences, "\x01")
+        tokens = tf.ragged.boolean_mask(tokens, tf.strings.length(tokens) > 0)
+        tokens = tf.strings.regex_replace(tokens, "^\x02", "")
+
+        # A token followed by a single space ends a word, the space is dropped.
+        is_space = tf.equal(tokens, " ")
+        position = tf.ragged.range(tokens.row_lengths())
+        drop = tf.logical_and(is_space, position > 0)
+        next_is_space = tf.concat([is_space[:, 1:], tf.zeros_like(is_space[:, :1])], axis=1)
+        tokens = tf.strings.regex_replace(tokens, "_", UNDERSCORE_REPLACEMENT.replace("\\", "\\\\"))
+        tokens = tf.strings.join([tokens, tf.where(next_is_space, "_", "")])
+        return tf.ragged.boolean_mask(tokens, tf.logical_not(drop))
+
+    def tokens_to_ids(self, tokens: tf.Tensor) -> tf.RaggedTensor:
+        """Greedily split a flat tensor of tokens into the longest subwords, falling back to bytes.
+        Every step consumes one subword of each unfinished token."""
+        lengths = tf.strings.length(tokens)
+        candidate_lengths = tf.range(self.max_subword_length, 0, -1)
+        tiled_tokens = tf.tile(tokens[:, tf.newaxis], [1, self.max_subword_length])
+
+        def cond(position, ids):
+            return tf.reduce_any(position < lengths)
+
+        def body(position, ids):
+            active = position < lengths
+            starts = tf.tile(position[:, tf.newaxis], [1, self.max_subword_length])
+            candidates = tf.strings.substr(tiled_tokens, starts, tf.broadcast_to(candidate_lengths, tf.shape(starts)))
+            candidate_ids = self.subword_table.lookup(candidates)
+            matches = tf.logical_and(candidate_ids >= 0, tf.equal(tf.strings.length(candidates), candidate_lengths))
+            longest = tf.argmax(tf.cast(matches, tf.int32), axis=1, output_type=tf.int32)
+            matched = tf.reduce_any(matches, axis=1)
+
+            character = tf.strings.substr(tokens, position, tf.ones_like(position))
+            character = tf.cast(tf.io.decode_raw(character, tf.uint8, fixed_length=1)[:, 0], tf.int32)
+            byte_id = self.byte_offset + tf.where(tf.equal(character, ord("_")), ord(" "), character)
+            subword_id = tf.where(matched, tf.gather(candidate_ids, longest, batch_dims=1), byte_id)
+            ids = ids.write(ids.size(), tf.where(active, subword_id, -1))
+            return position + tf.where(active, tf.where(matched, tf.gather(candidate_lengths, longest), 1), 0), ids
+
+        # starts with a row of -1s, so there is something to stack when every token is empty
+        ids = tf.TensorArray(tf.int32, size=0, dynamic_size=True, element_shape=tokens.shape)
+        ids = ids.write(0, tf.fill(tf.shape(tokens), -1))
+        _, ids = tf.while_loop(cond, body, (tf.zeros_like(lengths), ids))
+        ids = tf.transpose(tf.reshape(ids.stack(), [-1, tf.shape(tokens)[0]]))
+        return tf.ragged.boolean_mask(ids, ids >= 0)
+
+    def encode(self, sentences: tf.Tensor) -> tf.RaggedTensor:
+        """Token ids (batch_size, None) of normalised sentences (batch_size,), like tokenizer.encode."""
+        tokens = self.split_tokens(sentences)
+        ids = self.tokens_to_ids(tokens.flat_values)
+        return tf.RaggedTensor.from_row_splits(ids, tokens.row_splits).merge_dims(1, 2) + 1
+
+    def decode(self, ids: tf.Tensor) -> tf.Tensor:
+        """Text (batch_size,) of token ids (batch_size, sequence_length), like tokenizer.decode.
+        Ids outside the tokenizer's vocab (padding, start & end tokens) are skipped."""
+        ids = tf.ragged.boolean_mask(ids, tf.logical_and(ids > 0, ids < self.vocab_size))
+        text = tf.strings.reduce_join(tf.gather(self.id_to_string, ids - 1), axis=-1)
+        # invalid byte sequences become U+FFFD
+        return tf.strings.unicode_transcode(text, "UTF-8", "UTF-8", errors="replace")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize raw {filename}.from/.to files into indexed token files.")
+    parser.add_argument("data_path", help="Directory (with trailing separator) holding the .from/.to files")
+    parser.add_argument("tokenizer_path", help="Path of the SubwordTextEncoder, without the .subwords suffix")
+    parser.add_argument("name", help="Name of the token files, usually the tokenizer's name")
+    parser.add_argument("--filename", default="train", help="Name of the text files without the .from/.to suffix")
+    parser.add_argument("--output-path", default=None, help="Where to write the token files, defaults to data_path")
+    parser.add_argument("--num-workers", type=int, default=None, help="Number of processes")
+    parser.add_argument("--chunk-size", type=int, default=1 << 24, help="Bytes of the text files per chunk")
+    parser.add_argument("--force", action="store_true", help="Tokenize even if the files are up to date")
+    args = parser.parse_args()
+    engine = TokenizationEngine(tfds.deprecated.text.SubwordTextEncoder.load_from_file(args.tokenizer_path),
+                                num_workers=args.num_workers)
+    for manifest in engine.tokenize_corpus(args.data_path, args.name, filename=args.filename,
+                                           output_path=args.output_path, chunk_size=args.chunk_size, force=args.force):
+        print(f"{manifest['source']['path']}: {manifest['num_samples']} samples, {manifest['num_tokens']} tokens")
+
+
+if __name__ == "__main__":
+    main()
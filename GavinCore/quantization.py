@@ -0,0 +1,97 @@
+import typing
+
+import numpy as np
+
+from .utils import tf, PhaseTimer
+from .serving import load_tflite_model
+
+
+def weight_bytes(model) -> int:
+    """Bytes taken by the weights of a TransformerAbstract's model, what decoding reads for every token."""
+    return int(sum(np.prod(weight.shape) * weight.dtype.size for weight in model.get_model().weights))
+
+
+def replies(output: np.ndarray) -> typing.List[typing.List[int]]:
+    """Rows of an output buffer without their padding."""
+    return [[int(token) for token in row if token != 0] for row in np.asarray(output)]
+
+
+def reply_agreement(expected: np.ndarray, output: np.ndarray) -> float:
+    """Fraction of rows of two output buffers holding the same reply."""
+    return float(np.mean([a == b for a, b in zip(replies(expected), replies(output))]))
+
+
+def quantization_report(float_model, quantized_model, dataset: tf.data.Dataset = None,
+                        sentences: typing.List[typing.AnyStr] = None, tflite_path: typing.AnyStr = None,
+                        steps: int = None, iterations: int = 3) -> typing.Dict[str, float]:
+    """Compare a quantised model (see TransformerAbstract.quantize) with the float model it was made from,
+    over held out data.
+    Args:
+        :param float_model: TransformerAbstract
+            The float model
+        :param quantized_model: TransformerAbstract
+            The same weights quantised
+        :param dataset: tf.data.Dataset
+            Held out batches like the validation dataset of DatasetAPICreator, ({'inputs', 'dec_inputs'}, {'outputs'}),
+            compared one next token prediction at a time (teacher forcing)
+        :param sentences: List[str]
+            Held out raw sentences, the greedy replies of both models are compared
+        :param tflite_path: str
+            A model written by export_tflite, its replies to sentences are compared with the float model's too
+        :param steps: int
+            Only compare the first steps batches of dataset
+        :param iterations: int
+            Decodes of sentences timed per model, after a first (tracing) one
+    :return: Dict[str, float]
+        'float_weight_bytes' & 'quantized_weight_bytes'.
+        With dataset, 'float_accuracy' & 'quantized_accuracy' (next token accuracy over the non padding targets),
+        'top1_agreement' (how often both models predict the same next token), 'mean_abs_logit_error' &
+        'max_abs_logit_error'.
+        With sentences, 'reply_agreement' (the fraction of identical replies) & 'tflite_reply_agreement',
+        and the seconds to decode replies to all sentences, 'float_decode_seconds', 'quantized_decode_seconds'
+        & 'tflite_decode_seconds'.
+    """
+    report = {'float_weight_bytes': weight_bytes(float_model), 'quantized_weight_bytes': weight_bytes(quantized_model)}
+    if dataset is not None:
+        if steps is not None:
+            dataset = dataset.take(steps)
+        tokens, float_correct, quantized_correct, agreed, error, max_error = 0, 0, 0, 0, 0., 0.
+        for inputs, outputs in dataset:
+            float_logits = float_model.get_model()(inputs, training=False)
+            quantized_logits = quantized_model.get_model()(inputs, training=False)
+            targets = tf.cast(outputs['outputs'], tf.int64)
+            mask = tf.not_equal(targets, 0)
+            float_predictions = tf.argmax(float_logits, axis=-1)
+            quantized_predictions = tf.argmax(quantized_logits, axis=-1)
+
+            tokens += int(tf.reduce_sum(tf.cast(mask, tf.int64)))
+            float_correct += int(tf.reduce_sum(tf.cast(mask & tf.equal(float_predictions, targets), tf.int64)))
+            quantized_correct += int(tf.reduce_sum(tf.cast(mask & tf.equal(quantized_predictions, targets), tf.int64)))
+            agreed += int(tf.reduce_sum(tf.cast(mask & tf.equal(float_predictions, quantized_predictions), tf.int64)))
+            errors = tf.boolean_mask(tf.abs(float_logits - quantized_logits), mask)
+            error += float(tf.reduce_sum(tf.reduce_mean(errors, axis=-1)))
+            if tf.size(errors) > 0:
+                max_error = max(max_error, float(tf.reduce_max(errors)))
+        tokens = max(tokens, 1)
+        report.update(float_accuracy=float_correct / tokens, quantized_accuracy=quantized_correct / tokens,
+                      top1_agreement=agreed / tokens, mean_abs_logit_error=error / tokens, max_abs_logit_error=max_error)
+    if sentences:
+        expected = float_model.evaluate_batch(sentences)
+        report['reply_agreement'] = reply_agreement(expected, quantized_model.evaluate_batch(sentences))
+        decoders = {'float': lambda: float_model.evaluate_batch(sentences),
+                    'quantized': lambda: quantized_model.evaluate_batch(sentences)}
+        if tflite_path is not None:
+            max_len = float_model.max_len if float_model.fixed_length_inputs else None
+            tokens = float_model.tokenize_batch(sentences, max_len=max_len).numpy()
+            interpreter = load_tflite_model(tflite_path)
+            output, length = interpreter(tokens)
+            report['tflite_reply_agreement'] = reply_agreement(expected, output[:, :length])
+            decoders['tflite'] = lambda: interpreter(tokens)
+        # Both models were traced by the replies above.
+        timer = PhaseTimer()
+        for name, decode in decoders.items():
+            with timer.phase(name):
+                for _ in range(iterations):
+                    decode()
+            report[f'{name}_decode_seconds'] = timer.timings[name] / iterations
+    return report
@@ -0,0 +1,89 @@
+import typing
+
+import numpy as np
+
+from .utils import tf, PhaseTimer
+from .decoding import Decoder
+from .preprocessing.text import TextNormaliser
+from .preprocessing.tokenization import GraphSubwordEncoder
+
+
+class ServingModule(tf.Module):
+    def __init__(self, model, decoding_strategy: Decoder = None, use_cache: bool = True, jit_compile: bool = False,
+                 name: str = None):
+        """String in, string out version of TransformerAbstract.predict_batch made only of TensorFlow ops,
+        normalisation, subword lookup, the compiled decode loop & detokenisation, so it can be saved as a SavedModel
+        and served without building the model in Python, see TransformerAbstract.export_serving_model.
+        Args:
+            :param model: TransformerAbstract
+                The model, built with setup_model
+            :param decoding_strategy: Decoder
+                The decoding strategy, defaults to model.decoding_strategy
+            :param use_cache: bool
+                Use incremental (key/value cached) decoding when the model supports it.
+            :param jit_compile: bool
+                Compile the decode loop with XLA, inputs are padded (or truncated) to max_len.
+            :param name: str
+                Name of the module
+        """
+        super().__init__(name=name)
+        # Only the weights are tracked, saving the Keras model itself would add every layer's traced functions,
+        # which makes the SavedModel many times slower to load.
+        self.model_weights = model.model.weights
+        self.encoder = GraphSubwordEncoder(model.tokenizer)
+        self.start_token, self.end_token = model.start_token[0], model.end_token[0]
+        self.max_len = model.max_len if model.fixed_length_inputs or jit_compile else None
+        # token ids in, (output buffer, length) out, also saved as a function of the module
+        self.generate = model.get_decode_function(decoding_strategy=decoding_strategy, use_cache=use_cache,
+                                                  jit_compile=jit_compile)
+
+    def tokenize(self, sentences: tf.Tensor) -> tf.Tensor:
+        """In graph TransformerAbstract.tokenize_batch, raw sentences (batch_size,) to padded token ids."""
+        ids = self.encoder.encode(TextNormaliser.tf_normalise(sentences))
+        batch_size = ids.nrows(out_type=tf.int32)
+        ids = tf.concat([tf.fill([batch_size, 1], self.start_token), ids, tf.fill([batch_size, 1], self.end_token)], axis=1)
+        if self.max_len is None:
+            return ids.to_tensor()
+        # like pad_sequences, long sentences lose their first tokens
+        return ids[:, -self.max_len:].to_tensor(shape=[None, self.max_len])
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,), dtype=tf.string, name="sentences")])
+    def serve(self, sentences: tf.Tensor) -> typing.Dict[str, tf.Tensor]:
+        output, length = self.generate(self.tokenize(sentences))
+        return {'outputs': self.encoder.decode(output[:, :length])}
+
+
+def load_serving_model(export_dir: typing.AnyStr, warmup: bool = True):
+    """Load a SavedModel written by TransformerAbstract.export_serving_model, without Keras or the tokenizer.
+    The seconds spent loading (and warming up) are in its startup_timings.
+    Args:
+        :param export_dir: str
+            The SavedModel's directory
+        :param warmup: bool
+            Run one prediction, so the first request doesn't pay for instantiating the graph
+    """
+    timer = PhaseTimer()
+    with timer.phase('saved_model'):
+        serving = tf.saved_model.load(export_dir)
+    if warmup:
+        with timer.phase('warmup'):
+            serving.signatures['serving_default'](sentences=tf.constant([""]))
+    serving.startup_timings = timer.report()
+    return serving
+
+
+def load_tflite_model(path: typing.AnyStr) -> typing.Callable[[np.ndarray], typing.Tuple[np.ndarray, int]]:
+    """Load a TFLite model written by TransformerAbstract.export_tflite.
+    Returns a function of token ids (batch_size, sequence_length), tokenized like TransformerAbstract.tokenize_batch,
+    to the output buffer and the number of decoded positions in it, like TransformerAbstract.get_decode_function.
+    Args:
+        :param path: str
+            The .tflite file
+    """
+    runner = tf.lite.Interpreter(model_path=path).get_signature_runner()
+
+    def decode(sentences: np.ndarray) -> typing.Tuple[np.ndarray, int]:
+        outputs = runner(sentences=np.asarray(sentences, dtype=np.int32))
+        return outputs['output_0'], int(outputs['output_1'])
+
+    return decode
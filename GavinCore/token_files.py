@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import typing
+
+import numpy as np
+
+FORMAT_VERSION = 1
+TOKENS_SUFFIX = ".tokens"
+OFFSETS_SUFFIX = ".offsets"
+HEADER_SUFFIX = ".json"
+OFFSETS_DTYPE = np.int64
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """Smallest dtype able to hold every token id of a vocabulary, the start & end tokens aren't stored."""
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.int32)
+
+
+def token_file_paths(path: typing.AnyStr) -> typing.Tuple[str, str, str]:
+    """The tokens, offsets and header files making up the indexed token file at path."""
+    return path + TOKENS_SUFFIX, path + OFFSETS_SUFFIX, path + HEADER_SUFFIX
+
+
+class IndexedTokenFile:
+    def __init__(self, path: typing.AnyStr, start_token: int = None, end_token: int = None, max_length: int = None,
+                 padding_value: int = 0):
+        """Memory mapped token file, a flat array of every sample's tokens plus an offsets index.
+        Sample i is tokens[offsets[i]:offsets[i + 1]], so random access is O(1) and the data lives in the page
+        cache instead of the heap. Drop in replacement for GavinBackendDatasetUtils.BINFile.
+        Args:
+            :param path: str
+                Path of the file without suffixes, see token_file_paths
+            :param start_token: int
+                Prepended to samples returned by __getitem__ & batch
+            :param end_token: int
+                Appended to samples returned by __getitem__ & batch
+            :param max_length: int
+                Length samples are padded (or truncated) to by __getitem__, None returns them unpadded
+            :param padding_value: int
+                Value used for padding
+        """
+        self.path = path
+        tokens_path, offsets_path, header_path = token_file_paths(path)
+        with open(header_path, "r") as f:
+            self.header = json.load(f)
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"{path} is version {self.header['version']}, expected {FORMAT_VERSION}.")
+        self.dtype = np.dtype(self.header['dtype'])
+        self.number_of_samples = self.header['num_samples']
+        self.offsets = np.memmap(offsets_path, dtype=OFFSETS_DTYPE, mode='r', shape=(self.number_of_samples + 1,))
+        # np.memmap can't map an empty file
+        self.tokens = np.memmap(tokens_path, dtype=self.dtype, mode='r', shape=(self.header['num_tokens'],)) \
+            if self.header['num_tokens'] else np.zeros((0,), dtype=self.dtype)
+        self.start_token = start_token
+        self.end_token = end_token
+        self.max_length = max_length
+        self.padding_value = padding_value
+
+    @staticmethod
+    def exists(path: typing.AnyStr) -> bool:
+        return all(os.path.exists(file_path) for file_path in token_file_paths(path))
+
+    @property
+    def max_number_of_samples(self) -> int:
+        return self.number_of_samples
+
+    def __len__(self) -> int:
+        return self.number_of_samples
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of tokens in every sample, excluding the start & end tokens."""
+        return np.diff(self.offsets)
+
+    def sample(self, index: int) -> np.ndarray:
+        """Tokens of sample index, a view of the memory map (no copy)."""
+        if not -self.number_of_samples <= index < self.number_of_samples:
+            raise IndexError(f"Sample {index} is out of range for {self.number_of_samples} samples.")
+        index %= self.number_of_samples
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """Sample index with the start & end tokens, padded to max_length if set."""
+        sample = self.sample(index)
+        if self.max_length is None:
+            return np.concatenate([[self.start_token] if self.start_token is not None else [], sample,
+                                   [self.end_token] if self.end_token is not None else []]).astype(np.int32)
+        return self.batch([index])[0]
+
+    def batch(self, indices: typing.Union[typing.Sequence[int], np.ndarray], max_length: int = None) -> np.ndarray:
+        """Gather samples into one padded int32 array in a single vectorised copy out of the memory map.
+        Samples which don't fit are truncated, the end token is kept.
+        Args:
+            :param indices: Sequence[int]
+                The samples to gather
+            :param max_length: int
+                Width of the batch including the start & end tokens, defaults to self.max_length, or the longest sample
+        :return: np.ndarray
+            (len(indices), max_length)
+        """
+        indices = np.asarray(indices, dtype=np.int64) % max(self.number_of_samples, 1)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        prefix = int(self.start_token is not None)
+        suffix = int(self.end_token is not None)
+        max_length = max_length or self.max_length
+        if max_length is None:
+            max_length = int(lengths.max(initial=0)) + prefix + suffix
+        lengths = np.minimum(lengths, max_length - prefix - suffix)
+
+        positions = np.arange(max_length - prefix, dtype=np.int64)[np.newaxis, :]
+        in_sample = positions < lengths[:, np.newaxis]
+        # out of sample positions are clipped to a valid index, then overwritten with padding
+        token_index = np.minimum(starts[:, np.newaxis] + positions, max(len(self.tokens) - 1, 0))
+        gathered = self.tokens[token_index] if len(self.tokens) else np.zeros(token_index.shape, dtype=self.dtype)
+        batch = np.where(in_sample, gathered, self.padding_value).astype(np.int32)
+        if suffix:
+            batch[np.arange(len(indices)), np.minimum(lengths, max_length - prefix - 1)] = self.end_token
+        if prefix:
+            batch = np.concatenate([np.full((len(indices), 1), self.start_token, dtype=np.int32), batch], axis=1)
+        return batch
+
+
+class IndexedTokenFileWriter:
+    def __init__(self, path: typing.AnyStr, vocab_size: int = None, dtype: np.dtype = None):
+        """Streams samples into an IndexedTokenFile, the header is written on close.
+        Args:
+            :param path: str
+                Path of the file without suffixes, see token_file_paths
+            :param vocab_size: int
+                Used to pick the smallest dtype, see token_dtype
+            :param dtype: np.dtype
+                dtype of the tokens, overrides vocab_size
+        """
+        if dtype is None and vocab_size is None:
+            raise ValueError("Either vocab_size or dtype must be given.")
+        self.path = path
+        self.dtype = np.dtype(dtype) if dtype is not None else token_dtype(vocab_size)
+        self.tokens_path, self.offsets_path, self.header_path = token_file_paths(path)
+        self.tokens_file = open(self.tokens_path, "wb")
+        self.offsets_file = open(self.offsets_path, "wb")
+        self.number_of_samples = 0
+        self.number_of_tokens = 0
+        self.offsets_file.write(np.zeros((1,), dtype=OFFSETS_DTYPE).tobytes())
+
+    def write(self, sample: typing.Union[typing.Sequence[int], np.ndarray]):
+        """Append one sample, without start or end tokens."""
+        self.write_many([sample])
+
+    def write_many(self, samples: typing.Iterable[typing.Union[typing.Sequence[int], np.ndarray]]):
+        """Append many samples with one write per file."""
+        samples = [np.asarray(sample) for sample in samples]
+        if not samples:
+            return
+        tokens = np.concatenate(samples)
+        if tokens.size and (tokens.min() < 0 or tokens.max() > np.iinfo(self.dtype).max):
+            raise ValueError(f"Token ids must be in [0, {np.iinfo(self.dtype).max}] to be stored as {self.dtype}.")
+        offsets = self.number_of_tokens + np.cumsum([len(sample) for sample in samples], dtype=OFFSETS_DTYPE)
+        self.tokens_file.write(tokens.astype(self.dtype).tobytes())
+        self.offsets_file.write(offsets.tobytes())
+        self.number_of_samples += len(samples)
+        self.number_of_tokens = int(offsets[-1])
+
+    def append_file(self, token_file: IndexedTokenFile, chunk_size: int = 1 << 24) -> str:
+        """Append every sample of another token file by copying its arrays, without decoding samples.
+        Returns the sha256 of the copied token bytes."""
+        if token_file.dtype != self.dtype:
+            raise ValueError(f"Can't append {token_file.dtype} tokens to a {self.dtype} file.")
+        checksum = hashlib.sha256()
+        with open(token_file_paths(token_file.path)[0], "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                checksum.update(block)
+                self.tokens_file.write(block)
+        self.offsets_file.write((np.asarray(token_file.offsets[1:]) + self.number_of_tokens).astype(OFFSETS_DTYPE).tobytes())
+        self.number_of_samples += token_file.number_of_samples
+        self.number_of_tokens += int(token_file.offsets[-1])
+        return checksum.hexdigest()
+
+    def close(self):
+        self.tokens_file.close()
+        self.offsets_file.close()
+        with open(self.header_path, "w") as f:
+            json.dump({'version': FORMAT_VERSION, 'dtype': self.dtype.name, 'num_samples': self.number_of_samples,
+                       'num_tokens': self.number_of_tokens}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
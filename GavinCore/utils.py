@@ -1,3 +1,7 @@
+import contextlib
+import time
+import typing
+
 import tensorflow as tf
 from .preprocessing.text import np
 
@@ -18,3 +22,22 @@ def convert_to_probabilities(y_true, vocab_size) -> tf.Tensor:
 
     del y_true
     return tf.convert_to_tensor(new_y_true)
+
+
+class PhaseTimer:
+    """Wall clock time of named phases, e.g. the startup phases of TransformerAbstract.load_model."""
+
+    def __init__(self):
+        self.timings: typing.Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self) -> typing.Dict[str, float]:
+        """Seconds per phase, in the order they ran, plus the total."""
+        return dict(self.timings, total=sum(self.timings.values()))
@@ -0,0 +1,552 @@
+import glob
+import os
+import shutil
+import unittest
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+from GavinCore.models import TransformerIntegration, RotaryTransformerIntegration, PerformerIntegration, FNetIntegration, tfds, np
+from GavinCore.utils import tf
+from GavinCore.decoding import BeamSearchDecoder, SamplingDecoder
+from GavinCore.serving import load_serving_model, load_tflite_model
+from GavinCore.quantization import quantization_report
+from GavinCore.benchmarks import favor_benchmark, transposed_attn_hat
+from GavinCore.callbacks import AttentionImageLoggingCallback, FeatureRedrawCallback
+from GavinCore.layers import GavinMultiHeadAttention, GavinMultiHeadPerformerAttention, MultiHeadPerformerReluAttention, \
+    scaled_dot_product_attention, blockwise_attention, FourierTransformationLayer, PositionalEncoding, positional_encoding_table, \
+    rotary_table, apply_rotary, RotaryPositionalEncoding, causal_mask, mask_logits, PaddingMaskLayer, LookAheadMaskLayer, \
+    orthogonal_gaussians, attn_hat, attn_hat_xla, causal_attn_hat, kernel_features, relu_kernel_transformation
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+class Inference(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tokenizer_path = os.path.join(BASE_DIR, os.path.join('tests/test_files', 'Tokenizer-3'))
+        self.tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(self.tokenizer_path)
+        self.config_for_models = {
+            'num_layers': 2,
+            'units': 256,
+            'd_model': 128,
+            'num_heads': 2,
+            'dropout': 0.1,
+            'max_len': 24,
+            'tokenizer': self.tokenizer,
+            'name': "TestInference",
+            'mixed': False,
+            'epochs': 0,
+            'batch_size': 32,
+            'base_log_dir': '../models/'
+        }
+        if not os.path.exists(self.config_for_models['base_log_dir']):
+            os.mkdir(self.config_for_models['base_log_dir'])
+        self.prompts = ["Hello there.", "How are you doing?", "What is your name?"]
+        tf.keras.backend.clear_session()
+
+    def test_001_incremental_decoding_matches_greedy(self):
+        """Key/value cached decoding should return the same tokens as re-running the full model."""
+        for model_type in [TransformerIntegration, RotaryTransformerIntegration, PerformerIntegration]:
+            with self.subTest(msg=f"Testing {model_type.__name__}"):
+                tf.random.set_seed(0)
+                config = self.config_for_models.copy()
+                if model_type is PerformerIntegration:
+                    config['num_features'] = 64
+                model = model_type(**config)
+                for prompt in self.prompts:
+                    expected = model.evaluate(prompt, use_cache=False)
+                    reply = model.evaluate(prompt, use_cache=True)
+                    np.testing.assert_array_equal(expected.numpy(), reply.numpy())
+
+    def test_002_predict_batch_matches_predict(self):
+        """Batched decoding should give each row the same reply as decoding it on its own."""
+        for model_type in [TransformerIntegration, PerformerIntegration, FNetIntegration]:
+            with self.subTest(msg=f"Testing {model_type.__name__}"):
+                tf.random.set_seed(0)
+                config = self.config_for_models.copy()
+                if model_type is PerformerIntegration:
+                    config['num_features'] = 64
+                model = model_type(**config)
+                replies = model.predict_batch(self.prompts)
+                self.assertEqual(len(self.prompts), len(replies))
+                self.assertEqual([model.predict(prompt) for prompt in self.prompts], replies)
+
+    def test_003_compiled_decoding_matches_eager(self):
+        """The tf.function (and XLA) decode loop should return the same tokens as running it eagerly."""
+        for model_type in [TransformerIntegration, PerformerIntegration]:
+            with self.subTest(msg=f"Testing {model_type.__name__}"):
+                tf.random.set_seed(0)
+                config = self.config_for_models.copy()
+                if model_type is PerformerIntegration:
+                    config['num_features'] = 64
+                model = model_type(**config)
+                expected = model.evaluate_batch(self.prompts, compiled=False)
+                for kwargs in [{'compiled': True}, {'jit_compile': True}, {'use_cache': False, 'compiled': True}]:
+                    np.testing.assert_array_equal(expected.numpy(), model.evaluate_batch(self.prompts, **kwargs).numpy())
+
+    def test_004_sampling_top_k_one_matches_greedy(self):
+        """Sampling from only the most likely token (or a tiny nucleus) is greedy decoding."""
+        tf.random.set_seed(0)
+        model = TransformerIntegration(**self.config_for_models)
+        expected = model.evaluate_batch(self.prompts)
+        for decoding_strategy in [SamplingDecoder(top_k=1), SamplingDecoder(top_p=1e-6)]:
+            np.testing.assert_array_equal(expected.numpy(),
+                                          model.evaluate_batch(self.prompts, decoding_strategy=decoding_strategy).numpy())
+
+    def test_005_beam_search_batch_matches_single(self):
+        """Beams of every sentence share one batch, each row should get the reply it gets on its own."""
+        tf.random.set_seed(0)
+        model = TransformerIntegration(**self.config_for_models)
+        decoding_strategy = BeamSearchDecoder(beam_width=3, length_penalty=0.6)
+        replies = model.evaluate_batch(self.prompts, decoding_strategy=decoding_strategy).numpy()
+        for prompt, reply in zip(self.prompts, replies):
+            expected = model.evaluate(prompt, decoding_strategy=decoding_strategy).numpy()
+            np.testing.assert_array_equal(expected, reply[:len(expected)])
+            self.assertFalse(reply[len(expected):].any())
+
+    def test_006_causal_performer_attention(self):
+        """Causal FAVOR+ must not look ahead, and its recurrent form must match the prefix sums."""
+        for layer_type in [GavinMultiHeadPerformerAttention, MultiHeadPerformerReluAttention]:
+            with self.subTest(msg=f"Testing {layer_type.__name__}"):
+                tf.random.set_seed(0)
+                layer = layer_type(64, 4, 32, causal=True)
+                inputs = tf.random.normal((2, 7, 64))
+                outputs = layer({'query': inputs, 'key': inputs, 'value': inputs, 'mask': None}).numpy()
+                changed = tf.concat([inputs[:, :4], tf.random.normal((2, 3, 64))], axis=1)
+                np.testing.assert_allclose(outputs[:, :4], layer({'query': changed, 'key': changed, 'value': changed,
+                                                                  'mask': None}).numpy()[:, :4], atol=1e-5)
+                cache = layer.initial_cache(2)
+                steps = [layer({'query': inputs[:, i:i + 1], 'key': inputs[:, i:i + 1], 'value': inputs[:, i:i + 1],
+                                'mask': None}, cache=cache, decode_step=i) for i in range(7)]
+                np.testing.assert_allclose(outputs, tf.concat(steps, axis=1).numpy(), atol=1e-5)
+
+    def test_007_export_serving_model(self):
+        """The exported string in, string out SavedModel should reply like predict_batch, without the Python model."""
+        prompts = self.prompts + ["", "Wow... that's, like, SO cool: don't_you think?! " * 6]
+        for model_type, kwargs in [(TransformerIntegration, {}), (TransformerIntegration, {'jit_compile': True}),
+                                   (FNetIntegration, {})]:
+            with self.subTest(msg=f"Testing {model_type.__name__} {kwargs}"):
+                tf.random.set_seed(0)
+                model = model_type(**self.config_for_models)
+                expected = [model.tokenizer.decode([i for i in prediction if i < model.tokenizer.vocab_size])
+                            for prediction in model.evaluate_batch(prompts, **kwargs).numpy()]
+                if not kwargs:
+                    self.assertEqual(model.predict_batch(prompts), expected)
+                export_dir = model.export_serving_model(**kwargs)
+                serving = load_serving_model(export_dir)
+                self.assertEqual(['saved_model', 'warmup', 'total'], list(serving.startup_timings))
+                outputs = serving.signatures['serving_default'](sentences=tf.constant(prompts))['outputs']
+                self.assertEqual(expected, [reply.decode('utf-8') for reply in outputs.numpy().tolist()])
+
+    def test_008_fast_load(self):
+        """Inference only loading should restore the same weights, without a MirroredStrategy or new directories."""
+        tf.random.set_seed(0)
+        model = TransformerIntegration(**dict(self.config_for_models, name="TestFastLoad"))
+        model.save_hparams()
+        expected = model.predict_batch(self.prompts)
+        checkpoint = os.path.join(model.log_dir, 'cp.ckpt')
+        shutil.rmtree(os.path.join(model.log_dir, 'images'))
+        for weights in ['cp.ckpt', 'saved_model']:
+            with self.subTest(msg=f"Testing {weights}"):
+                if weights == 'cp.ckpt':
+                    model.model.save_weights(checkpoint)
+                else:
+                    for path in glob.glob(checkpoint + '*'):
+                        os.remove(path)
+                    model.model.save(os.path.join(model.log_dir, 'saved_model'))
+                loaded = TransformerIntegration.load_model('../models/', model.name, inference_only=True, warmup=True)
+                self.assertEqual(['config', 'tokenizer', 'construct', 'build', 'weights', 'warmup', 'total'],
+                                 list(loaded.startup_timings))
+                self.assertNotIsInstance(loaded.strategy, tf.distribute.MirroredStrategy)
+                self.assertFalse(os.path.exists(os.path.join(model.log_dir, 'images')))
+                self.assertEqual(expected, loaded.predict_batch(self.prompts))
+                with self.assertRaises(ValueError):
+                    loaded.fit(None, epochs=1)
+
+    def test_009_quantization(self):
+        """int8 weights should stay close to the float model, and convert to TFLite."""
+        sentences = self.prompts + ["Where do you live?", "I like the weather today!"]
+        for model_type in [TransformerIntegration, PerformerIntegration, FNetIntegration]:
+            with self.subTest(msg=f"Testing {model_type.__name__}"):
+                tf.random.set_seed(0)
+                config = dict(self.config_for_models, name=f"TestQuantize{model_type.__name__}")
+                if model_type is PerformerIntegration:
+                    config['num_features'] = 64
+                model = model_type(**config)
+                with self.assertRaises(ValueError):
+                    model.quantize()
+                model.save_hparams()
+                model.model.save_weights(os.path.join(model.log_dir, 'cp.ckpt'))
+                quantized = model_type.load_model('../models/', model.name, inference_only=True, quantize=True)
+                self.assertIn('quantize', quantized.startup_timings)
+                weights = {weight.dtype for weight in quantized.model.weights}
+                self.assertIn(tf.int8, weights)
+
+                # the sentences are their own replies, the inputs have the same length for FNet
+                tokens = model.tokenize_batch(sentences, max_len=self.config_for_models['max_len'] + 1)
+                dataset = tf.data.Dataset.from_tensor_slices(({'inputs': tokens[:, :-1], 'dec_inputs': tokens[:, :-1]},
+                                                              {'outputs': tokens[:, 1:]})).batch(2)
+                tflite_path = quantized.export_tflite() if model_type is TransformerIntegration else None
+                report = quantization_report(model, quantized, dataset=dataset, sentences=sentences, tflite_path=tflite_path)
+                self.assertLess(report['quantized_weight_bytes'], report['float_weight_bytes'] / 3)
+                self.assertGreaterEqual(report['top1_agreement'], 0.9)
+                self.assertLess(report['mean_abs_logit_error'], 0.05)
+                # untrained models have near ties, so whole replies can still differ
+                self.assertTrue(0. <= report['reply_agreement'] <= 1.)
+                self.assertGreater(report['float_decode_seconds'], 0.)
+                self.assertGreater(report['quantized_decode_seconds'], 0.)
+                if tflite_path is not None:
+                    self.assertTrue(os.path.exists(tflite_path))
+                    output, length = load_tflite_model(tflite_path)(model.tokenize_batch(sentences).numpy())
+                    self.assertEqual((len(sentences), length), output[:, :length].shape)
+                    self.assertTrue(np.all(output[:, 0] == model.start_token[0]))
+                    self.assertIn('tflite_reply_agreement', report)
+                    self.assertGreater(report['tflite_decode_seconds'], 0.)
+
+    def test_010_fused_qkv(self):
+        """Fused self attention should load checkpoints saved with separate query, key & value Dense layers."""
+        inputs = tf.random.normal((2, 7, 64))
+        for layer_type in [GavinMultiHeadAttention, GavinMultiHeadPerformerAttention]:
+            with self.subTest(msg=f"Testing {layer_type.__name__}"):
+                def build(fused_qkv):
+                    args = (64, 4, 32) if layer_type is GavinMultiHeadPerformerAttention else (64, 4)
+                    layer = layer_type(*args, name="attention", fused_qkv=fused_qkv)
+                    layer_inputs = tf.keras.Input(shape=(None, 64))
+                    outputs = layer({'query': layer_inputs, 'key': layer_inputs, 'value': layer_inputs, 'mask': None})
+                    return layer, tf.keras.Model(inputs=layer_inputs, outputs=outputs)
+
+                layer, model = build(fused_qkv=False)
+                checkpoint = os.path.join(self.config_for_models['base_log_dir'], f'{layer_type.__name__}-qkv', 'cp.ckpt')
+                model.save_weights(checkpoint)
+                fused_layer, fused_model = build(fused_qkv=True)
+                fused_model.load_weights(checkpoint).expect_partial()
+                np.testing.assert_allclose(model(inputs).numpy(), fused_model(inputs).numpy(), atol=1e-5)
+
+                fused_model.save_weights(checkpoint)
+                self.assertTrue(any('qkv_dense' in name for name, _ in tf.train.list_variables(checkpoint)))
+                self.assertFalse(any('query_dense' in name for name, _ in tf.train.list_variables(checkpoint)))
+
+    def test_011_blockwise_attention(self):
+        """Blockwise attention should match the full attention matrix, values & gradients, and whole models with it."""
+        tf.random.set_seed(0)
+        query, key, value = tf.random.normal((2, 3, 7, 8)), tf.random.normal((2, 3, 10, 8)), tf.random.normal((2, 3, 10, 8))
+        masks = {'none': None, 'padding': 1 - tf.sequence_mask([6, 10], 10, dtype=tf.float32)[:, tf.newaxis, tf.newaxis, :],
+                 'look_ahead': 1 - tf.linalg.band_part(tf.ones((7, 10)), -1, 3)[tf.newaxis, tf.newaxis]}
+
+        def attention_and_gradients(mask):
+            with tf.GradientTape(persistent=True) as tape:
+                tape.watch([query, key, value])
+                expected, _ = scaled_dot_product_attention(query, key, value, mask, name_prefix="attention")
+                outputs = blockwise_attention(query, key, value, mask, block_size=4)
+                expected_loss, loss = tf.reduce_sum(tf.sin(expected)), tf.reduce_sum(tf.sin(outputs))
+            return expected, outputs, tape.gradient(expected_loss, [query, key, value]), tape.gradient(loss, [query, key, value])
+
+        for name, mask in masks.items():
+            for mode, function in [('eager', attention_and_gradients), ('graph', tf.function(attention_and_gradients)),
+                                   ('XLA', tf.function(attention_and_gradients, jit_compile=True))]:
+                with self.subTest(msg=f"Testing {name} mask ({mode})"):
+                    expected, outputs, expected_gradients, gradients = function(mask)
+                    np.testing.assert_allclose(expected.numpy(), outputs.numpy(), atol=1e-5)
+                    for expected_gradient, gradient in zip(expected_gradients, gradients):
+                        np.testing.assert_allclose(expected_gradient.numpy(), gradient.numpy(), atol=1e-5)
+
+        model = TransformerIntegration(**self.config_for_models)
+        blockwise = TransformerIntegration(**dict(self.config_for_models, attention_block_size=5))
+        self.assertEqual(5, blockwise.get_hparams()['ATTENTION_BLOCK_SIZE'])
+        blockwise.model.set_weights(model.model.get_weights())
+        sentences = model.tokenize_batch(self.prompts)
+        expected = model.model(model.model_inputs(sentences, sentences), training=False).numpy()
+        for function in [blockwise.model, tf.function(blockwise.model)]:
+            np.testing.assert_allclose(expected, function(blockwise.model_inputs(sentences, sentences), training=False).numpy(),
+                                       atol=1e-4)
+        for prompt in self.prompts:
+            np.testing.assert_array_equal(model.evaluate(prompt).numpy(), blockwise.evaluate(prompt).numpy())
+
+    def test_012_attention_capture(self):
+        """Attention images should only be captured on the training step the callback arms, blockwise or not."""
+        # no dropout, so both models' training steps see the same attention
+        config = dict(self.config_for_models, dropout=0.)
+        model = TransformerIntegration(**config)
+        blockwise = TransformerIntegration(**dict(config, attention_block_size=5))
+        blockwise.model.set_weights(model.model.get_weights())
+        sentences = model.tokenize_batch(self.prompts)
+        inputs = model.model_inputs(sentences, sentences)
+        for wrapper in [model, blockwise]:
+            with self.subTest(msg=f"Testing attention_block_size={wrapper.attention_block_size}"):
+                log_dir = os.path.join(wrapper.log_dir, 'attention_images')
+                callback = AttentionImageLoggingCallback(log_dir, update_freq=2, wrapper_model=wrapper)
+                layers = [layer for _, layer in callback.attention_layers]
+                self.assertEqual(3 * self.config_for_models['num_layers'], len(layers))
+                train_step = tf.function(lambda x: wrapper.model(x, training=True))
+                wrapper.evaluate(self.prompts[0])
+                for batch in range(2):
+                    callback.on_batch_begin(batch)
+                    train_step(inputs)
+                    if batch == 0:
+                        # nothing is captured until armed
+                        self.assertTrue(all(not np.any(layer.attention_image.numpy()) for layer in layers))
+                    callback.on_batch_end(batch)
+
+                for layer in layers:
+                    self.assertFalse(layer.capture_armed.numpy())
+                    # every (resized) row of the first example's attention sums to 1 over its keys
+                    image = layer.attention_image.numpy()
+                    np.testing.assert_allclose(image.sum(axis=-1), layer.attention_image_size / sentences.shape[1], rtol=1e-4)
+                self.assertTrue(glob.glob(os.path.join(log_dir, 'train', 'events.out.tfevents.*')))
+
+                # disarmed, other training steps keep the captured image
+                images = [layer.attention_image.numpy() for layer in layers]
+                train_step(model.model_inputs(sentences[::-1], sentences[::-1]))
+                for image, layer in zip(images, layers):
+                    np.testing.assert_array_equal(image, layer.attention_image.numpy())
+        for layer, blockwise_layer in zip(*[[layer for layer in wrapper.model.submodules
+                                             if isinstance(layer, GavinMultiHeadAttention)] for wrapper in [model, blockwise]]):
+            np.testing.assert_allclose(layer.attention_image.numpy(), blockwise_layer.attention_image.numpy(), atol=1e-5)
+
+        # fit runs its training steps in the replica context of the model's MirroredStrategy, set up like in fit
+        with model.strategy.scope():
+            model.setup_model()
+            model.compile()
+        callback = AttentionImageLoggingCallback(os.path.join(model.log_dir, 'attention_images'), update_freq=1,
+                                                 wrapper_model=model)
+        model.model.fit(inputs, sentences, batch_size=len(self.prompts), epochs=1, callbacks=[callback], verbose=0)
+        for _, layer in callback.attention_layers:
+            self.assertFalse(layer.capture_armed.numpy())
+            self.assertTrue(np.any(layer.attention_image.numpy()))
+
+        # the capture variables are neither weights of the model nor saved with it
+        captures = [variable for _, layer in callback.attention_layers for variable in [layer.capture_armed, layer.attention_image]]
+        self.assertFalse([weight for weight in model.model.weights if any(weight is variable for variable in captures)])
+        self.assertFalse([weight.name for weight in model.model.weights if 'capture_armed' in weight.name or 'attention_image' in weight.name])
+        checkpoint = os.path.join(model.log_dir, 'capture', 'cp.ckpt')
+        model.model.save_weights(checkpoint)
+        self.assertFalse([name for name, _ in tf.train.list_variables(checkpoint) if 'capture_armed' in name or 'attention_image' in name])
+
+    def test_013_fourier_modes(self):
+        """Every Fourier mode should give the real part of the complex FFT2D, in float16 too, and the same FNet."""
+        tf.random.set_seed(0)
+        for length, d_model in [(24, 128), (7, 9), (8, 10), (1, 1)]:
+            inputs = tf.random.normal((2, length, d_model))
+            expected = tf.math.real(tf.signal.fft2d(tf.cast(inputs, tf.complex64))).numpy()
+            for mode in FourierTransformationLayer.modes:
+                with self.subTest(msg=f"Testing {mode} {length}x{d_model}"):
+                    layer = FourierTransformationLayer(mode=mode)
+                    np.testing.assert_allclose(expected, layer(inputs).numpy(), atol=1e-4)
+                    np.testing.assert_allclose(expected, tf.function(layer)(inputs).numpy(), atol=1e-4)
+                    dynamic_length = tf.function(layer, input_signature=[tf.TensorSpec((None, None, d_model))])
+                    np.testing.assert_allclose(expected, dynamic_length(inputs).numpy(), atol=1e-4)
+                    half = FourierTransformationLayer(mode=mode, dtype=tf.float16)(tf.cast(inputs, tf.float16))
+                    self.assertEqual(tf.float16, half.dtype)
+                    np.testing.assert_allclose(expected, half.numpy(), atol=0.05 * np.abs(expected).max())
+        with self.assertRaises(ValueError):
+            FourierTransformationLayer(mode='fft3d')
+
+        config = dict(self.config_for_models, name="TestFourierModes")
+        model = FNetIntegration(**config)
+        self.assertEqual('rfft', model.get_hparams()['FOURIER_MODE'])
+        sentences = model.tokenize_batch(self.prompts, max_len=model.max_len)
+        expected = model.model(model.model_inputs(sentences, sentences), training=False).numpy()
+        for mode in ['fft', 'dft']:
+            other = FNetIntegration(**dict(config, fourier_mode=mode))
+            other.model.set_weights(model.model.get_weights())
+            np.testing.assert_allclose(expected, other.model(other.model_inputs(sentences, sentences), training=False).numpy(),
+                                       atol=1e-4)
+            self.assertEqual(model.predict_batch(self.prompts), other.predict_batch(self.prompts))
+
+    def test_014_positional_encoding_table(self):
+        """Positional encodings should come from one right sized table shared by every model, extended when needed."""
+        models = [TransformerIntegration(**self.config_for_models), TransformerIntegration(**self.config_for_models)]
+        layers = [layer for model in models for layer in model.model.submodules if isinstance(layer, PositionalEncoding)]
+        self.assertEqual(4, len(layers))
+        d_model = self.config_for_models['d_model']
+        for layer in layers:
+            self.assertEqual(self.config_for_models['max_len'] + 1, layer.position)
+            np.testing.assert_array_equal(positional_encoding_table(layer.position, d_model), layer.pos_encoding[0])
+            self.assertTrue(np.shares_memory(positional_encoding_table(layer.position, d_model), layer.pos_encoding))
+        self.assertTrue(np.shares_memory(positional_encoding_table(3, d_model), positional_encoding_table(7, d_model)))
+
+        layer = PositionalEncoding(8, d_model)
+        inputs = tf.random.normal((2, 12, d_model))
+        # the in graph encodings of the positions, as the tables used to be made
+        expected = (inputs + layer.positional_encoding(tf.range(12, dtype=tf.float32), d_model)).numpy()
+        np.testing.assert_allclose(expected, layer(inputs).numpy(), atol=1e-5)
+        # calls don't change the layer's config
+        self.assertEqual({'d_model': d_model, 'position': 8}, layer.get_config())
+        dynamic_length = tf.function(layer.call, input_signature=[tf.TensorSpec((None, None, d_model))])
+        np.testing.assert_allclose(expected, dynamic_length(inputs).numpy(), atol=1e-5)
+        np.testing.assert_allclose(expected[:, 5:6], layer(inputs[:, 5:6], position=tf.constant(5)).numpy(), atol=1e-5)
+        np.testing.assert_allclose(expected[:, 5:6], layer(inputs[:, 5:6], position=5).numpy(), atol=1e-5)
+
+        # packed inputs, the positions restart with the second segment of the first row
+        segments = tf.constant([[1] * 5 + [2] * 7, [1] * 12])
+        mask = 1 - tf.cast(tf.equal(segments[:, :, tf.newaxis], segments[:, tf.newaxis, :]), tf.float32)[:, tf.newaxis]
+        packed = layer(inputs, attention_mask=mask).numpy()
+        np.testing.assert_allclose(expected[1], packed[1], atol=1e-5)
+        np.testing.assert_allclose(expected[0, :7] - inputs[0, :7] + inputs[0, 5:], packed[0, 5:], atol=1e-5)
+        dynamic_length = tf.function(lambda x, m: layer(x, attention_mask=m),
+                                     input_signature=[tf.TensorSpec((None, None, d_model)), tf.TensorSpec((None, 1, None, None))])
+        np.testing.assert_allclose(packed, dynamic_length(inputs, mask).numpy(), atol=1e-5)
+
+    def test_015_rotary_embeddings(self):
+        """Rotary models should rotate the query & key inside self attention, with shared tables & position offsets."""
+        depth = 16
+        cos, sin = rotary_table(10, depth)
+        self.assertTrue(np.shares_memory(cos, rotary_table(4, depth)[0]))
+        layer = GavinMultiHeadAttention(2 * depth, 2, rotary_positions=8)
+        for offset, length in [(0, 10), (3, 4), (tf.constant(3), 4), (tf.constant(0), tf.constant(10))]:
+            with self.subTest(msg=f"Testing offset {offset} & length {length}"):
+                # past rotary_positions the angles are computed instead of sliced from the table
+                expected = np.arange(int(offset), int(offset) + int(length))[:, np.newaxis]
+                rotation = layer.rotary_embedding(offset, length)
+                np.testing.assert_allclose(rotary_table(20, depth)[0][expected[:, 0]], rotation[0].numpy(), atol=1e-5)
+                np.testing.assert_allclose(rotary_table(20, depth)[1][expected[:, 0]], rotation[1].numpy(), atol=1e-5)
+
+        # the scores only depend on the distance between the query & the key
+        query, key = tf.random.normal((1, 1, 1, depth)), tf.random.normal((1, 1, 1, depth))
+        scores = [float(tf.reduce_sum(apply_rotary(query, *layer.rotary_embedding(i + 2, 1)) *
+                                      apply_rotary(key, *layer.rotary_embedding(i, 1)))) for i in range(12)]
+        np.testing.assert_allclose(scores[0], scores, rtol=1e-4)
+
+        tf.random.set_seed(0)
+        model = RotaryTransformerIntegration(**self.config_for_models)
+        self.assertFalse([layer for layer in model.model.submodules if isinstance(layer, PositionalEncoding)])
+        attention = [layer for layer in model.model.submodules if isinstance(layer, GavinMultiHeadAttention)]
+        # the encoder's & the decoder's self attention, not the decoder's attention over the encoder outputs
+        self.assertEqual([self.config_for_models['max_len'] + 1] * 4 + [None] * 2,
+                         sorted([layer.rotary_positions for layer in attention], key=str))
+        # the cached keys keep the rotation of their positions, under XLA too
+        expected = model.evaluate_batch(self.prompts, use_cache=False, compiled=False)
+        for kwargs in [{'compiled': False}, {'compiled': True}, {'jit_compile': True}]:
+            np.testing.assert_array_equal(expected.numpy(), model.evaluate_batch(self.prompts, **kwargs).numpy())
+
+        # configs saved with the old RotaryPositionalEncoding layer still load, it passes the embeddings through
+        with self.assertWarns(DeprecationWarning):
+            layer = tf.keras.layers.deserialize({'class_name': 'GavinCore>RotaryPositionalEncoding', 'config': {}})
+        self.assertIsInstance(layer, RotaryPositionalEncoding)
+        embeddings = tf.random.normal((2, 5, 2 * depth))
+        np.testing.assert_array_equal(embeddings.numpy(), layer(embeddings).numpy())
+        with self.assertWarns(DeprecationWarning):
+            inputs = tf.keras.Input(shape=(None, 2 * depth))
+            old_model = tf.keras.Model(inputs, tf.keras.layers.Dense(4)(RotaryPositionalEncoding()(inputs)))
+            loaded = tf.keras.models.model_from_json(old_model.to_json())
+        loaded.set_weights(old_model.get_weights())
+        np.testing.assert_allclose(old_model(embeddings).numpy(), loaded(embeddings).numpy(), atol=1e-6)
+
+    def test_016_boolean_masks(self):
+        """Masks should be boolean, the causal part cached, and padding free batches skip masking the logits."""
+        expected = np.triu(np.ones((7, 7), dtype=bool), k=1)
+        np.testing.assert_array_equal(expected, causal_mask(7).numpy())
+        np.testing.assert_array_equal(expected[:3, :3], causal_mask(3).numpy())
+        dynamic_length = tf.function(lambda x: LookAheadMaskLayer()(x), input_signature=[tf.TensorSpec((None, None), tf.int32)])
+        inputs = tf.constant([[5, 6, 7, 0, 0, 0, 0], [5, 6, 7, 8, 9, 10, 11]])
+        # the float mask the layer used to build
+        padding = tf.cast(tf.equal(inputs, 0), tf.float32)[:, tf.newaxis, tf.newaxis, :]
+        float_mask = tf.maximum(1 - tf.linalg.band_part(tf.ones((7, 7)), -1, 0), padding)
+        for mask in [LookAheadMaskLayer()(inputs), dynamic_length(inputs)]:
+            self.assertEqual(tf.bool, mask.dtype)
+            np.testing.assert_array_equal(float_mask.numpy().astype(bool), mask.numpy())
+
+        logits = tf.random.normal((2, 2, 7, 7))
+        masked = mask_logits(logits, PaddingMaskLayer()(inputs)).numpy()
+        np.testing.assert_array_equal(-1e9, masked[0, :, :, 3:])
+        np.testing.assert_array_equal(logits[:, :, :, :3].numpy(), masked[:, :, :, :3])
+        self.assertIs(logits, mask_logits(logits, PaddingMaskLayer()(inputs[1:])[[0, 0]]))
+        query, key, value = [tf.random.normal((2, 2, 7, 16)) for _ in range(3)]
+        for mask in [padding, float_mask]:
+            np.testing.assert_allclose(scaled_dot_product_attention(query, key, value, mask, 'float')[0].numpy(),
+                                       scaled_dot_product_attention(query, key, value, mask > 0, 'bool')[0].numpy(),
+                                       atol=1e-6)
+
+        model = TransformerIntegration(**self.config_for_models)
+        # the decoder attends over the encoder inputs with their padding mask
+        with self.assertRaises(ValueError):
+            model.model.get_layer('dec_padding_mask')
+        self.assertEqual(1, len([layer for layer in model.model.layers if isinstance(layer, PaddingMaskLayer)]))
+
+    def test_017_performer_feature_redraw(self):
+        """Performer random features should be saved with the model, and only redrawn by the callback while training."""
+        matrices = orthogonal_gaussians(3, 40, 16).numpy()
+        self.assertEqual((3, 40, 16), matrices.shape)
+        for matrix in matrices:
+            # orthogonal rows within each 16 × 16 block, scaled by 1 / sqrt(2 + 8 / 16)
+            np.testing.assert_allclose(np.eye(16) / 2.5, matrix[:16] @ matrix[:16].T, atol=1e-5)
+        self.assertFalse(np.allclose(matrices[0], matrices[1]))
+
+        config = dict(self.config_for_models, num_features=64, feature_redraw_steps=2)
+        model = PerformerIntegration(**config)
+        self.assertEqual(2, model.get_hparams()['FEATURE_REDRAW_STEPS'])
+        self.assertTrue([callback for callback in model.get_default_callbacks() if isinstance(callback, FeatureRedrawCallback)])
+        layers = [layer for layer in model.model.submodules if isinstance(layer, GavinMultiHeadPerformerAttention)]
+        self.assertTrue(all(any(weight is layer.random_feats for weight in model.model.non_trainable_weights)
+                            for layer in layers))
+
+        checkpoint = os.path.join(model.log_dir, 'random_feats', 'cp.ckpt')
+        model.model.save_weights(checkpoint)
+        other = PerformerIntegration(**config)
+        other.model.load_weights(checkpoint)
+        expected = model.evaluate_batch(self.prompts)
+        np.testing.assert_array_equal(expected.numpy(), other.evaluate_batch(self.prompts).numpy())
+
+        # inference keeps the features, training redraws them every 2 batches
+        features = [layer.random_feats.numpy() for layer in layers]
+        model.evaluate_batch(self.prompts, compiled=False)
+        for feature, layer in zip(features, layers):
+            np.testing.assert_array_equal(feature, layer.random_feats.numpy())
+        with model.strategy.scope():
+            model.setup_model()
+            model.compile()
+        layers = [layer for layer in model.model.submodules if isinstance(layer, GavinMultiHeadPerformerAttention)]
+        features = [layer.random_feats.numpy() for layer in layers]
+        sentences = model.tokenize_batch(self.prompts * 2, max_len=model.max_len)
+        callback = FeatureRedrawCallback(2)
+        redraws = []
+        callback.redraw = (lambda redraw: lambda: redraws.append(redraw()))(callback.redraw)
+        model.model.fit(model.model_inputs(sentences, sentences), sentences, batch_size=len(self.prompts), epochs=2,
+                        callbacks=[callback], verbose=0)
+        self.assertEqual(2, len(redraws))
+        for feature, layer in zip(features, layers):
+            self.assertFalse(np.allclose(feature, layer.random_feats.numpy()))
+
+    def test_018_fused_favor_attention(self):
+        """FAVOR+ in the heads' B, H, L, D layout should match the sequence major version it replaced, XLA too."""
+        query, key, value = [tf.random.normal((2, 4, 33, 16)) for _ in range(3)]
+        random_feats = orthogonal_gaussians(1, 32, 16)[0]
+        expected = transposed_attn_hat(query, key, value, random_feats).numpy()
+        self.assertEqual((2, 33, 4, 16), expected.shape)
+        np.testing.assert_allclose(expected, attn_hat(query, key, value, random_feats=random_feats).numpy(), atol=1e-5)
+        np.testing.assert_allclose(expected, attn_hat_xla(query, key, value, random_feats=random_feats).numpy(), atol=1e-5)
+
+        timings = favor_benchmark(batch_size=1, num_heads=2, sequence_length=16, depth=8, num_features=8, iterations=1)
+        self.assertEqual(['transposed', 'fused', 'fused_xla'], list(timings))
+        self.assertTrue(all(seconds > 0 for seconds in timings.values()))
+
+    def test_019_chunked_causal_favor(self):
+        """Chunked causal FAVOR+ should match the prefix sums it replaced on long sequences, gradients included."""
+        def prefix_sum_attn_hat(query, key, value, phi_fun=None, random_feats=None):
+            # the B×H×L×M×D prefix sum of the key/value outer products, as causal_attn_hat used to be computed
+            q_prime = kernel_features(query, is_query=True, phi_fun=phi_fun, random_feats=random_feats)
+            k_prime = kernel_features(key, is_query=False, phi_fun=phi_fun, random_feats=random_feats, causal=True)
+            kv_prefix = tf.math.cumsum(tf.einsum("bhlm,bhld->bhlmd", k_prime, value), axis=2)
+            av_attention = tf.einsum("bhlm,bhlmd->blhd", q_prime, kv_prefix)
+            normalizer = tf.einsum("bhlm,bhlm->blh", q_prime, tf.math.cumsum(k_prime, axis=2))
+            return av_attention / tf.expand_dims(normalizer, -1)
+
+        tf.random.set_seed(0)
+        random_feats = orthogonal_gaussians(1, 32, 16)[0]
+        weights = tf.random.normal((2, 300, 4, 16))
+        chunked = tf.function(lambda q, k, v: causal_attn_hat(q, k, v, random_feats=random_feats, chunk_size=64))
+        for length, phi_fun in [(300, None), (300, relu_kernel_transformation), (5, None)]:
+            with self.subTest(msg=f"Testing length {length} & {getattr(phi_fun, '__name__', 'softmax')}"):
+                query, key, value = [tf.random.normal((2, 4, length, 16)) * 0.5 for _ in range(3)]
+                results = []
+                for attention in [lambda q, k, v: prefix_sum_attn_hat(q, k, v, phi_fun=phi_fun, random_feats=random_feats),
+                                  lambda q, k, v: causal_attn_hat(q, k, v, phi_fun=phi_fun, random_feats=random_feats,
+                                                                  chunk_size=64)]:
+                    with tf.GradientTape() as tape:
+                        tape.watch([query, key, value])
+                        outputs = attention(query, key, value)
+                        loss = tf.reduce_sum(outputs * weights[:, :length])
+                    results.append([outputs] + tape.gradient(loss, [query, key, value]))
+                self.assertEqual((2, length, 4, 16), results[1][0].shape)
+                for expected, result in zip(*results):
+                    np.testing.assert_allclose(expected.numpy(), result.numpy(), rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(results[0][0].numpy(), chunked(query, key, value).numpy(), rtol=1e-4, atol=1e-4)
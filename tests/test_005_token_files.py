@@ -0,0 +1,155 @@
+import base64
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+from GavinCore.token_files import IndexedTokenFile, IndexedTokenFileWriter
+from GavinCore.datasets import DatasetDirectFromFileAPICreator
+from GavinCore.load_data import convert_tokenized_chunk, convert_tokenized_data, load_tokenized_data, source_fingerprint, \
+    tokenized_read_thread
+
+
+class TokenFiles(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "Tokenizer-3-from")
+        self.start_token = 69908
+        self.end_token = 69909
+        self.max_len = 8
+        rng = np.random.default_rng(0)
+        self.samples = [rng.integers(1, 69908, size=rng.integers(0, 12)).tolist() for _ in range(50)]
+        with IndexedTokenFileWriter(self.path, vocab_size=69908) as writer:
+            writer.write(self.samples[0])
+            writer.write_many(self.samples[1:])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def padded(self, sample):
+        sample = [self.start_token] + sample[:self.max_len - 2] + [self.end_token]
+        return sample + [0] * (self.max_len - len(sample))
+
+    def test_001_random_access(self):
+        token_file = IndexedTokenFile(self.path)
+        self.assertEqual(len(self.samples), len(token_file))
+        self.assertEqual(np.int32, token_file.dtype)
+        for index in [0, 17, 49, -1]:
+            self.assertEqual(self.samples[index], token_file.sample(index).tolist())
+        np.testing.assert_array_equal([len(sample) for sample in self.samples], token_file.lengths)
+        with self.assertRaises(IndexError):
+            token_file.sample(50)
+
+    def test_002_padded_batches(self):
+        token_file = IndexedTokenFile(self.path, self.start_token, self.end_token, self.max_len, 0)
+        indices = [3, 0, 42, 7]
+        batch = token_file.batch(indices)
+        self.assertEqual((len(indices), self.max_len), batch.shape)
+        self.assertEqual([self.padded(self.samples[index]) for index in indices], batch.tolist())
+        self.assertEqual(self.padded(self.samples[5]), token_file[5].tolist())
+
+    def test_003_dataset_from_token_files(self):
+        answers_path = os.path.join(self.directory, "Tokenizer-3-to")
+        with IndexedTokenFileWriter(answers_path, vocab_size=69908) as writer:
+            writer.write_many(reversed(self.samples))
+        dataset_train, _ = DatasetDirectFromFileAPICreator.create_data_objects(self.path, answers_path, buffer_size=1,
+                                                                               batch_size=4, vocab_size=69910,
+                                                                               max_length=self.max_len,
+                                                                               number_of_samples=len(self.samples),
+                                                                               start_token=self.start_token,
+                                                                               end_token=self.end_token,
+                                                                               padding_value=0)
+        inputs, outputs = next(iter(dataset_train))
+        self.assertEqual((4, self.max_len), tuple(inputs['inputs'].shape))
+        for row in inputs['inputs'].numpy().tolist():
+            self.assertIn(row, [self.padded(sample) for sample in self.samples])
+
+    def write_text_files(self):
+        """Write the samples in the pickled & base64 encoded .from/.to format."""
+        for part, samples in [("from", self.samples), ("to", self.samples[::-1])]:
+            with open(os.path.join(self.directory, f"Tokenizer-3.{part}"), "w") as f:
+                for sample in samples:
+                    f.write(str(base64.b64encode(pickle.dumps(sample))) + "\n")
+        return self.directory + os.sep
+
+    def test_004_convert_text_files(self):
+        data_path = self.write_text_files()
+        # small chunks so the lines are split between several processes
+        manifests = convert_tokenized_data(data_path, "Tokenizer-3", vocab_size=69908, num_workers=2, chunk_size=300)
+        self.assertGreater(len(manifests[0]['chunks']), 1)
+        for manifest, part in zip(manifests, ["from", "to"]):
+            self.assertEqual(len(self.samples), manifest['num_samples'])
+            expected = tokenized_read_thread(os.path.join(data_path, f"Tokenizer-3.{part}"), len(self.samples) * 2,
+                                             [self.start_token], [self.end_token])
+            token_file = IndexedTokenFile(os.path.join(data_path, f"Tokenizer-3-{part}"), self.start_token, self.end_token)
+            self.assertEqual(expected, [token_file[i].tolist() for i in range(len(token_file))])
+        self.assertFalse(os.path.exists(os.path.join(data_path, "Tokenizer-3-from.chunks")))
+
+        questions, answers = load_tokenized_data(20, data_path, "Tokenizer-3", [self.start_token], [self.end_token],
+                                                 max_len=self.max_len)
+        self.assertEqual([self.padded(sample) for sample in self.samples[:10]], questions.tolist())
+        self.assertEqual([self.padded(sample) for sample in self.samples[::-1][:10]], answers.tolist())
+
+    def test_005_convert_skips_and_resumes(self):
+        data_path = self.write_text_files()
+        output = os.path.join(data_path, "Tokenizer-3-from")
+        manifest, _ = convert_tokenized_data(data_path, "Tokenizer-3", vocab_size=69908, num_workers=1, chunk_size=300)
+        modified = os.stat(output + ".tokens").st_mtime_ns
+        self.assertEqual(manifest, convert_tokenized_data(data_path, "Tokenizer-3", vocab_size=69908, chunk_size=300)[0])
+        self.assertEqual(modified, os.stat(output + ".tokens").st_mtime_ns)
+
+        # An interrupted run leaves finished chunks behind, they are reused rather than converted again.
+        os.remove(output + ".manifest.json")
+        source = os.path.join(data_path, "Tokenizer-3.from")
+        os.makedirs(output + ".chunks")
+        with open(os.path.join(output + ".chunks", "plan.json"), "w") as f:
+            json.dump({'source': source_fingerprint(source), 'chunk_size': 300, 'dtype': 'int32'}, f)
+        chunk = os.path.join(output + ".chunks", "000000")
+        entry = convert_tokenized_chunk(source, chunk, 0, 300, 'int32')
+        with open(chunk + ".done", "w") as f:
+            json.dump(dict(entry, finished_before=True), f)
+        resumed, _ = convert_tokenized_data(data_path, "Tokenizer-3", vocab_size=69908, num_workers=1, chunk_size=300)
+        self.assertTrue(resumed['chunks'][0].pop('finished_before'))
+        self.assertEqual(manifest, resumed)
+
+    def test_006_streamed_dataset(self):
+        """Every sample should be read exactly once per epoch, split between the workers and from the cache."""
+        answers_path = os.path.join(self.directory, "Tokenizer-3-to")
+        with IndexedTokenFileWriter(answers_path, vocab_size=69908) as writer:
+            writer.write_many(self.samples)
+        config = dict(questions_file=self.path, answers_file=answers_path, buffer_size=8, batch_size=4, vocab_size=69910,
+                      max_length=self.max_len, number_of_samples=len(self.samples), start_token=self.start_token,
+                      end_token=self.end_token, padding_value=0, num_shards=4)
+
+        def rows(datasets):
+            rows = []
+            for dataset in datasets:
+                for inputs, outputs in dataset:
+                    self.assertEqual(inputs['inputs'].shape[1:], outputs['outputs'].shape[1:])
+                    np.testing.assert_array_equal(inputs['inputs'].numpy()[:, 1:], outputs['outputs'].numpy()[:, :-1])
+                    rows += inputs['inputs'].numpy().tolist()
+            return sorted(rows)
+
+        expected = sorted(self.padded(sample) for sample in self.samples)
+        self.assertEqual(expected, rows(DatasetDirectFromFileAPICreator.create_data_objects(**config)))
+        workers = [rows(DatasetDirectFromFileAPICreator.create_data_objects(num_workers=2, worker_index=i, **config))
+                   for i in range(2)]
+        self.assertEqual(expected, sorted(workers[0] + workers[1]))
+        self.assertTrue(workers[0] and workers[1])
+
+        cached = DatasetDirectFromFileAPICreator.create_data_objects(cache_path=os.path.join(self.directory, "cache"), **config)
+        self.assertEqual(expected, rows(cached))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "cache-train.index")))
+        self.assertEqual(expected, rows(cached))
+
+        # the validation samples aren't shuffled, they're read in file order
+        split = int(len(self.samples) * .8)
+        for cache_path in [None, os.path.join(self.directory, "cache")]:
+            _, dataset_val = DatasetDirectFromFileAPICreator.create_data_objects(cache_path=cache_path, **config)
+            self.assertEqual([self.padded(sample) for sample in self.samples[split:]],
+                             [row for inputs, _ in dataset_val for row in inputs['inputs'].numpy().tolist()])
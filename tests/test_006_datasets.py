@@ -0,0 +1,138 @@
+import os
+import unittest
+
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+from GavinCore.models import TransformerIntegration, PerformerIntegration, tfds
+from GavinCore.utils import tf
+from GavinCore.datasets import DatasetAPICreator
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+class Datasets(unittest.TestCase):
+    def setUp(self) -> None:
+        self.max_len = 24
+        self.start_token = 1000
+        self.end_token = 1001
+        rng = np.random.default_rng(0)
+        self.questions = self.padded([rng.integers(1, 1000, size=rng.integers(0, 30)).tolist() for _ in range(200)])
+        self.answers = self.padded([rng.integers(1, 1000, size=rng.integers(0, 30)).tolist() for _ in range(200)])
+        if not os.path.exists('../models/'):
+            os.mkdir('../models/')
+        tf.keras.backend.clear_session()
+
+    def padded(self, samples):
+        samples = [[self.start_token] + sample[:self.max_len - 2] + [self.end_token] for sample in samples]
+        return tf.keras.preprocessing.sequence.pad_sequences(samples, maxlen=self.max_len, padding='post')
+
+    @staticmethod
+    def unpadded_samples(dataset):
+        """Every sample of a dataset with the padding removed, in a comparable order."""
+        samples = []
+        for inputs, outputs in dataset:
+            for row in zip(inputs['inputs'].numpy(), inputs['dec_inputs'].numpy(), outputs['outputs'].numpy()):
+                samples.append(tuple(tuple(np.trim_zeros(part, 'b').tolist()) for part in row))
+        return sorted(samples)
+
+    def test_001_bucketed_batches(self):
+        """Bucketed batches should hold the same samples, padded only to the longest sample in the batch."""
+        tokens_per_batch = 128
+        bucket_boundaries = [8, 16]
+        expected = DatasetAPICreator.create_data_objects(self.questions, self.answers, buffer_size=1, batch_size=8,
+                                                         vocab_size=1002)
+        bucketed = DatasetAPICreator.create_data_objects(self.questions, self.answers, buffer_size=1, batch_size=8,
+                                                         vocab_size=1002, bucket_boundaries=bucket_boundaries,
+                                                         tokens_per_batch=tokens_per_batch)
+        for expected_dataset, dataset in zip(expected, bucketed):
+            self.assertEqual(self.unpadded_samples(expected_dataset), self.unpadded_samples(dataset))
+            widths = []
+            for inputs, outputs in dataset:
+                width = max(inputs['inputs'].shape[1], inputs['dec_inputs'].shape[1])
+                widths.append(width)
+                self.assertEqual(inputs['dec_inputs'].shape, outputs['outputs'].shape)
+                self.assertLessEqual(inputs['inputs'].shape[0] * width, tokens_per_batch)
+                # at least one row of the batch is as long as the batch, otherwise it was padded more than needed
+                lengths = [DatasetAPICreator.sequence_lengths(part.numpy()).max()
+                           for part in [inputs['inputs'], inputs['dec_inputs'], outputs['outputs']]]
+                self.assertEqual(width, max(lengths))
+            self.assertLess(min(widths), self.max_len)
+
+    def test_002_train_on_bucketed_batches(self):
+        """The loss & metrics should accept batches shorter than max_len."""
+        tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
+            os.path.join(BASE_DIR, os.path.join('tests/test_files', 'Tokenizer-3')))
+        model = TransformerIntegration(num_layers=1, units=64, d_model=32, num_heads=2, dropout=0.1,
+                                       max_len=self.max_len, tokenizer=tokenizer, name="TestDatasets", mixed=False,
+                                       epochs=0, batch_size=8, base_log_dir='../models/')
+        questions = np.minimum(self.questions, tokenizer.vocab_size - 1)
+        answers = np.minimum(self.answers, tokenizer.vocab_size - 1)
+        dataset_train, dataset_val = DatasetAPICreator.create_data_objects(questions, answers, buffer_size=1,
+                                                                           batch_size=8, vocab_size=model.vocab_size,
+                                                                           tokens_per_batch=128)
+        history = model.fit(training_dataset=dataset_train, validation_dataset=dataset_val, epochs=1, callbacks=[],
+                            verbose=0)
+        self.assertTrue(np.isfinite(history.history['loss'][0]))
+        self.assertTrue(np.isfinite(history.history['val_loss'][0]))
+
+    def test_003_packed_samples(self):
+        """Packing should keep every sample whole inside one segment of one row, with the same targets as unpacked."""
+        packed = DatasetAPICreator.pack_samples(self.questions, self.answers)
+        self.assertEqual(self.max_len, packed['inputs'].shape[1])
+        self.assertLess(len(packed['inputs']), len(self.questions))
+        inputs, targets = DatasetAPICreator.packed_teacher_forcing({key: tf.constant(value) for key, value in packed.items()})
+        inputs = {key: value.numpy() for key, value in inputs.items()}
+
+        samples = []
+        for row in range(len(inputs['inputs'])):
+            for segment in range(1, inputs['inputs_segments'][row].max() + 1):
+                question = inputs['inputs_segments'][row] == segment
+                answer = inputs['dec_segments'][row] == segment
+                samples.append(tuple(tuple(np.trim_zeros(part, 'b').tolist()) for part in [
+                    inputs['inputs'][row][question], inputs['dec_inputs'][row][answer], targets['outputs'].numpy()[row][answer]]))
+        _, outputs = DatasetAPICreator.batch_teacher_forcing(self.questions, self.answers)
+        expected = [tuple(tuple(np.trim_zeros(part, 'b').tolist()) for part in sample)
+                    for sample in zip(self.questions, self.answers, outputs['outputs'].numpy())]
+        self.assertEqual(sorted(expected), sorted(samples))
+
+    def test_004_segments_are_independent(self):
+        """A sample packed with others should get the same predictions as the sample on its own."""
+        tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
+            os.path.join(BASE_DIR, os.path.join('tests/test_files', 'Tokenizer-3')))
+        config = dict(num_layers=1, units=64, d_model=32, num_heads=2, dropout=0.1, max_len=self.max_len,
+                      tokenizer=tokenizer, name="TestDatasets", mixed=False, epochs=0, batch_size=8,
+                      base_log_dir='../models/')
+        with self.assertRaises(ValueError):
+            PerformerIntegration(num_features=16, packed_inputs=True, **config)
+        model = TransformerIntegration(packed_inputs=True, **config)
+        self.assertEqual(True, model.get_hparams()['PACKED_INPUTS'])
+        samples = [([3, 5, 7], [11, 13, 17, 19]), ([23, 29], [31, 37, 41]), ([43, 47, 53, 59], [61, 67])]
+        packed = {'inputs': np.array([sum([question for question, _ in samples], [])]),
+                  'dec_inputs': np.array([sum([answer for _, answer in samples], [])]),
+                  'inputs_segments': np.array([sum([[i + 1] * len(question) for i, (question, _) in enumerate(samples)], [])]),
+                  'dec_segments': np.array([sum([[i + 1] * len(answer) for i, (_, answer) in enumerate(samples)], [])])}
+        predictions = model.model(packed, training=False).numpy()[0]
+        start = 0
+        for question, answer in samples:
+            expected = model.model(model.model_inputs(tf.constant([question]), tf.constant([answer])), training=False)
+            np.testing.assert_allclose(expected.numpy()[0], predictions[start:start + len(answer)], rtol=1e-4, atol=1e-4)
+            start += len(answer)
+
+    def test_005_teacher_forcing(self):
+        """The batched shift should match the per sample copy & roll it replaced."""
+        dec_inputs, outputs = self.answers.copy(), self.answers.copy()
+        dec_inputs[:, -1] = 0
+        outputs[:, 0] = 0
+        outputs = np.roll(outputs, -1, axis=1)
+        inputs, targets = DatasetAPICreator.batch_teacher_forcing(self.questions, self.answers)
+        np.testing.assert_array_equal(dec_inputs, inputs['dec_inputs'].numpy())
+        np.testing.assert_array_equal(outputs, targets['outputs'].numpy())
+
+        dataset_train, _ = DatasetAPICreator.create_data_objects(self.questions, self.answers, buffer_size=1,
+                                                                 batch_size=len(self.questions), vocab_size=1002)
+        inputs, targets = next(iter(dataset_train))
+        np.testing.assert_array_equal(self.questions[:160], inputs['inputs'].numpy())
+        np.testing.assert_array_equal(dec_inputs[:160], inputs['dec_inputs'].numpy())
+        np.testing.assert_array_equal(outputs[:160], targets['outputs'].numpy())
@@ -0,0 +1,133 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+from GavinCore.models import tfds
+from GavinCore.utils import tf
+from GavinCore.preprocessing.text import TextNormaliser, preprocess_sentence, read_thread
+from GavinCore.preprocessing.tokenization import GraphSubwordEncoder, TokenizationEngine
+from GavinCore.token_files import IndexedTokenFile
+from GavinCore.load_data import load_tokenized_data
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+class Tokenization(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
+            os.path.join(BASE_DIR, os.path.join('tests/test_files', 'Tokenizer-3')))
+        self.lines = ["Hello there, how are you?", "I'm fine thanks newlinechar and you?", "", "what's 2 + 2?",
+                      "\"Quote\" me: on@this!"] * 20
+        for part, lines in [("from", self.lines), ("to", self.lines[::-1])]:
+            with open(os.path.join(self.directory, f"train.{part}"), "w", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in lines)
+        self.data_path = self.directory + os.sep
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def expected(self, lines):
+        return [self.tokenizer.encode(preprocess_sentence(line)) for line in lines]
+
+    def test_001_cached_encode(self):
+        engine = TokenizationEngine(self.tokenizer, cache_size=8)
+        expected = self.expected(self.lines)
+        self.assertEqual(expected, engine.encode_batch(self.lines))
+        self.assertEqual(len(set(self.lines)), engine.cache_info().misses)
+        # cached values can't be modified through the returned lists
+        engine.encode(self.lines[0]).append(-1)
+        self.assertEqual(expected[0], engine.encode(self.lines[0]))
+
+    def test_002_parallel_lines(self):
+        engine = TokenizationEngine(self.tokenizer, num_workers=2)
+        self.assertEqual(self.expected(self.lines), engine.tokenize_lines(self.lines, lines_per_task=7))
+        self.assertEqual(0, engine.cache_info().currsize)
+
+    def test_003_tokenize_corpus(self):
+        engine = TokenizationEngine(self.tokenizer, num_workers=2)
+        # small chunks so the lines are split between several processes
+        manifests = engine.tokenize_corpus(self.data_path, "Tokenizer-3", chunk_size=256)
+        self.assertGreater(len(manifests[0]['chunks']), 1)
+        lines = {part: read_thread(os.path.join(self.data_path, f"train.{part}"), len(self.lines) * 2)
+                 for part in ["from", "to"]}
+        for part in ["from", "to"]:
+            token_file = IndexedTokenFile(os.path.join(self.data_path, f"Tokenizer-3-{part}"))
+            self.assertEqual(self.expected(lines[part]), [token_file.sample(i).tolist() for i in range(len(token_file))])
+
+        output = os.path.join(self.data_path, "Tokenizer-3-from")
+        modified = os.stat(output + ".tokens").st_mtime_ns
+        self.assertEqual(manifests[0], engine.tokenize_file(os.path.join(self.data_path, "train.from"), output,
+                                                            chunk_size=256))
+        self.assertEqual(modified, os.stat(output + ".tokens").st_mtime_ns)
+
+        # a new tokenizer makes the existing token files out of date
+        tokenizer = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(self.lines, target_vocab_size=300)
+        manifest = TokenizationEngine(tokenizer, num_workers=1).tokenize_file(
+            os.path.join(self.data_path, "train.from"), output, chunk_size=256)
+        self.assertNotEqual(manifests[0]['converter'], manifest['converter'])
+        token_file = IndexedTokenFile(output)
+        self.assertEqual([tokenizer.encode(preprocess_sentence(line)) for line in lines["from"]],
+                         [token_file.sample(i).tolist() for i in range(len(token_file))])
+
+    def test_004_normaliser(self):
+        """The normaliser should match the regex chain preprocess_sentence used to run, in Python & in the graph."""
+        def regex_chain(sentence):
+            sentence = sentence.strip()
+            sentence = re.sub(r"([?.!,'*\":@])", r" \1 ", sentence)
+            sentence = re.sub(r"[^a-zA-z?.!,'*:\"@]+", " ", sentence)
+            return sentence.strip()
+
+        rng = np.random.default_rng(0)
+        alphabet = list("aZq  \t\n?.!,'*\":@[]^_`-#1é€😀")
+        sentences = self.lines[:5] + ["", " ", "..", "a..b", "  x , y  ", "ünïcödé wörds", "tab\tnew\nline"] + \
+            ["".join(rng.choice(alphabet, size=rng.integers(0, 20))) for _ in range(500)]
+        expected = [regex_chain(sentence) for sentence in sentences]
+        normaliser = TextNormaliser()
+        self.assertEqual(expected, [preprocess_sentence(sentence) for sentence in sentences])
+        self.assertEqual(expected, normaliser.normalise_batch(sentences))
+
+        array = np.array(sentences).reshape(-1, 4)
+        np.testing.assert_array_equal(np.array(expected).reshape(-1, 4), normaliser.normalise_batch(array))
+        np.testing.assert_array_equal(np.array(expected).reshape(-1, 4),
+                                      normaliser.normalise_batch(np.char.encode(array, "utf-8")))
+
+        graph = tf.function(TextNormaliser.tf_normalise)(tf.constant(sentences))
+        self.assertEqual(expected, [sentence.decode("utf-8") for sentence in graph.numpy().tolist()])
+
+    def test_005_graph_encoder(self):
+        """In graph encode & decode should match the tokenizer's on normalised text."""
+        rng = np.random.default_rng(0)
+        alphabet = list("abcdefghijklmnopqrstuvwxyzEDIT    ?.!,'*\":@[]^_`\\-#1é")
+        sentences = self.lines[:5] + ["", "[edit] don`t [of the] a_b __", "supercalifragilisticexpialidocious"] + \
+            ["".join(rng.choice(alphabet, size=rng.integers(0, 40))) for _ in range(500)]
+        sentences = [preprocess_sentence(sentence) for sentence in sentences]
+        for name in ["Tokenizer-3", "GloVe"]:
+            with self.subTest(msg=f"Testing {name}"):
+                tokenizer = tfds.deprecated.text.SubwordTextEncoder.load_from_file(
+                    os.path.join(BASE_DIR, os.path.join('tests/test_files', name)))
+                encoder = GraphSubwordEncoder(tokenizer)
+                self.assertEqual([tokenizer.encode(sentence) for sentence in sentences],
+                                 encoder.encode(tf.constant(sentences)).to_list())
+                self.assertEqual([[], []], encoder.encode(tf.constant(["", ""])).to_list())
+
+                ids = [rng.integers(0, tokenizer.vocab_size + 3, size=rng.integers(0, 30)).tolist() for _ in range(500)]
+                self.assertEqual([tokenizer.decode([i for i in row if 0 < i < tokenizer.vocab_size]) for row in ids],
+                                 [text.decode("utf-8") for text in
+                                  encoder.decode(tf.ragged.constant(ids).to_tensor()).numpy().tolist()])
+
+    def test_006_load_tokenized_corpus(self):
+        """load_tokenized_data should read up to date token files written by TokenizationEngine."""
+        TokenizationEngine(self.tokenizer, num_workers=1).tokenize_corpus(self.data_path, "train")
+        start, end = [self.tokenizer.vocab_size], [self.tokenizer.vocab_size + 1]
+        inputs, outputs = load_tokenized_data(len(self.lines) * 2, self.data_path, "train", start, end,
+                                              python_legacy=True)
+        for part, samples in [("from", inputs), ("to", outputs)]:
+            lines = read_thread(os.path.join(self.data_path, f"train.{part}"), len(self.lines) * 2)
+            self.assertEqual([start + sample + end for sample in self.expected(lines)], samples)